@@ -23,6 +23,10 @@ import ujson
 from PIL import Image
 import re
 import sys
+from transcription import load_transcription
+import line_geometry
+import ocr_store
+from align import ensure_overlay
 
 
 def remove_additionnal_dots(txt: str):
@@ -104,11 +108,8 @@ def retrieve_transcription(filename: str) -> str:
     # Retrieve filepath of the ocr and manual transcription form the image filename
     txt_manual_file = "tmp"+os.sep+"extract_txt"+os.sep+filename[:-4]+".gt.txt"
 
-    # Retrieve the manual transcription without tab and newline
-    with open(txt_manual_file, newline='', encoding='UTF-8', errors="ignore") as inputfile:
-        txt_manual = inputfile.readlines()
-        txt_manual = ''.join(txt_manual).replace('\t', '')
-    return txt_manual
+    # Retrieve the manual transcription without tab (shared with the alignment, see transcription.py)
+    return load_transcription(txt_manual_file, remove_last_line=False).raw
 
 
 def curate_alignments(acceptlist: list, filename: str, order: bool = False) -> None:
@@ -169,7 +170,6 @@ def generate_manual_alignments(number: int = -1, skip: int = 0) -> None:
 
     # Get last monitoring data
     segment_stats_path = "tmp"+os.sep+"save"+os.sep+"segment_stats"
-    segments_path = "tmp"+os.sep+"save"+os.sep+"segment"
     files = sorted(
         list(next(os.walk(segment_stats_path)))[2])
     # The last saved monitoring json is the last of half the file, due to the half being the histogram images
@@ -208,32 +208,20 @@ def generate_manual_alignments(number: int = -1, skip: int = 0) -> None:
             # Load segmentation data
             img = Image.open("tmp"+os.sep+"extract_image"+os.sep+filename)
             width = img.width
-            with open(segments_path+os.sep+filename+"_segment.json", "r", encoding="UTF-8", errors='ignore') as segment_file:
-                segments = ujson.load(segment_file)
+            # Lines of the ocr prediction, in the same order as the automatic alignment (see ocr_store.py)
+            predictions = ocr_store.load_ocr(filename)
 
             # Prepare the cropped images for the manual alignments
             crop_count = 0
             name_count = 0
-            for segment in segments["lines"]:
-                boundaries = segment["boundary"]
-                x_min = x_max = boundaries[0][0]
-                y_min = y_max = boundaries[0][1]
-                for i in range(1, len(boundaries)):
-
-                    x = boundaries[i][0]
-                    y = boundaries[i][1]
-
-                    # Take larger coordinates for a rectangle cropping
-                    x_min = (x if x < x_min else x_min)
-                    x_max = (x if x > x_max else x_max)
-                    y_min = (y if y < y_min else y_min)
-                    y_max = (y if y > y_max else y_max)
-
-                cropped = img.crop((x_min, y_min, x_max, y_max))
+            boxes = line_geometry.bounding_boxes(
+                [record.line for record in predictions])
+            for box in boxes:
+                cropped = img.crop(tuple(int(x) for x in box))
                 w, h = cropped.size
 
                 # Skip images that are too 'small'
-                if w < 0.2*width:
+                if w < line_geometry.min_width_ratio*width:
                     name_count += 1
                     continue
                 cropped_name = "manual_align"+os.sep+filename + \
@@ -250,6 +238,12 @@ def generate_manual_alignments(number: int = -1, skip: int = 0) -> None:
             img.close()
 
             text_ref = retrieve_transcription(filename)
+
+            # The segmented image shown next to the alignment is drawn on first request
+            try:
+                ensure_overlay(filename)
+            except OSError as Argument:
+                print("No segmented image for "+filename+" : "+str(Argument))
             generate_manual_align_webpage(
                 filename, images, text_ref, usable, used)
             progress_count += 1
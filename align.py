@@ -4,51 +4,90 @@ align.py: Contains functions for alignment
 
 import numpy as np
 import os
-import pickle
 import cv2 as cv
 import re
-from monitoring import timeit
+import argparse
+from monitoring import timeit, setup_logger
+import distance
+from transcription import Transcription, load_transcription, encode_text, word_separators
+from crop_writer import CropWriter, crop_formats
+import overlay
+import line_geometry
+import ocr_store
+from checkpoint import unfinished_suffix, write_atomic
 import shutil
+import hashlib
+import json
+from multiprocessing import Pool
 import logging
 logger = logging.getLogger("TIA_logger")
 
 
 image_extension = (".jpg", ".png")
 
+# Alignment results of each page, reused while its inputs are unchanged
+align_cache_dir = "tmp"+os.sep+"save"+os.sep+"align_cache"
 
-def levenshtein_dist(s1: str, s2: str) -> float:
+# Version of the alignment rules (acceptance thresholds of acceptance_threshold() and check_dist_acceptance(),
+# guards and matching of align_patterns()), to increment whenever they change so the pages are aligned again
+ALIGN_CACHE_VERSION = 1
+
+# Defaults of the keyword arguments of align_patterns(), the options of an alignment are completed with them
+default_align_options = {"mode": "hamming", "search": "full", "band": 20, "window": 200, "q": 4}
+
+# Hits and misses of the alignment cache in this process
+align_cache_stats = {"hit": 0, "miss": 0}
+
+# When the segmented image of a page is drawn, see align_cropped()
+overlay_modes = ("eager", "lazy", "off")
+
+
+def levenshtein_dist(s1: str, s2: str, max_dist: int = -1, traceback: bool = False) -> tuple:
     """
     Compute and return the Levenshtein Distance.
-    Algorithm from : https://fr.wikipedia.org/wiki/Distance_de_Levenshtein
+    The full matrix is only computed when a traceback is asked (see distance.py)
 
     Parameters :
         s1 :
-            String 2
+            String 1
         s2 :
             String 2
+        max_dist :
+            Stop as soon as the distance is known to be greater than max_dist, the value returned is then max_dist+1
+            (By default : -1, negative value will compute the exact distance)
+        traceback :
+            If True, the full matrix is also returned
 
     Returns :
-        The Levenshtein distance of s1 and s2
+        The Levenshtein distance of s1 and s2, and his matrix if traceback is True (else None)
     """
-    m, n = len(s1)+1, len(s2)+1
+    if traceback:
+        d = distance.levenshtein_matrix(s1, s2)
+        return d[-1][-1], d
+    return distance.levenshtein(s1, s2, max_dist), None
 
-    # Init all values of matrix with zeros
-    d = [[0]*(n) for i in range(m)]
 
-    for i in range(m):
-        d[i][0] = i
-    for j in range(n):
-        d[0][j] = j
+def character_error_rate(pattern: str, reference: str, max_dist: int = -1) -> float:
+    """
+    Calculate the Character Error Rate, normalized by the length of the reference
 
-    for j in range(1, n):
-        for i in range(1, m):
-            cost = 0 if s1[i-1] == s2[j-1] else 1
-            d[i][j] = min(
-                d[i-1][j]+1,  # deletion of the new character of s1
-                d[i][j-1]+1,  # insertion in s2 of the new character of s1
-                d[i-1][j-1]+cost)  # substitution
+    Parameters :
+        pattern :
+            pattern to test
+        reference :
+            Reference to compare to
+        max_dist :
+            Maximum edit distance of interest, past it the computation is stopped
+            and the rate returned is the one of max_dist+1
+            (By default : -1, negative value will compute the exact rate)
 
-    return d[m-1][n-1], d
+    Returns :
+        The CER
+    """
+    cer = distance.levenshtein(pattern, reference, max_dist)
+    if len(reference):
+        cer = cer/len(reference)
+    return cer
 
 
 def calculate_error_rate(pattern, reference, norm=True, percent=False):
@@ -69,8 +108,8 @@ def calculate_error_rate(pattern, reference, norm=True, percent=False):
     pattern_words = pattern.split()
     ref_words = reference.split()
 
-    wer = levenshtein_dist(pattern_words, ref_words)[0]
-    cer = levenshtein_dist(pattern, reference)[0]
+    wer = distance.levenshtein(pattern_words, ref_words)
+    cer = distance.levenshtein(pattern, reference)
     if norm or percent:
         if len(ref_words):
             wer = wer/len(ref_words)
@@ -120,6 +159,107 @@ def hamming_distance(string1: str, string2: str) -> int:
     return sum(c1 != c2 for c1, c2 in zip(string1, string2))
 
 
+def batch_hamming_scores(patterns: list, text_codes: np.ndarray, chunk_size: int = 64) -> list:
+    """
+    Calculate the Hamming Distance of every pattern against every offset of the text
+    Patterns are compared in batch, as a matrix padded to the longest pattern
+
+    Parameters:
+        patterns :
+            List of patterns to compare, they are compared as is (not lowercased)
+        text_codes :
+            The text encoded with encode_text()
+        chunk_size :
+            Maximum number of patterns compared at once, to bound the memory used
+
+    Returns:
+        A list of numpy arrays, for each pattern the Hamming Distance at each offset
+        (offsets go from 0 to len(text)-len(pattern) excluded)
+    """
+    scores = []
+    for start in range(0, len(patterns), chunk_size):
+        chunk = patterns[start:start+chunk_size]
+        lengths = [len(pattern) for pattern in chunk]
+        max_length = max(lengths)
+        nb_offsets = max(len(text_codes)-min(lengths), 0)
+
+        # Patterns are padded with a mask so that padding never counts as a mismatch
+        pattern_codes = np.zeros((len(chunk), max_length), dtype=np.int32)
+        valid = np.zeros((len(chunk), max_length), dtype=bool)
+        for i, pattern in enumerate(chunk):
+            pattern_codes[i, :len(pattern)] = encode_text(pattern, lower=False)
+            valid[i, :len(pattern)] = True
+
+        # The text is padded as well, so that every column can be sliced with the same number of offsets
+        padded_text = np.concatenate(
+            (text_codes, np.full(max_length, -1, dtype=np.int32)))
+
+        chunk_scores = np.zeros((len(chunk), nb_offsets), dtype=np.int32)
+        for j in range(max_length):
+            chunk_scores += (padded_text[j:j+nb_offsets][np.newaxis, :] !=
+                             pattern_codes[:, j][:, np.newaxis]) & valid[:, j][:, np.newaxis]
+
+        for i, length in enumerate(lengths):
+            scores.append(chunk_scores[i, :max(len(text_codes)-length, 0)])
+    return scores
+
+
+def hamming_scores(pattern: str, text_codes: np.ndarray, start: int = 0, stop: int = -1) -> np.ndarray:
+    """
+    Calculate the Hamming Distance of one pattern against a range of offsets of the text
+
+    Parameters:
+        pattern :
+            Pattern to compare, it is compared as is (not lowercased)
+        text_codes :
+            The text encoded with encode_text()
+        start :
+            First offset compared
+        stop :
+            Offset where the comparison stops (excluded)
+            (By default : -1, negative value will compare up to len(text)-len(pattern) excluded)
+
+    Returns:
+        A numpy array of the Hamming Distance at each offset from start to stop
+    """
+    nb_offsets = len(text_codes)-len(pattern)
+    if stop < 0 or stop > nb_offsets:
+        stop = nb_offsets
+    if stop <= start:
+        return np.zeros(0, dtype=np.int32)
+
+    scores = np.zeros(stop-start, dtype=np.int32)
+    for j, code in enumerate(encode_text(pattern, lower=False)):
+        scores += text_codes[start+j:stop+j] != code
+    return scores
+
+
+def best_hamming_matches(patterns: list, transcription: Transcription) -> list:
+    """
+    Find for each pattern the offset of the text with the smallest Hamming Distance
+    (the first offset is kept in case of equality)
+
+    Parameters:
+        patterns :
+            List of patterns to align, expected to be already lowercased
+        transcription :
+            The Transcription in which the patterns are located
+
+    Returns:
+        A list of (index, score) for each pattern, (-1, -1) if the pattern is longer than the text
+    """
+    if not patterns:
+        return []
+    matches = []
+    for scores in batch_hamming_scores(patterns, transcription.codes):
+        if len(scores) == 0:
+            matches.append((-1, -1))
+            continue
+        index = int(np.argmin(scores))
+        matches.append((index, int(scores[index])))
+    return matches
+
+
 def txt_compare_open(image_filename: str) -> tuple:
     """
     Retrieve the ocr result and the transcription of the filename
@@ -129,7 +269,7 @@ def txt_compare_open(image_filename: str) -> tuple:
             Name of the image file
 
     Returns:
-        A string of the transcription and a list of every pattern found by the ocr
+        The Transcription object and a list of every pattern found by the ocr
     """
 
     # Retrieve filepath of the ocr and manual transcription form the image filename
@@ -141,10 +281,8 @@ def txt_compare_open(image_filename: str) -> tuple:
     # We compare using lowercased string, the manual transcription will be lowercased when compared
 
     # Retrieve the manual transcription without tab and newline
-    with open(txt_manual_file, newline='', encoding='UTF-8', errors="ignore") as inputfile:
-        txt_manual = inputfile.readlines()
-        txt_manual.pop()  # Remove last line which is autographe reference
-        txt_manual = ''.join(txt_manual).replace('\t', '')
+    # (without the last line which is autographe reference)
+    txt_manual = load_transcription(txt_manual_file)
 
     # Retrieve the ocr prediction into a list of each segmented part
     with open(txt_ocr_file, newline='', encoding='UTF-8', errors="ignore") as inputfile:
@@ -155,13 +293,14 @@ def txt_compare_open(image_filename: str) -> tuple:
     return txt_manual, txt_ocr
 
 
-def complete_word(corpus: str, lower_bound: int, upper_bound: int, threshold: int = -1) -> str:
+def complete_word(corpus: Transcription, lower_bound: int, upper_bound: int, threshold: int = -1) -> str:
     """
     Will try to complete words by extending range up to threshold amount of character
+    The word separators are found with binary searches in the sorted positions of separators
 
     Parameters:
         corpus:
-            Corpus where the text is from
+            Corpus where the text is from (a Transcription or a string)
         lower_bound:
             index where the extracted text starts
         upper_bound:
@@ -173,23 +312,25 @@ def complete_word(corpus: str, lower_bound: int, upper_bound: int, threshold: in
     Returns:
         Text processed that may be extended
     """
+    if isinstance(corpus, Transcription):
+        text, separators = corpus.text, corpus.separators
+    else:
+        text, separators = corpus, word_separators(corpus)
+
+    def previous_separator(index: int) -> int:
+        # Position of the last separator at or before index, -1 if there is none
+        position = np.searchsorted(separators, index, side="right")
+        return int(separators[position-1]) if position > 0 else -1
+
+    def next_separator(index: int) -> int:
+        # Position of the first separator at or after index, len(text) if there is none
+        position = np.searchsorted(separators, index, side="left")
+        return int(separators[position]) if position < len(separators) else len(text)
 
     # Will extend upper and lower bound until a word separator if encountered
-    word_separator = [" ", ",", "", "\n"]
-
-    new_upper = upper_bound
-    new_lower = lower_bound
-    character = corpus[new_lower]
-    while character not in word_separator:
-        new_lower -= 1
-        character = corpus[new_lower]
-
-    character = corpus[new_upper]
-    while character not in word_separator:
-        new_upper += 1
-        if new_upper >= len(corpus):
-            break
-        character = corpus[new_upper]
+    # (the start and the end of the text count as separators)
+    new_lower = previous_separator(lower_bound)
+    new_upper = next_separator(upper_bound)
 
     # Threshold check, to not extend too much
     if threshold >= 0:
@@ -197,22 +338,31 @@ def complete_word(corpus: str, lower_bound: int, upper_bound: int, threshold: in
         # if so, remove the incomplete word
 
         if lower_bound - new_lower >= threshold:
-            new_lower = lower_bound
-            character = corpus[new_lower]
-            while character not in word_separator:
-                new_lower += 1
-                if new_lower >= len(corpus):
-                    break
-                character = corpus[new_lower]
+            new_lower = next_separator(lower_bound)
 
         if new_upper - upper_bound >= threshold:
-            new_upper = upper_bound
-            character = corpus[new_upper]
-            while character not in word_separator:
-                new_upper -= 1
-                character = corpus[new_upper]
+            new_upper = previous_separator(upper_bound)
 
-    return corpus[new_lower+1:new_upper]
+    return text[new_lower+1:new_upper]
+
+
+def acceptance_threshold(x: int) -> float:
+    """
+    Custom math function separating acceptable alignments from non-acceptable alignments
+    (see check_dist_acceptance())
+
+    Parameters:
+        x :
+            Value x, corresponding the lenght of the OCR pattern
+
+    Returns:
+        The normalized distance under which an alignment of this length is accepted
+    """
+    if x >= 60:
+        return 0.6
+    elif x >= 20:
+        return 0.005*x+0.3
+    return 0.04*x-0.4
 
 
 def check_dist_acceptance(x: int, dist: int):
@@ -234,17 +384,159 @@ def check_dist_acceptance(x: int, dist: int):
             "It was asked to check the acceptance of a value that shouldn't be possible in a discrete environnement")
         return True
 
-    if x >= 60 and dist < 0.6:
-        return True
-    elif x >= 20 and x <= 60 and dist < (0.005*x+0.3):
-        return True
-    elif x <= 20 and dist < (0.04*x-0.4):
-        return True
-    return False
+    return dist < acceptance_threshold(x)
+
+
+def semi_global_match(pattern: str, transcription: Transcription, seed: int, band: int = 20) -> tuple:
+    """
+    Locate a pattern with a semi-global edit distance search (free start and end in the text),
+    restricted to a band of characters around the hamming seed
+    Unlike the hamming scan, it handles insertions and deletions in the ocr
+
+    Parameters:
+        pattern:
+            Pattern to locate, already lowercased
+        transcription:
+            Transcription in which the pattern is located
+        seed:
+            Index of the best hamming match of the pattern
+        band:
+            Number of characters searched before and after the hamming match
+
+    Returns:
+        The index where the match starts, the text matched and its edit distance
+    """
+    window_start = max(0, seed-band)
+    window_end = min(len(transcription), seed+len(pattern)+band)
+    start, end, dist = distance.semi_global_align(
+        pattern, transcription.lower[window_start:window_end])
+
+    # Surrounding spaces are not kept in the text matched
+    matched = transcription.text[window_start+start:window_start+end]
+    start += len(matched)-len(matched.lstrip())
+    return window_start+start, matched.strip(), dist
+
+
+def monotone_hamming_match(pattern: str, transcription: Transcription, anchor: int, misses: int, window: int = 200, band: int = 20, max_misses: int = 5) -> tuple:
+    """
+    Find the offset with the smallest Hamming Distance in a window following the previous accepted match
+    Lines of the ocr and the transcription are in the same reading order, so the next line is expected right after
+
+    Parameters:
+        pattern :
+            Pattern to align, expected to be already lowercased
+        transcription :
+            Transcription in which the pattern is located
+        anchor :
+            Index in the text where the previous accepted match ends, negative if there is none yet
+            (the whole text is then searched)
+        misses :
+            Number of patterns not accepted since the previous accepted match,
+            the window grows by the length of the pattern for each of them
+        window :
+            Number of characters searched after the anchor
+        band :
+            Number of characters searched before the anchor
+        max_misses :
+            Past this number of misses, the anchor is considered lost (likely a false match) and the whole text is searched
+
+    Returns:
+        (index, score) of the best match, (-1, -1) if the pattern doesn't fit in the window,
+        and the number of offsets evaluated
+    """
+    if anchor < 0 or misses > max_misses:
+        start, stop = 0, -1
+    else:
+        start, stop = max(0, anchor-band), anchor+window+misses*len(pattern)
+
+    scores = hamming_scores(pattern, transcription.codes, start, stop)
+    if len(scores) == 0:
+        return -1, -1, 0
+    index = int(np.argmin(scores))
+    return start+index, int(scores[index]), len(scores)
+
+
+def seed_candidates(pattern: str, index: dict, q: int = 4, max_candidates: int = 5) -> list:
+    """
+    Propose the offsets where a pattern is likely located, by voting with the q-grams it shares with the text
+
+    Parameters:
+        pattern :
+            Pattern to align, expected to be already lowercased
+        index :
+            Inverted index of the text obtained with Transcription.qgram_index()
+        q :
+            Number of characters of each q-gram (same as the index)
+        max_candidates :
+            Maximum number of offsets proposed
+
+    Returns:
+        List of the offsets with the most votes, empty if no q-gram is shared
+    """
+    votes = []
+    for i in range(len(pattern)-q+1):
+        positions = index.get(pattern[i:i+q])
+        if positions is not None:
+            # A q-gram at position i of the pattern votes for the pattern starting i characters before
+            votes.append(positions-i)
+    if not votes:
+        return []
+
+    offsets, counts = np.unique(np.concatenate(votes), return_counts=True)
+    best = np.argsort(-counts, kind="stable")[:max_candidates]
+    return [int(offset) for offset in offsets[best]]
+
+
+def seeded_hamming_match(pattern: str, transcription: Transcription, q: int = 4, band: int = 20) -> tuple:
+    """
+    Find the offset with the smallest Hamming Distance, only around the offsets proposed by q-gram seeds
+    If no seed is found, or every seed is past the last offset of the pattern, the whole text is searched
+
+    Parameters:
+        pattern :
+            Pattern to align, expected to be already lowercased
+        transcription :
+            Transcription in which the pattern is located
+        q :
+            Number of characters of each q-gram
+        band :
+            Number of characters searched before and after each seed
+
+    Returns:
+        (index, score) of the best match, (-1, -1) if the pattern is longer than the text,
+        and the number of offsets evaluated
+    """
+    candidates = seed_candidates(pattern, transcription.qgram_index(q), q)
+
+    # Ranges around each seed, merged when they overlap
+    ranges = []
+    for candidate in sorted(candidates):
+        start, stop = max(0, candidate-band), candidate+band+1
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], stop)
+        else:
+            ranges.append([start, stop])
+
+    best, best_score, evaluated = -1, -1, 0
+    for start, stop in ranges:
+        scores = hamming_scores(pattern, transcription.codes, start, stop)
+        evaluated += len(scores)
+        if len(scores) and (best < 0 or scores.min() < best_score):
+            best = start+int(np.argmin(scores))
+            best_score = int(scores.min())
+    if best >= 0:
+        return best, best_score, evaluated
+
+    # No seed, or only seeds too close to the end of the text for the whole pattern to fit
+    scores = hamming_scores(pattern, transcription.codes)
+    if len(scores) == 0:
+        return -1, -1, evaluated
+    best = int(np.argmin(scores))
+    return best, int(scores[best]), evaluated+len(scores)
 
 
 @ timeit
-def align_patterns(patterns: list, text: str, printing: bool = True) -> tuple:
+def align_patterns(patterns: list, text: Transcription, printing: bool = True, mode: str = "hamming", search: str = "full", band: int = 20, window: int = 200, q: int = 4) -> tuple:
     """
     Find the best alignment for each pattern
     It may return an empty list if no alignment was found
@@ -253,69 +545,139 @@ def align_patterns(patterns: list, text: str, printing: bool = True) -> tuple:
         pattern:
             List of all pattern to test
         text:
-            Text in which the pattern are located
+            Transcription in which the pattern are located (a string is also accepted)
         printing:
             If True result will be printed on terminal
+        mode:
+            "hamming" : the hamming match is completed with complete_word() then checked with the CER
+            "semiglobal" : the hamming match is refined in one pass with semi_global_match()
+        search:
+            "full" : every pattern is searched in the whole text
+            "monotone" : once a pattern is accepted, the next ones are only searched in a window after it
+            (see monotone_hamming_match())
+            "qgram" : patterns are only searched around the offsets proposed by their q-grams
+            (see seeded_hamming_match())
+        band:
+            Number of characters around the hamming match searched in the "semiglobal" mode,
+            before the previous match in the "monotone" search and around each seed in the "qgram" search
+        window:
+            Number of characters after the previous match searched in the "monotone" search
+        q:
+            Number of characters of the q-grams used in the "qgram" search
 
     Returns:
         A list of [pattern, pattern_index, text_matched, distance_score] and his list of index indicating where these match are in the text
     """
+    if mode not in ("hamming", "semiglobal"):
+        raise ValueError("Unknown alignment mode : "+str(mode))
+    if search not in ("full", "monotone", "qgram"):
+        raise ValueError("Unknown search : "+str(search))
 
     indexes = []
     # associations = [ [pattern, pattern_index, text_matched, distance score]  , [ ... ] , ... ]
     associations = []
     pattern_index = 0
-    text = text.replace("\n", " ")
+    transcription = text if isinstance(
+        text, Transcription) else Transcription(text)
+    text = transcription.text
 
     # For each pattern found by the ocr
     # 1/ Align them in the original text using hamming distance
     #  (comppared in lowercase, because the poet tend the mix upper and lower case in writing)
     # 2/ With the best match, complete word if necessary
-    for pattern in patterns:
-        scores = []
-        for i in range(len(text)-len(pattern)):
-            scores.append(hamming_distance(
-                pattern, text[i:i+len(pattern)].lower()))
-        index = np.argmin(scores)
+    if search == "full":
+        # The hamming scan of every pattern is done in one batch over the encoded text
+        matches = best_hamming_matches(patterns, transcription)
 
-        # Complete words
-        text_complete = complete_word(
-            text, index, index+len(pattern), threshold=3)
+    # Number of offsets evaluated, to compare with the full scan
+    total_evaluated = 0
+
+    # For the monotone search, end of the last accepted match and number of patterns rejected since
+    anchor, misses = -1, 0
+    # Patterns skipped by the length guards, they are neither accepted nor rejected
+    skipped = 0
+
+    for pattern in patterns:
 
         if not pattern or pattern.isspace():
             # Skip empty ocr/pattern
             pattern_index += 1
             continue
 
-        # Get Word Error Rate and Character Error Rate
-        wer, cer = calculate_error_rate(pattern, text_complete.lower())
+        if search == "full":
+            index, score = matches[pattern_index]
+            evaluated = max(len(text)-len(pattern), 0)
+        elif search == "monotone":
+            index, score, evaluated = monotone_hamming_match(
+                pattern, transcription, anchor, misses, window, band)
+        else:
+            index, score, evaluated = seeded_hamming_match(
+                pattern, transcription, q, band)
+        total_evaluated += evaluated
+        if printing:
+            logger.debug("Evaluated "+str(evaluated) +
+                         " offsets for pattern "+str(pattern_index))
+
+        if index < 0:
+            # Skip pattern longer than the text (or the window)
+            skipped += 1
+            pattern_index += 1
+            continue
 
-        # Get the minimum between the hamming distance
-        # and the CER = Levensthein distance with the text completed
-        min_normalized = scores[index]/len(pattern)
-        if min_normalized > cer:
-            min_normalized = cer
+        if mode == "semiglobal":
+            # The span and its edit distance replace the word completion and the CER
+            index, text_complete, score = semi_global_match(
+                pattern, transcription, index, band)
+        else:
+            # Complete words
+            text_complete = complete_word(
+                transcription, index, index+len(pattern), threshold=3)
 
         # Alignment to a smalll text is too much of a hazard
         if len(text_complete) > 15:
 
+            # Get the minimum between the hamming distance
+            # and the CER = Levensthein distance with the text completed
+            # The CER is only needed when the hamming distance isn't enough to accept the alignment,
+            # and its computation stops past the distance where it couldn't be accepted either
+            min_normalized = score/len(pattern)
+            if mode == "hamming" and not check_dist_acceptance(len(pattern), min_normalized):
+                max_dist = int(acceptance_threshold(
+                    len(pattern))*len(text_complete))
+                cer = character_error_rate(
+                    pattern, text_complete.lower(), max_dist)
+                if min_normalized > cer:
+                    min_normalized = cer
+
             # A distance too great is ignored
             if check_dist_acceptance(len(pattern), min_normalized):
 
                 associations.append([
-                    pattern, pattern_index, text_complete, scores[index]])
+                    pattern, pattern_index, text_complete, score])
                 indexes.append(index)
+                anchor, misses = index+len(pattern), 0
 
                 # if True, if will log a trace of every alignment done ( cause a lot of logs )
                 if printing:
+                    # Get Word Error Rate and Character Error Rate
+                    wer, cer = calculate_error_rate(
+                        pattern, text_complete.lower())
                     logger.debug("For : "+str(pattern)+" | >> dist score : " +
-                                 str(scores[index]/len(pattern)) + "\t\t\t at index : "+str(index))
+                                 str(score/len(pattern)) + "\t\t\t at index : "+str(index))
                     logger.debug("\t "+text[index:index+len(pattern)])
                     logger.debug("\t "+text_complete)
                     logger.debug("WER : "+str(wer) +
                                  ", CER : "+str(cer))
+            else:
+                misses += 1
+        else:
+            skipped += 1
 
         pattern_index += 1
+
+    logger.debug("Evaluated "+str(total_evaluated)+" offsets with the " +
+                 search+" search for "+str(len(patterns))+" patterns, " +
+                 str(skipped)+" skipped by the length guards")
     return associations, indexes
 
 
@@ -327,7 +689,7 @@ def get_usable_alignments(associations: dict, indexes: list) -> tuple:
     return associations, indexes
 
 
-def align_cropped(lst: list, indexes_origin: list, filepath: str) -> None:
+def align_cropped(lst: list, indexes_origin: list, filepath: str, writer: CropWriter = None, overlay_mode: str = "lazy") -> None:
     """
     For each alignment, create the pair text-image
 
@@ -339,102 +701,90 @@ def align_cropped(lst: list, indexes_origin: list, filepath: str) -> None:
             Unused in this function
         filepath:
             Path to the original image
+        writer:
+            CropWriter writing the pairs in background, the folder of the page appears once they are written
+            (By default : None, a CropWriter is created and the pairs are written before returning)
+        overlay_mode:
+            "eager" draws the segmentation on a downscaled image in tmp/segmented/ (see overlay.py),
+            "lazy" removes the outdated one so it is drawn on first request (see ensure_overlay()),
+            "off" leaves tmp/segmented/ untouched
 
     Returns:
         None
     """
+    if overlay_mode not in overlay_modes:
+        raise ValueError("Unknown overlay mode : "+str(overlay_mode))
 
     filename = filepath.split(os.sep)[-1]
 
-    # Fetch position of segmented pattern from pickled save of an ocr_record
-    predict_backup = "tmp"+os.sep+"save"+os.sep + \
-        "ocr_save"+os.sep+filename+'_ocr.pickle'
-    with open(predict_backup, 'rb') as file:
-        predictions = pickle.load(file)
+    # Fetch position of segmented pattern from the saved ocr prediction, kraken isn't needed
+    predictions = ocr_store.load_ocr(filename)
 
+    # Pairs are written in a temporary folder renamed once complete,
+    # since the presence of the folder indicates the file was already processed
     cropping_dir = "tmp"+os.sep+"cropped_match"+os.sep+filename
-    segmented_img_dir = "tmp"+os.sep+"segmented"
+    tmp_cropping_dir = cropping_dir+unfinished_suffix
 
     indexes = [i[1] for i in lst]
 
+    local_writer = writer is None
+    if local_writer:
+        writer = CropWriter()
+
     try:
-        os.makedirs(segmented_img_dir, exist_ok=True)
-        os.makedirs(cropping_dir, exist_ok=True)
+        writer.start_page(tmp_cropping_dir, cropping_dir)
 
         # Align text-image for crop
         img = cv.imread(filepath, cv.IMREAD_COLOR)
-        img_segmented = img.copy()
         count_iterator = 0
 
-        for i in range(len(predictions)):
-
-            # Crop the image
-            boundaries = predictions[i].line
-            x_min = x_max = boundaries[0][0]
-            y_min = y_max = boundaries[0][1]
-            for j in range(1, len(boundaries)):
+        # Take larger coordinates of every line for a rectangle cropping
+        boundaries = [prediction.line for prediction in predictions]
+        boxes = line_geometry.bounding_boxes(boundaries)
+        used = set(indexes)
 
-                # If segment is used, draw it in blue
-                if i in indexes:
-                    img_segmented = cv.line(img_segmented, boundaries[j-1],
-                                            boundaries[j], (255, 0, 0, 0.25), 5)
-                else:  # draw it in red
-
-                    img_segmented = cv.line(img_segmented, boundaries[j-1],
-                                            boundaries[j], (0, 0, 255, 0.25), 5)
-
-                x = boundaries[j][0]
-                y = boundaries[j][1]
-
-                # Take larger coordinates for a rectangle cropping
-                x_min = (x if x < x_min else x_min)
-                x_max = (x if x > x_max else x_max)
-                y_min = (y if y < y_min else y_min)
-                y_max = (y if y > y_max else y_max)
+        for i in range(len(predictions)):
 
             # If the text matched is empty, skip
 
             # If the segment width isn't at least 20% of the total image width, skip (most likely noise)
-            # Also re-draw them in orange (less visible)
-            if (x_max-x_min) < 0.2*img.shape[1]:
-
-                boundaries = predictions[i].line
-                for j in range(1, len(boundaries)):
-
-                    img_segmented = cv.line(img_segmented, boundaries[j-1],
-                                            boundaries[j], (80, 165, 255, 1), 5)
+            if (boxes[i][2]-boxes[i][0]) < line_geometry.min_width_ratio*img.shape[1]:
                 continue
-            if i not in indexes:
+            if i not in used:
                 continue
 
-            # Create cropped file associated
-            cropped = img[y_min:y_max, x_min:x_max]
-
-            # new filepath,  also remove additionnal "." = dots due to kraken/ketos implementation
-            cropped_img_path = cropping_dir+os.sep + \
-                filename[:-4].replace(".", "")+"_"+str(count_iterator)+".jpg"
-            cv.imwrite(cropped_img_path, cropped)
+            # Create cropped file associated, the background is masked by the writer if asked
+            cropped = line_geometry.crop_box(img, boxes[i])
 
-            # Create txt file associated
-            with open(cropped_img_path[:-4]+'.gt.txt', 'w', encoding='UTF-8', errors="ignore") as f:
-                f.write(lst[count_iterator][2])
+            # new filename,  also remove additionnal "." = dots due to kraken/ketos implementation
+            # The image and its txt file associated are written in background
+            writer.write_pair(tmp_cropping_dir, filename[:-4].replace(".", "")+"_"+str(count_iterator),
+                              cropped, lst[count_iterator][2], boundaries[i], boxes[i][:2])
             count_iterator += 1
-        logger.debug("Finished cropping " +
-                     str(count_iterator) + " times for "+filename)
+        logger.debug("Queued " + str(count_iterator) +
+                     " croppings for "+filename)
 
         # Save the original image with segmentation drawn on it
-        cv.imwrite(segmented_img_dir+os.sep +
-                   filename[:-4]+"_segmented.jpg", img_segmented)
+        if overlay_mode == "eager":
+            overlay.save_overlay(img, filename, boundaries,
+                                 used, writer=writer)
+        elif overlay_mode == "lazy":
+            overlay.remove_overlay(filename)
+
+        # The folder is atomically renamed once every pair is written, marking the file as processed
+        writer.finish_page(tmp_cropping_dir)
+        if local_writer:
+            writer.close()
 
     except KeyboardInterrupt:
         # If this process is interrupted, considering we use the presence of the folder
         # to indicate files are already processed, we remove the folder unfinished
-        shutil.rmtree(cropping_dir)
+        shutil.rmtree(tmp_cropping_dir, ignore_errors=True)
         exit()
 
 
 @ timeit
-def batch_align_crop(image_dir: str, printing: bool = False) -> None:
+def batch_align_crop(image_dir: str, printing: bool = False, align_options: dict = None, workers: int = 1, crop_options: dict = None, overlay_mode: str = "lazy") -> None:
     """
     Batch process image files to create pairs of alignments text-images
 
@@ -443,13 +793,31 @@ def batch_align_crop(image_dir: str, printing: bool = False) -> None:
             Directory where images are located
         printing:
             If True, logger will log in debug of each text-image alignment with their score
+        align_options:
+            Keyword arguments given to align_patterns() (i.e. {"mode": "semiglobal"})
+        workers:
+            Number of processes aligning images in parallel (By default : 1, no process pool is used)
+        crop_options:
+            Keyword arguments given to the CropWriter (i.e. {"image_format": "png", "grayscale": True})
+        overlay_mode:
+            When the segmented images are drawn, see align_cropped() (By default : "lazy")
 
     Returns:
         None
     """
     logger.info("Started batch align text-images with segmented images")
-    count = 0
-    # Process the entire directory
+    if crop_options is None:
+        crop_options = {}
+
+    # Remove cropping folders left unfinished by an interrupted run
+    cropped_match_dir = "tmp"+os.sep+"cropped_match"
+    if os.path.isdir(cropped_match_dir):
+        for folder in os.listdir(cropped_match_dir):
+            if folder.endswith(unfinished_suffix):
+                shutil.rmtree(cropped_match_dir+os.sep+folder)
+
+    # List the entire directory
+    jobs = []
     for (dirpath, subdirnames, filenames) in os.walk(image_dir):
         for filename in filenames:
 
@@ -458,12 +826,169 @@ def batch_align_crop(image_dir: str, printing: bool = False) -> None:
                 continue
 
             filepath = dirpath+os.sep+filename
-            # Process the entire directory, thism ay cause error due to image present but not yet ocr-ed
-            count = apply_align(
-                count, filename, filepath, len(filenames), printing=printing)
+            jobs.append((len(jobs), filename, filepath))
+    total = len(jobs)
+
+    count = 0
+    hits = misses = 0
+    if workers <= 1:
+        hits, misses = align_cache_stats["hit"], align_cache_stats["miss"]
+
+        # Pairs of a page are written while the next one is aligned
+        with CropWriter(**crop_options) as writer:
+            for position, filename, filepath in jobs:
+                # Process the entire directory, thism ay cause error due to image present but not yet ocr-ed
+                count = apply_align(
+                    count, filename, filepath, total, printing=printing, align_options=align_options, writer=writer,
+                    overlay_mode=overlay_mode)
+        hits = align_cache_stats["hit"]-hits
+        misses = align_cache_stats["miss"]-misses
+    else:
+        # Pages are independent, they are distributed by chunks to the pool
+        jobs = [(position, filename, filepath, total, printing, align_options, crop_options, overlay_mode)
+                for position, filename, filepath in jobs]
+        chunksize = max(1, total//(workers*4))
+        done = 0
+        with Pool(workers) as pool:
+            for aligned, hit, miss in pool.imap_unordered(apply_align_job, jobs, chunksize=chunksize):
+                count += aligned
+                hits += hit
+                misses += miss
+                done += 1
+                logger.info("Processed "+str(done)+"/"+str(total) +
+                            " images, "+str(count)+" newly aligned")
+
+    logger.info("Aligned a total of "+str(count)+" images")
+    logger.info("Alignment cache : "+str(hits)+" hits, " +
+                str(misses)+" misses")
+
+
+def alignment_cache_key(txt_ocr: list, transcription: Transcription, align_options: dict) -> str:
+    """
+    Hash every input of the alignment of a page, the version of the alignment rules included
+
+    Parameters:
+        txt_ocr:
+            List of the lines predicted by the ocr
+        transcription:
+            The Transcription of the page
+        align_options:
+            Keyword arguments given to align_patterns(), the ones missing being its defaults
+
+    Returns:
+        The hexadecimal sha256 of the inputs
+    """
+    # The same settings give the same key, whether they are given or left to their defaults
+    options = dict(default_align_options, **align_options)
+    content = json.dumps({"ocr": txt_ocr, "transcription": transcription.text,
+                          "options": sorted(options.items()), "version": ALIGN_CACHE_VERSION})
+    return hashlib.sha256(content.encode("UTF-8")).hexdigest()
 
 
-def apply_align(count: int, filename: str, filepath: str, total: int, printing: bool = False) -> int:
+def load_alignment_cache(filename: str) -> dict:
+    """
+    Fetch the alignment of a page saved by save_alignment_cache()
+
+    Parameters:
+        filename:
+            Name of the image file
+
+    Returns:
+        {"key", "associations", "indexes"}, None if the page has no entry,
+        associations and indexes are None for the pages aligned before the cache (see apply_align())
+    """
+    cache_file = align_cache_dir+os.sep+filename+".json"
+    try:
+        with open(cache_file, encoding='UTF-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_alignment_cache(filename: str, key: str, associations: list, indexes: list) -> None:
+    """
+    Save the alignment of a page, the file is replaced atomically
+
+    Parameters:
+        filename:
+            Name of the image file
+        key:
+            Hash of the inputs of the alignment (see alignment_cache_key())
+        associations:
+            List of [pattern, pattern_index, text_matched, score], None if unknown
+        indexes:
+            List of the index of each pattern in the transcription, None if unknown
+
+    Returns:
+        None
+    """
+    os.makedirs(align_cache_dir, exist_ok=True)
+    cache_file = align_cache_dir+os.sep+filename+".json"
+
+    # Numpy scalars are saved as python numbers
+    entry = {"key": key, "associations": associations, "indexes": indexes}
+    write_atomic(cache_file, json.dumps(entry, default=lambda o: o.item()))
+
+
+def ensure_overlay(filename: str, image_dir: str = "tmp"+os.sep+"extract_image") -> str:
+    """
+    Draw the segmented image of a page if it isn't already, using its cached alignment (see overlay.py)
+
+    Parameters:
+        filename:
+            Name of the image file
+        image_dir:
+            Directory where the image is located
+
+    Returns:
+        Path of the segmented image
+    """
+    path = overlay.overlay_path(filename)
+    if os.path.exists(path):
+        return path
+
+    # Lines used are the ones of the last alignment, whatever its inputs were
+    used = set()
+    entry = load_alignment_cache(filename)
+    if entry is not None and entry["associations"] is not None:
+        lst_alignments_usable, _ = get_usable_alignments(
+            entry["associations"], entry["indexes"])
+        used = {association[1] for association in lst_alignments_usable}
+    else:
+        logger.warning("No alignment found for "+filename +
+                       ", its segmented image has no line marked as used")
+
+    img = cv.imread(image_dir+os.sep+filename, cv.IMREAD_COLOR)
+    if img is None:
+        raise OSError("Could not read "+image_dir+os.sep+filename)
+    return overlay.save_overlay(img, filename, overlay.load_boundaries(filename), used)
+
+
+def apply_align_job(job: tuple) -> tuple:
+    """
+    Wrapper of apply_align() used by the process pool of batch_align_crop()
+
+    Parameters:
+        job:
+            Tuple (position, filename, filepath, total, printing, align_options, crop_options, overlay_mode)
+
+    Returns:
+        (aligned, hits, misses), aligned is 1 if the image was aligned else 0,
+        hits and misses are those of the alignment cache for this image
+    """
+    position, filename, filepath, total, printing, align_options, crop_options, overlay_mode = job
+    hits, misses = align_cache_stats["hit"], align_cache_stats["miss"]
+
+    # The pairs are written before returning, the pool may terminate its processes once every job returned
+    with CropWriter(**crop_options) as writer:
+        # The position is used as the count, apply_align() increments it only if the image was aligned
+        aligned = apply_align(position, filename, filepath, total,
+                              printing=printing, align_options=align_options, writer=writer,
+                              overlay_mode=overlay_mode)-position
+    return aligned, align_cache_stats["hit"]-hits, align_cache_stats["miss"]-misses
+
+
+def apply_align(count: int, filename: str, filepath: str, total: int, printing: bool = False, align_options: dict = None, writer: CropWriter = None, overlay_mode: str = "lazy") -> int:
     """
     Apply alignment to create pairs of text-images
 
@@ -478,26 +1003,59 @@ def apply_align(count: int, filename: str, filepath: str, total: int, printing:
             Total number of alignment (for statistic purpose)
         printing : 
             If True, logger will log in debug of each text-image alignment with their score
+        align_options:
+            Keyword arguments given to align_patterns()
+        writer:
+            CropWriter given to align_cropped()
+        overlay_mode:
+            When the segmented image is drawn, see align_cropped()
 
     Returns:
-        count + 1
+        count + 1 if the image was aligned or cropped again, else count
     """
+    if align_options is None:
+        align_options = {}
+    cropping_dir = "tmp"+os.sep+"cropped_match"+os.sep + filename
 
-    # Check if folder for cropped image is already present, if yes it means the file was already aligned
-    if os.path.exists("tmp"+os.sep+"cropped_match"+os.sep + filename):
-        return count
-
-    logger.info("Align " + filepath + " " + str(count)+"/"+str(total))
     # Fetch the manual transcription and the ocr
     try:
         txt_manual, txt_ocr = txt_compare_open(filename)
     except Exception as Argument:
+        if os.path.exists(cropping_dir):
+            # Already aligned, its inputs can't be checked
+            return count
         logger.warning("Error loading text for alignment : "+str(Argument))
         return count
 
-    # Align each pattern of the ocr to the transcription
-    associations, indexes = align_patterns(
-        txt_ocr, txt_manual, printing=printing)
+    # The alignment is reused while the ocr, the transcription and the parameters are unchanged
+    key = alignment_cache_key(txt_ocr, txt_manual, align_options)
+    entry = load_alignment_cache(filename)
+    if entry is None and os.path.exists(cropping_dir):
+        # Aligned before the cache existed, its pairs are adopted as made from the current inputs
+        align_cache_stats["hit"] += 1
+        save_alignment_cache(filename, key, None, None)
+        return count
+
+    if entry is not None and entry["key"] == key and (os.path.exists(cropping_dir) or entry["associations"] is not None):
+        align_cache_stats["hit"] += 1
+        # Check if folder for cropped image is already present, if yes it means the file was already aligned
+        if os.path.exists(cropping_dir):
+            return count
+        associations, indexes = entry["associations"], entry["indexes"]
+        logger.info("Crop " + filepath + " from cached alignment " +
+                    str(count)+"/"+str(total))
+    else:
+        align_cache_stats["miss"] += 1
+        logger.info("Align " + filepath + " " + str(count)+"/"+str(total))
+
+        # Align each pattern of the ocr to the transcription
+        associations, indexes = align_patterns(
+            txt_ocr, txt_manual, printing=printing, **align_options)
+        save_alignment_cache(filename, key, associations, indexes)
+
+        # Pairs made from outdated inputs are replaced
+        if entry is not None and entry["key"] != key and os.path.exists(cropping_dir):
+            shutil.rmtree(cropping_dir)
 
     # Does nothing as of now
     # When implemented will curate the alignments
@@ -505,7 +1063,8 @@ def apply_align(count: int, filename: str, filepath: str, total: int, printing:
         associations, indexes)
 
     # Crop and produce every pair of text-image
-    align_cropped(lst_alignments_usable, index_used,  filepath)
+    align_cropped(lst_alignments_usable, index_used,  filepath,
+                  writer=writer, overlay_mode=overlay_mode)
 
     count += 1
     logger.debug("Cropped a total of "+str(count)+" images")
@@ -514,6 +1073,34 @@ def apply_align(count: int, filename: str, filepath: str, total: int, printing:
 
 if __name__ == "__main__":
 
-    main_dir = "tmp/extract_image"
-
-    batch_align_crop(main_dir)
+    parser = argparse.ArgumentParser(
+        description="Align the ocr of images with their transcription and create pairs of text/image")
+    parser.add_argument("image_dir", nargs="?", default="tmp"+os.sep+"extract_image",
+                        help="Directory where images are located (default : tmp/extract_image)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes aligning images in parallel (default : 1)")
+    parser.add_argument("--mode", choices=["hamming", "semiglobal"], default="hamming",
+                        help="Alignment mode, see align_patterns() (default : hamming)")
+    parser.add_argument("--search", choices=["full", "monotone", "qgram"], default="full",
+                        help="Search of the alignment in the transcription, see align_patterns() (default : full)")
+    parser.add_argument("--crop-format", choices=crop_formats, default="jpg",
+                        help="Format of the cropped images (default : jpg)")
+    parser.add_argument("--crop-quality", type=int, default=-1,
+                        help="JPEG quality (0-100) or PNG compression (0-9) of the cropped images (default : OpenCV's)")
+    parser.add_argument("--grayscale", action="store_true",
+                        help="Write the cropped images in grayscale")
+    parser.add_argument("--masked", action="store_true",
+                        help="Fill the background outside of the boundary of each cropped line with white")
+    parser.add_argument("--overlay", choices=overlay_modes, default="lazy",
+                        help="When the segmented images of tmp/segmented/ are drawn, see align_cropped() (default : lazy)")
+    parser.add_argument("--crop-threads", type=int, default=4,
+                        help="Number of threads writing the cropped images of each process (default : 4)")
+    args = parser.parse_args()
+
+    logger = setup_logger()
+    batch_align_crop(args.image_dir, align_options={"mode": args.mode, "search": args.search},
+                     workers=args.workers,
+                     crop_options={"image_format": args.crop_format, "quality": args.crop_quality,
+                                   "grayscale": args.grayscale, "masked": args.masked,
+                                   "workers": args.crop_threads},
+                     overlay_mode=args.overlay)
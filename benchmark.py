@@ -0,0 +1,321 @@
+"""
+benchmark.py: Contains the benchmark of the steps of process_images.py (segmentation, recognition, serialization)
+over a fixed sample of images, for a matrix of settings, to choose the settings of the current machine
+
+Nothing is saved apart from the report, the models are the local ones (see model_registry.py)
+
+Usage : benchmark.py [image_dir] [--sample N] [--workers N ...] [--threads N ...] [--sizes full|PIXELS ...]
+                     [--model NAME] [--segmentation-model NAME] [--all] [--output PATH]
+"""
+
+from kraken import serialization
+from PIL import Image
+from multiprocessing import Pool, Barrier
+import numpy as np
+import os
+import time
+import json
+import resource
+import argparse
+import itertools
+from process_images import list_images, kraken_segment, recognize, init_ocr_worker
+from model_registry import get_recognition_model
+from checkpoint import write_atomic
+from monitoring import setup_logger
+import logging
+logger = logging.getLogger("TIA_logger")
+
+benchmark_path = "tmp"+os.sep+"save"+os.sep+"benchmark.json"
+
+# Steps measured for each page, in their order
+benchmark_stages = ("decode", "segmentation", "recognition", "serialization")
+
+# Option of main.py of each parameter of kraken_segment()
+segmentation_options = {"max_size": "--segmentation-size",
+                        "line_height": "--segmentation-line-height"}
+
+# A resolution mode whose line count differs more than this ratio from full resolution isn't recommended
+line_tolerance = 0.05
+
+
+# Seconds a process waits for the others to be started, see wait_workers()
+worker_timeout = 600
+
+# Barrier of the processes of the pool, see init_benchmark_worker()
+workers_barrier = None
+
+
+def memory_status(field: str) -> int:
+    """
+    Parameters :
+        field :
+            "VmRSS" for the current resident memory, "VmHWM" for its peak
+
+    Returns :
+        Resident memory of the current process, in MB
+        Without /proc (not Linux), the peak of the process over its whole life
+    """
+    try:
+        with open("/proc/self/status", encoding="UTF-8") as file:
+            for line in file:
+                if line.startswith(field+":"):
+                    return int(line.split()[1])//1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss//1024
+
+
+def reset_peak_rss() -> None:
+    """
+    Reset the peak resident memory of the current process to its current value (Linux), so that the peak of each step
+    is measured apart from the previous ones
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def init_benchmark_worker(barrier: Barrier, recognition_model: str, segmentation_model: str, threads: int) -> None:
+    """
+    Initializer of the processes of run_config(), see process_images.init_ocr_worker()
+    """
+    global workers_barrier
+    workers_barrier = barrier
+    init_ocr_worker(recognition_model, segmentation_model, threads)
+
+
+def wait_workers(_) -> int:
+    """
+    Job returning once a job runs in every process of the pool, each one blocks its process so that no process
+    runs two of them : every process is started and its models loaded before the timer
+
+    Returns :
+        (pid, peak memory of the process in MB, models included)
+    """
+    workers_barrier.wait(worker_timeout)
+    return os.getpid(), memory_status("VmHWM")
+
+
+def measure_stage(step, *args, **kwargs) -> tuple:
+    """
+    Parameters :
+        step :
+            Function of the step, called with args and kwargs
+
+    Returns :
+        (result of step, {"seconds", "rss", "rss_delta"}), rss being the peak memory of the process during the step
+        and rss_delta the memory it kept at its end, in MB
+    """
+    reset_peak_rss()
+    before = memory_status("VmRSS")
+    start = time.time()
+    result = step(*args, **kwargs)
+    seconds = time.time()-start
+    return result, {"seconds": seconds, "rss": memory_status("VmHWM"), "rss_delta": memory_status("VmRSS")-before}
+
+
+def benchmark_page(job: tuple) -> dict:
+    """
+    Run every step on a page, in memory, the models being loaded by init_benchmark_worker()
+
+    Parameters :
+        job :
+            Tuple (filepath, recognition_model, segmentation_model, segmentation_params)
+
+    Returns :
+        {"pid", "lines", "stages": {stage: {"seconds", "rss", "rss_delta"}}}, see measure_stage()
+    """
+    filepath, recognition_model, segmentation_model, segmentation_params = job
+    stages = {}
+
+    def decode():
+        im = Image.open(filepath)
+        im.load()
+        return im
+
+    im, stages["decode"] = measure_stage(decode)
+    with im:
+        segmentation, stages["segmentation"] = measure_stage(
+            kraken_segment, im, segmentation_model, **segmentation_params)
+        predictions, stages["recognition"] = measure_stage(
+            recognize, get_recognition_model(recognition_model), im, segmentation)
+        _, stages["serialization"] = measure_stage(
+            serialization.serialize, predictions, image_name=filepath.split(os.sep)[-1],
+            image_size=im.size, template="alto")
+    return {"pid": os.getpid(), "lines": len(segmentation["lines"]), "stages": stages}
+
+
+def run_config(filepaths: list, config: dict, recognition_model: str = None, segmentation_model: str = None) -> dict:
+    """
+    Process the sample with a setting, in a new process pool
+
+    Parameters :
+        filepaths :
+            Paths to the images of the sample
+        config :
+            {"workers", "threads", "mode", "segmentation_params"}, see process_images.process_images()
+        recognition_model :
+            Name or path of the recognition model, see model_registry.py
+        segmentation_model :
+            Name or path of the segmentation model, see model_registry.py
+
+    Returns :
+        The result of the setting : config with {"pages_per_second", "seconds", "lines", "workers_rss_mb",
+        "children_max_rss_mb", "stages": {stage: {"p50", "p95", "total", "peak_rss_mb", "mean_rss_delta_mb"}}},
+        workers_rss_mb being the sum of the peak memory of each process, models included, and children_max_rss_mb
+        the largest peak counted by the kernel for the processes of the pools run until now (RUSAGE_CHILDREN),
+        covering only the last step of each process when measure_stage() can reset the peaks
+    """
+    jobs = [(filepath, recognition_model, segmentation_model, config["segmentation_params"])
+            for filepath in filepaths]
+
+    # Models are loaded by the initializer, before the timer
+    barrier = Barrier(config["workers"])
+    with Pool(config["workers"], initializer=init_benchmark_worker,
+              initargs=(barrier, recognition_model, segmentation_model, config["threads"])) as pool:
+        workers_rss = dict(pool.map(wait_workers, range(config["workers"]), chunksize=1))
+        start = time.time()
+        pages = pool.map(benchmark_page, jobs, chunksize=1)
+        seconds = time.time()-start
+        pool.close()
+        pool.join()
+
+    # Peak of each process over its pages, the processes run at the same time
+    for page in pages:
+        workers_rss[page["pid"]] = max(workers_rss.get(page["pid"], 0),
+                                       max(stage["rss"] for stage in page["stages"].values()))
+
+    result = dict(config)
+    result.update({"seconds": seconds, "pages_per_second": len(pages)/seconds,
+                   "lines": sum(page["lines"] for page in pages),
+                   "workers_rss_mb": sum(workers_rss.values()),
+                   "children_max_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss//1024,
+                   "stages": {}})
+    for stage in benchmark_stages:
+        durations = np.array([page["stages"][stage]["seconds"]
+                             for page in pages])
+        result["stages"][stage] = {"p50": float(np.percentile(durations, 50)),
+                                   "p95": float(np.percentile(durations, 95)),
+                                   "total": float(durations.sum()),
+                                   "peak_rss_mb": max(page["stages"][stage]["rss"] for page in pages),
+                                   "mean_rss_delta_mb": float(np.mean([page["stages"][stage]["rss_delta"] for page in pages]))}
+    logger.info("workers %d, threads %d, %s : %.2f pages/sec, %d lines, %d MB, " % (config["workers"], config["threads"], config["mode"],
+                                                                                 result["pages_per_second"], result["lines"],
+                                                                                 result["workers_rss_mb"]) +
+                ", ".join("%s p50 %.2f p95 %.2f sec" % (stage, stats["p50"], stats["p95"]) for stage, stats in result["stages"].items()))
+    return result
+
+
+def recommend(results: list) -> dict:
+    """
+    Choose the fastest setting among the ones whose segmentation finds as many lines as at full resolution
+
+    Parameters :
+        results :
+            Results of run_config()
+
+    Returns :
+        The result recommended
+    """
+    full = [result["lines"] for result in results if result["mode"] == "full"]
+    reference = full[0] if full else None
+    valid = [result for result in results
+             if reference is None or abs(result["lines"]-reference) <= line_tolerance*max(1, reference)]
+    return max(valid or results, key=lambda result: result["pages_per_second"])
+
+
+def benchmark(main_dir: str, sample: int = 5, workers: list = (1,), threads: list = None, modes: dict = None,
+              recognition_model: str = None, segmentation_model: str = None, oversubscribe: bool = False,
+              output: str = benchmark_path) -> dict:
+    """
+    Benchmark the processing of a fixed sample of images for every combination of settings
+
+    Parameters :
+        main_dir :
+            Directory in which images are located
+        sample :
+            Number of images, the first ones in alphabetical order (By default : 5)
+        workers :
+            Numbers of processes tested (By default : (1,))
+        threads :
+            Numbers of torch threads per process tested (By default : None, the cpus divided between the processes)
+        modes :
+            Dictionnary associating the name of a resolution mode -> parameters of kraken_segment()
+            (By default : None, only {"full": {}})
+        recognition_model :
+            Name or path of the recognition model, see model_registry.py
+        segmentation_model :
+            Name or path of the segmentation model, see model_registry.py
+        oversubscribe :
+            If True, settings with more threads than cpus are also tested
+        output :
+            Path to the json report
+
+    Returns :
+        The report : {"cpus", "sample", "results": [see run_config()], "recommended"}
+    """
+    cpus = os.cpu_count() or 1
+    filepaths = sorted(list_images(main_dir))[:sample]
+    if not filepaths:
+        raise FileNotFoundError("No image found in "+main_dir)
+    modes = modes or {"full": {}}
+
+    configs = []
+    for worker_count, (mode, params) in itertools.product(workers, modes.items()):
+        for thread_count in (threads or [max(1, cpus//worker_count)]):
+            if not oversubscribe and worker_count*thread_count > cpus:
+                logger.info("Skipped %d workers x %d threads, more than the %d cpus" %
+                            (worker_count, thread_count, cpus))
+                continue
+            configs.append({"workers": worker_count, "threads": thread_count,
+                            "mode": mode, "segmentation_params": params})
+
+    results = [run_config(filepaths, config, recognition_model, segmentation_model)
+               for config in configs]
+    report = {"cpus": cpus, "sample": [filepath.split(os.sep)[-1] for filepath in filepaths],
+              "results": results, "recommended": recommend(results) if results else None}
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    write_atomic(output, json.dumps(report, indent=4))
+    if report["recommended"] is not None:
+        best = report["recommended"]
+        logger.info("Recommended : --ocr-workers %d --ocr-threads %d %s(%.2f pages/sec)" %
+                    (best["workers"], best["threads"],
+                     "".join(segmentation_options[key]+" "+str(value)+" "
+                             for key, value in best["segmentation_params"].items()),
+                     best["pages_per_second"]))
+    logger.info("Saved the benchmark into "+output)
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark segmentation, recognition and serialization for several settings and recommend the fastest")
+    parser.add_argument("image_dir", nargs="?", default="tmp"+os.sep+"extract_image",
+                        help="Directory where images are located (default : tmp/extract_image)")
+    parser.add_argument("--sample", type=int, default=5,
+                        help="Number of images processed for each setting (default : 5)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1],
+                        help="Numbers of processes tested (default : 1)")
+    parser.add_argument("--threads", type=int, nargs="+", default=None,
+                        help="Numbers of torch threads per process tested (default : cpus divided by the processes)")
+    parser.add_argument("--sizes", nargs="+", default=["full"],
+                        help="Resolution modes tested, full or the largest side of the images segmented (default : full)")
+    parser.add_argument("--model", default=None,
+                        help="Name (in models/) or path of the recognition model (default : HTR-United-Manu_McFrench)")
+    parser.add_argument("--segmentation-model", default=None,
+                        help="Name (in models/) or path of the segmentation model (default : kraken's blla model)")
+    parser.add_argument("--all", action="store_true",
+                        help="Also test settings with more threads than cpus")
+    parser.add_argument("--output", default=benchmark_path,
+                        help="Path to the json report (default : tmp/save/benchmark.json)")
+    args = parser.parse_args()
+
+    logger = setup_logger()
+    modes = {size if size == "full" else "size_"+size: {} if size == "full" else {"max_size": int(size)}
+             for size in args.sizes}
+    benchmark(args.image_dir, args.sample, args.workers, args.threads, modes,
+              args.model, args.segmentation_model, args.all, args.output)
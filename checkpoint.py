@@ -0,0 +1,322 @@
+"""
+checkpoint.py: Contains the writing of checkpoints, files replaced atomically,
+and the Journal of the items completed by each step of the processing
+
+Usage : checkpoint.py [stage]
+        Verify the checksums of every item of the journal (of stage), the corrupt items are removed from the journal
+"""
+
+import hashlib
+import json
+import os
+import sys
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger("TIA_logger")
+
+# Suffix of the files and folders being written
+unfinished_suffix = ".part"
+
+journal_path = "tmp"+os.sep+"save"+os.sep+"journal.sqlite"
+
+
+def write_atomic(path: str, content, binary: bool = False) -> None:
+    """
+    Write a file through a temporary file renamed once complete and flushed to disk,
+    a save is then either complete or absent, even if the process is killed while writing
+
+    Parameters:
+        path :
+            Path to the file
+        content :
+            Text (or bytes if binary) to write
+        binary :
+            If True, content is written as bytes
+
+    Returns:
+        None
+    """
+    tmp_path = path+unfinished_suffix
+    if binary:
+        with open(tmp_path, 'wb') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+    else:
+        with open(tmp_path, 'w', encoding='UTF-8', errors="ignore") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_json_atomic(path: str, data, **kwargs) -> None:
+    """
+    Write a json file atomically, see write_atomic()
+
+    Parameters:
+        path :
+            Path to the file
+        data :
+            Object serialized
+        kwargs :
+            Arguments of json.dumps() (i.e. indent)
+
+    Returns:
+        None
+    """
+    write_atomic(path, json.dumps(data, **kwargs))
+
+
+def load_json(path: str, default=None):
+    """
+    Read a json checkpoint, a missing or corrupt file (i.e. truncated by a crash before the atomic writes) gives default
+
+    Parameters:
+        path :
+            Path to the file
+        default :
+            Value returned if the file can't be read
+
+    Returns:
+        The object read, or default
+    """
+    try:
+        with open(path, 'r', encoding='UTF-8', errors="ignore") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as error:
+        logger.warning("Ignored the corrupt checkpoint "+path+" : "+str(error))
+        return default
+
+
+def file_checksum(path: str) -> str:
+    """
+    Parameters:
+        path :
+            Path to the file
+
+    Returns:
+        The hexadecimal sha256 of the content of the file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ThreadConnections:
+    """
+    Connections to a SQLite file, one per thread and per process, opened on first use
+    The file can then be read and written by several processes and threads
+
+    Attributes:
+        path :
+            Path to the SQLite file
+        tables :
+            CREATE TABLE IF NOT EXISTS statements run when a connection is opened
+    """
+
+    def __init__(self, path: str, tables: list) -> None:
+        self.path = path
+        self.tables = tables
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        """
+        Returns:
+            The connection of the current thread, opened on first use
+        """
+        # A forked process doesn't reuse the connection of its parent
+        if getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # A process waits for the lock of another one instead of failing
+            connection = sqlite3.connect(self.path, timeout=60)
+            connection.execute("PRAGMA journal_mode=WAL")
+            for table in self.tables:
+                connection.execute(table)
+            connection.commit()
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def close(self) -> None:
+        """
+        Close the connection of the current thread
+
+        Returns:
+            None
+        """
+        if getattr(self._local, "pid", None) == os.getpid():
+            self._local.connection.close()
+        self._local.pid = None
+
+
+class Journal:
+    """
+    Items completed by each step (stage) of the processing, with the checksum of the files they produced
+    Finding if an item is done is a single query instead of a scan of the output folders,
+    an item whose files were modified, truncated or removed is no longer done and is processed again
+
+    Attributes:
+        path :
+            Path to the SQLite file of the journal
+    """
+
+    def __init__(self, path: str = journal_path) -> None:
+        self.path = path
+        self._connections = ThreadConnections(path, ["""CREATE TABLE IF NOT EXISTS journal (
+            stage TEXT, item TEXT, artifacts TEXT, PRIMARY KEY (stage, item))"""])
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Returns:
+            The connection of the current thread, see ThreadConnections
+        """
+        return self._connections.get()
+
+    def record(self, stage: str, item: str, paths: list) -> None:
+        """
+        Mark an item as done, once its files are written
+
+        Parameters:
+            stage :
+                Name of the step
+            item :
+                Name of the item (i.e. an image filename)
+            paths :
+                Paths to the files produced for the item
+
+        Returns:
+            None
+        """
+        artifacts = []
+        for path in paths:
+            stat = os.stat(path)
+            artifacts.append([path, stat.st_size, stat.st_mtime_ns,
+                              file_checksum(path)])
+        connection = self._connect()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO journal VALUES (?, ?, ?)",
+                               (stage, item, json.dumps(artifacts)))
+
+    def discard(self, stage: str, item: str) -> None:
+        """
+        Mark an item as not done
+
+        Parameters:
+            stage :
+                Name of the step
+            item :
+                Name of the item
+
+        Returns:
+            None
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "DELETE FROM journal WHERE stage = ? AND item = ?", (stage, item))
+
+    def _verify(self, stage: str, item: str, artifacts: list, full: bool = False) -> bool:
+        """
+        Check the files of an item, a file whose size and modification time are unchanged is trusted
+        unless full is True, otherwise its checksum is compared
+
+        Returns:
+            True if every file is intact, else the item is discarded and False returned
+        """
+        updated = False
+        for artifact in artifacts:
+            path, size, mtime, checksum = artifact
+            try:
+                stat = os.stat(path)
+            except OSError:
+                logger.warning("Missing "+path+", "+item +
+                               " will be processed again by "+stage)
+                self.discard(stage, item)
+                return False
+            if not full and stat.st_size == size and stat.st_mtime_ns == mtime:
+                continue
+            if stat.st_size != size or file_checksum(path) != checksum:
+                logger.warning("Corrupt "+path+", "+item +
+                               " will be processed again by "+stage)
+                self.discard(stage, item)
+                return False
+            # Same content, only touched
+            artifact[1], artifact[2] = stat.st_size, stat.st_mtime_ns
+            updated = True
+
+        if updated:
+            connection = self._connect()
+            with connection:
+                connection.execute("UPDATE journal SET artifacts = ? WHERE stage = ? AND item = ?",
+                                   (json.dumps(artifacts), stage, item))
+        return True
+
+    def is_done(self, stage: str, item: str) -> bool:
+        """
+        Parameters:
+            stage :
+                Name of the step
+            item :
+                Name of the item
+
+        Returns:
+            True if the item was done by the step and its files are intact
+        """
+        row = self._connect().execute(
+            "SELECT artifacts FROM journal WHERE stage = ? AND item = ?", (stage, item)).fetchone()
+        return row is not None and self._verify(stage, item, json.loads(row[0]))
+
+    def items(self, stage: str) -> list:
+        """
+        Parameters:
+            stage :
+                Name of the step
+
+        Returns:
+            List of the items recorded as done by the step, their files aren't verified
+        """
+        return [row[0] for row in self._connect().execute(
+            "SELECT item FROM journal WHERE stage = ? ORDER BY item", (stage,))]
+
+    def verify_all(self, stage: str = None) -> int:
+        """
+        Compare the checksum of every file of the journal, the corrupt items are discarded
+
+        Parameters:
+            stage :
+                Name of the step (By default : None, every step)
+
+        Returns:
+            Number of items discarded
+        """
+        query = "SELECT stage, item, artifacts FROM journal"
+        rows = self._connect().execute(query, ()).fetchall() if stage is None else \
+            self._connect().execute(query+" WHERE stage = ?", (stage,)).fetchall()
+        return sum(not self._verify(row_stage, item, json.loads(artifacts), full=True)
+                   for row_stage, item, artifacts in rows)
+
+    def close(self) -> None:
+        """
+        Close the connection of the current thread
+
+        Returns:
+            None
+        """
+        self._connections.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print(__doc__)
+        sys.exit()
+    from monitoring import setup_logger
+    setup_logger()
+    stage = sys.argv[1] if len(sys.argv) == 2 else None
+    logger.info("Discarded "+str(Journal().verify_all(stage)) +
+                " corrupt items of the journal")
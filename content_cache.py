@@ -0,0 +1,209 @@
+"""
+content_cache.py: Contains the ContentCache, saving segmentation and ocr results by the content of their inputs
+(image, models and parameters) instead of by filename
+"""
+
+import hashlib
+import os
+import sqlite3
+import ujson
+from segment_store import SegmentStore
+from checkpoint import file_checksum, ThreadConnections
+import logging
+logger = logging.getLogger("TIA_logger")
+
+content_cache_path = "tmp"+os.sep+"save"+os.sep+"content_cache.sqlite"
+segment_cache_path = "tmp"+os.sep+"save"+os.sep+"segment_cache.sqlite"
+ocr_cache_dir = "tmp"+os.sep+"save"+os.sep+"ocr_cache"
+
+
+def combine_key(*parts) -> str:
+    """
+    Parameters:
+        parts :
+            Values serializable in json
+
+    Returns:
+        The hexadecimal sha256 of the parts
+    """
+    return hashlib.sha256(ujson.dumps(parts, sort_keys=True).encode("UTF-8")).hexdigest()
+
+
+def segmentation_key(image_hash: str, model_hash: str, params: dict = None) -> str:
+    """
+    Parameters:
+        image_hash :
+            Hash of the content of the image
+        model_hash :
+            Hash of the segmentation model
+        params :
+            Parameters of the segmentation
+
+    Returns:
+        The key of the segmentation of the image
+    """
+    return combine_key("segmentation", image_hash, model_hash, params or {})
+
+
+def recognition_key(segmentation_key: str, model_hash: str, params: dict = None) -> str:
+    """
+    Parameters:
+        segmentation_key :
+            Key of the segmentation the recognition is applied on, see segmentation_key()
+        model_hash :
+            Hash of the recognition model
+        params :
+            Parameters of the recognition
+
+    Returns:
+        The key of the recognition of the image
+    """
+    return combine_key("recognition", segmentation_key, model_hash, params or {})
+
+
+class ContentCache:
+    """
+    Results of segmentation and ocr keyed by the content of their inputs,
+    so that a rescanned image or a new model is processed again and duplicate images are processed once
+
+    Hashes of files are cached on their size and modification time, a file is only read again when it changes
+
+    Attributes:
+        path :
+            Path to the SQLite file of the hashes and of the keys of each page
+        segmentations :
+            SegmentStore of the segmentations, keyed by segmentation_key()
+        ocr_dir :
+            Folder of the ocr predictions (see ocr_store.py), named by recognition_key()
+    """
+
+    def __init__(self, path: str = content_cache_path, segment_path: str = segment_cache_path, ocr_dir: str = ocr_cache_dir) -> None:
+        self.path = path
+        self.segmentations = SegmentStore(segment_path, json_dir=None)
+        self.ocr_dir = ocr_dir
+        self._connections = ThreadConnections(path, [
+            """CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)""",
+            """CREATE TABLE IF NOT EXISTS pages (
+                image TEXT PRIMARY KEY, segmentation_key TEXT, recognition_key TEXT)"""])
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Returns:
+            The connection of the current thread, see checkpoint.ThreadConnections
+        """
+        return self._connections.get()
+
+    def file_hash(self, path: str) -> str:
+        """
+        Hash of the content of a file, only computed again if its size or modification time changed
+
+        Parameters:
+            path :
+                Path to the file
+
+        Returns:
+            The hexadecimal sha256 of the content of the file
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        connection = self._connect()
+        row = connection.execute(
+            "SELECT size, mtime, digest FROM hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        digest = file_checksum(path)
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                               (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    def page_keys(self, image: str):
+        """
+        Parameters:
+            image :
+                Image filename
+
+        Returns:
+            (segmentation_key, recognition_key) of the results saved for the image, or None
+        """
+        row = self._connect().execute(
+            "SELECT segmentation_key, recognition_key FROM pages WHERE image = ?", (image,)).fetchone()
+        return None if row is None else tuple(row)
+
+    def set_page_keys(self, image: str, segmentation_key: str, recognition_key: str) -> None:
+        """
+        Record the keys of the results saved for an image
+
+        Parameters:
+            image :
+                Image filename
+            segmentation_key :
+                Key of its segmentation
+            recognition_key :
+                Key of its recognition
+
+        Returns:
+            None
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)",
+                               (image, segmentation_key, recognition_key))
+
+    def get_segmentation(self, key: str):
+        """
+        Parameters:
+            key :
+                Key of the segmentation, see segmentation_key()
+
+        Returns:
+            The segmentation, or None if it isn't cached
+        """
+        return self.segmentations.get(key)
+
+    def put_segmentation(self, key: str, segmentation: dict) -> None:
+        """
+        Parameters:
+            key :
+                Key of the segmentation, see segmentation_key()
+            segmentation :
+                Dictionnary produced by kraken.blla.segment()
+
+        Returns:
+            None
+        """
+        self.segmentations.put(key, segmentation)
+
+    def ocr_path(self, key: str) -> str:
+        """
+        Parameters:
+            key :
+                Key of the recognition, see recognition_key()
+
+        Returns:
+            Path to the cached prediction
+        """
+        return self.ocr_dir+os.sep+key+".npz"
+
+    def has_ocr(self, key: str) -> bool:
+        """
+        Parameters:
+            key :
+                Key of the recognition, see recognition_key()
+
+        Returns:
+            True if the prediction is cached
+        """
+        return os.path.isfile(self.ocr_path(key))
+
+    def close(self) -> None:
+        """
+        Close the connections of the current thread
+
+        Returns:
+            None
+        """
+        self._connections.close()
+        self.segmentations.close()
@@ -0,0 +1,238 @@
+"""
+crop_writer.py: Contains the CropWriter, encoding and writing the pairs text-image in background threads
+"""
+
+import cv2 as cv
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from line_geometry import mask_polygon
+import logging
+logger = logging.getLogger("TIA_logger")
+
+# Formats of the cropped images, kraken/ketos accept both
+crop_formats = ("jpg", "png")
+
+
+class CropWriter:
+    """
+    Write the pairs text-image of pages with a bounded pool of threads (OpenCV encoding releases the GIL),
+    so that alignment of the next page overlaps with encoding and disk I/O of the previous one
+
+    Every pair of a page is written in a temporary folder, renamed into the final folder
+    once all of them are written (see finish_page())
+
+    Attributes:
+        image_format :
+            Extension of the cropped images, "jpg" or "png"
+        quality :
+            JPEG quality (0-100) or PNG compression level (0-9)
+        grayscale :
+            If True, images are converted to grayscale before being encoded
+        masked :
+            If True, the background outside of the boundary of a line is filled with white
+    """
+
+    def __init__(self, workers: int = 4, image_format: str = "jpg", quality: int = -1, grayscale: bool = False, masked: bool = False, max_pending: int = 64) -> None:
+        """
+        Parameters:
+            workers :
+                Number of threads encoding and writing the files
+            image_format :
+                Extension of the cropped images, "jpg" or "png"
+            quality :
+                JPEG quality (0-100) or PNG compression level (0-9)
+                (By default : -1, OpenCV's default is used)
+            grayscale :
+                If True, images are converted to grayscale before being encoded
+            masked :
+                If True, the background outside of the boundary of a line is filled with white
+                (see line_geometry.mask_polygon()), the crops are smaller on disk
+            max_pending :
+                Number of jobs waiting to be written before submitting a new one blocks
+        """
+        if image_format not in crop_formats:
+            raise ValueError("Unknown crop format : "+str(image_format))
+        self.image_format = image_format
+        self.quality = quality
+        self.grayscale = grayscale
+        self.masked = masked
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def _encoding_params(self) -> list:
+        """
+        Returns:
+            The parameters given to cv.imwrite() for the chosen format and quality
+        """
+        if self.quality < 0:
+            return []
+        if self.image_format == "png":
+            return [cv.IMWRITE_PNG_COMPRESSION, self.quality]
+        return [cv.IMWRITE_JPEG_QUALITY, self.quality]
+
+    def _write_image(self, image_path: str, image, convert: bool) -> None:
+        """
+        Encode and write an image, run in a thread
+        """
+        if convert and self.grayscale and image.ndim == 3:
+            image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+        if not cv.imwrite(image_path, image, self._encoding_params()):
+            raise OSError("Could not write "+image_path)
+
+    def _write_pair(self, path: str, image, text: str, polygon, origin) -> None:
+        """
+        Write a pair text-image, run in a thread
+        """
+        if self.masked and polygon is not None:
+            image = mask_polygon(image, polygon, origin)
+        self._write_image(path+"."+self.image_format, image, True)
+        with open(path+'.gt.txt', 'w', encoding='UTF-8', errors="ignore") as f:
+            f.write(text)
+
+    def _submit(self, page: str, function, *args) -> None:
+        """
+        Submit a job, blocking while too many jobs are waiting
+        """
+        self._slots.acquire()
+        if page is not None:
+            with self._lock:
+                self._pages[page]["pending"] += 1
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(
+            lambda future: self._job_done(page, future))
+
+    def _job_done(self, page: str, future) -> None:
+        """
+        Called once a job is finished, finalize its page if it was the last one
+        """
+        self._slots.release()
+        error = future.exception()
+        if error is not None:
+            logger.warning("Error writing cropping of " +
+                           str(page)+" : "+str(error))
+        if page is None:
+            return
+        with self._lock:
+            state = self._pages[page]
+            state["pending"] -= 1
+            state["failed"] = state["failed"] or error is not None
+            ready = state["finished"] and state["pending"] == 0
+            if ready:
+                del self._pages[page]
+        if ready:
+            self._finalize(page, state)
+
+    def _finalize(self, page: str, state: dict) -> None:
+        """
+        Rename the temporary folder of a page into its final folder, or remove it if a pair couldn't be written
+        """
+        if state["failed"]:
+            shutil.rmtree(page, ignore_errors=True)
+            return
+        try:
+            os.rename(page, state["final_dir"])
+        except OSError:
+            # Another process already finished this file
+            shutil.rmtree(page, ignore_errors=True)
+
+    def start_page(self, tmp_dir: str, final_dir: str) -> None:
+        """
+        Prepare the temporary folder of a page
+
+        Parameters:
+            tmp_dir :
+                Folder where pairs are written
+            final_dir :
+                Name of the folder once every pair is written
+
+        Returns:
+            None
+        """
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        with self._lock:
+            self._pages[tmp_dir] = {"final_dir": final_dir,
+                                    "pending": 0, "finished": False, "failed": False}
+
+    def write_pair(self, tmp_dir: str, name: str, image, text: str, polygon=None, origin=None) -> None:
+        """
+        Queue a pair text-image of a page started with start_page()
+
+        Parameters:
+            tmp_dir :
+                Temporary folder of the page
+            name :
+                Name of the files without extension
+            image :
+                The cropped image, it must not be modified afterwards
+            text :
+                The text aligned
+            polygon :
+                Boundary of the line, used when masked (By default : None, the image is never masked)
+            origin :
+                [x_min, y_min] of the cropped image in the full image
+
+        Returns:
+            None
+        """
+        self._submit(tmp_dir, self._write_pair,
+                     tmp_dir+os.sep+name, image, text, polygon, origin)
+
+    def write_image(self, image_path: str, image) -> None:
+        """
+        Queue an image outside of any page, written as it is (i.e. the segmented image)
+
+        Parameters:
+            image_path :
+                Path of the image, its extension gives its format
+            image :
+                The image, it must not be modified afterwards
+
+        Returns:
+            None
+        """
+        self._submit(None, cv.imwrite, image_path, image)
+
+    def finish_page(self, tmp_dir: str) -> None:
+        """
+        Mark every pair of a page as queued, its folder is renamed once they are all written
+
+        Parameters:
+            tmp_dir :
+                Temporary folder of the page
+
+        Returns:
+            None
+        """
+        with self._lock:
+            state = self._pages[tmp_dir]
+            state["finished"] = True
+            ready = state["pending"] == 0
+            if ready:
+                del self._pages[tmp_dir]
+        if ready:
+            self._finalize(tmp_dir, state)
+
+    def close(self) -> None:
+        """
+        Wait for every queued job, pages not finished are left in their temporary folder
+
+        Returns:
+            None
+        """
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,256 @@
+"""
+distance.py: Contains functions for computing edit distances between strings or lists of words
+"""
+
+from collections import Counter
+
+
+def length_lower_bound(s1, s2) -> int:
+    """
+    Cheap lower bound of the Levenshtein distance, using the difference of length
+
+    Parameters :
+        s1 :
+            First string (or list of words)
+        s2 :
+            Second string (or list of words)
+
+    Returns :
+        A value that is never greater than the Levenshtein distance of s1 and s2
+    """
+    return abs(len(s1)-len(s2))
+
+
+def histogram_lower_bound(s1, s2) -> int:
+    """
+    Lower bound of the Levenshtein distance, using the difference of the characters (or words) histograms
+    Each edit operation can only fix one surplus of a character on each side
+
+    Parameters :
+        s1 :
+            First string (or list of words)
+        s2 :
+            Second string (or list of words)
+
+    Returns :
+        A value that is never greater than the Levenshtein distance of s1 and s2
+    """
+    histogram1, histogram2 = Counter(s1), Counter(s2)
+    surplus = sum((histogram1-histogram2).values())
+    deficit = sum((histogram2-histogram1).values())
+    return max(surplus, deficit)
+
+
+def levenshtein_matrix(s1, s2) -> list:
+    """
+    Compute the full matrix of the Levenshtein Distance, only needed for a traceback
+    Algorithm from : https://fr.wikipedia.org/wiki/Distance_de_Levenshtein
+
+    Parameters :
+        s1 :
+            First string (or list of words)
+        s2 :
+            Second string (or list of words)
+
+    Returns :
+        The (len(s1)+1)x(len(s2)+1) matrix, the distance is in the bottom-right cell
+    """
+    m, n = len(s1)+1, len(s2)+1
+
+    # Init all values of matrix with zeros
+    d = [[0]*(n) for i in range(m)]
+
+    for i in range(m):
+        d[i][0] = i
+    for j in range(n):
+        d[0][j] = j
+
+    for j in range(1, n):
+        for i in range(1, m):
+            cost = 0 if s1[i-1] == s2[j-1] else 1
+            d[i][j] = min(
+                d[i-1][j]+1,  # deletion of the new character of s1
+                d[i][j-1]+1,  # insertion in s2 of the new character of s1
+                d[i-1][j-1]+cost)  # substitution
+    return d
+
+
+def two_row_distance(s1, s2, max_dist: int = -1) -> int:
+    """
+    Compute the Levenshtein Distance keeping only two rows of the matrix
+    Used for lists of words, where the bit-parallel version can't be applied
+
+    Parameters :
+        s1 :
+            First string (or list of words)
+        s2 :
+            Second string (or list of words)
+        max_dist :
+            Stop as soon as the distance is known to be greater than max_dist
+            (By default : -1, negative value will compute the exact distance)
+
+    Returns :
+        The Levenshtein distance of s1 and s2, or max_dist+1 if it is greater than max_dist
+    """
+    # Rows are kept the size of the shortest sequence
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+
+    previous = list(range(len(s2)+1))
+    for i in range(1, len(s1)+1):
+        current = [i]+[0]*len(s2)
+        for j in range(1, len(s2)+1):
+            cost = 0 if s1[i-1] == s2[j-1] else 1
+            current[j] = min(
+                previous[j]+1,  # deletion
+                current[j-1]+1,  # insertion
+                previous[j-1]+cost)  # substitution
+
+        # The minimum of a row never decreases on the next rows
+        if max_dist >= 0 and min(current) > max_dist:
+            return max_dist+1
+        previous = current
+
+    if max_dist >= 0 and previous[-1] > max_dist:
+        return max_dist+1
+    return previous[-1]
+
+
+def myers_columns(pattern: str, text: str, free_start: bool = False):
+    """
+    Generator of the last row of the Levenshtein matrix of pattern against text, column by column
+    It uses the bit-parallel algorithm of Myers (1999) in the formulation of Hyyrö (2001),
+    a column of the matrix is encoded in the bits of python integers
+
+    Parameters :
+        pattern :
+            String encoded as bits, it must not be empty
+        text :
+            String iterated on
+        free_start :
+            If True, the alignment can start anywhere in text (semi-global alignment),
+            else it has to start at the beginning of text
+
+    Returns :
+        For each character of text, the edit distance of pattern with the best substring ending on this character
+        (a prefix of text if free_start is False)
+    """
+    peq = {}
+    for i, c in enumerate(pattern):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << len(pattern))-1
+    last_bit = 1 << (len(pattern)-1)
+    carry = 0 if free_start else 1
+    pv, mv = mask, 0
+    score = len(pattern)
+
+    for c in text:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv)+pv) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & mask
+        mh = pv & xh
+
+        if ph & last_bit:
+            score += 1
+        elif mh & last_bit:
+            score -= 1
+        yield score
+
+        # The first row is all zeros in a semi-global alignment, no carry is then needed
+        ph = ((ph << 1) | carry) & mask
+        mh = (mh << 1) & mask
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+
+
+def myers_distance(s1: str, s2: str, max_dist: int = -1) -> int:
+    """
+    Compute the Levenshtein Distance of 2 strings with the bit-parallel algorithm (see myers_columns())
+
+    Parameters :
+        s1 :
+            First string
+        s2 :
+            Second string
+        max_dist :
+            Stop as soon as the distance is known to be greater than max_dist
+            (By default : -1, negative value will compute the exact distance)
+
+    Returns :
+        The Levenshtein distance of s1 and s2, or max_dist+1 if it is greater than max_dist
+    """
+    # The shortest string is encoded as bits, the longest one is iterated on
+    if len(s1) > len(s2):
+        s1, s2 = s2, s1
+    m, n = len(s1), len(s2)
+    if m == 0:
+        return n if max_dist < 0 or n <= max_dist else max_dist+1
+
+    score = m
+    for j, score in enumerate(myers_columns(s1, s2)):
+        # The distance can decrease by at most one for each remaining character of s2
+        if max_dist >= 0 and score-(n-j-1) > max_dist:
+            return max_dist+1
+    return score
+
+
+def semi_global_align(pattern: str, text: str) -> tuple:
+    """
+    Find the substring of text with the smallest edit distance to pattern (free start and end in text)
+    The end is found with a forward semi-global pass, the start with a backward pass anchored on this end
+
+    Parameters :
+        pattern :
+            String to locate
+        text :
+            String in which pattern is located
+
+    Returns :
+        The start index, the end index (excluded) of the best substring and its edit distance
+    """
+    if not pattern or not text:
+        return 0, 0, len(pattern)
+
+    # Best end, the first one is kept in case of equality
+    dist, end = len(pattern), 0
+    for j, score in enumerate(myers_columns(pattern, text, free_start=True)):
+        if score < dist:
+            dist, end = score, j+1
+
+    # Best start, the span length closest to the pattern length is kept in case of equality
+    best = (len(pattern), len(pattern))
+    start = end
+    for j, score in enumerate(myers_columns(pattern[::-1], text[:end][::-1])):
+        candidate = (score, abs(j+1-len(pattern)))
+        if candidate < best:
+            best, start = candidate, end-(j+1)
+
+    return start, end, dist
+
+
+def levenshtein(s1, s2, max_dist: int = -1) -> int:
+    """
+    Compute the Levenshtein Distance, strings use the bit-parallel algorithm and lists of words the two-row algorithm
+    When a max_dist is given, cheap lower bounds are checked first to skip hopeless candidates
+
+    Parameters :
+        s1 :
+            First string (or list of words)
+        s2 :
+            Second string (or list of words)
+        max_dist :
+            Stop as soon as the distance is known to be greater than max_dist
+            (By default : -1, negative value will compute the exact distance)
+
+    Returns :
+        The Levenshtein distance of s1 and s2, or max_dist+1 if it is greater than max_dist
+    """
+    if max_dist >= 0:
+        if length_lower_bound(s1, s2) > max_dist or histogram_lower_bound(s1, s2) > max_dist:
+            return max_dist+1
+
+    if isinstance(s1, str) and isinstance(s2, str):
+        return myers_distance(s1, s2, max_dist)
+    return two_row_distance(s1, s2, max_dist)
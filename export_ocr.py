@@ -0,0 +1,147 @@
+"""
+export_ocr.py: Contains functions for serializing the saved ocr predictions (see ocr_store.py) into ALTO or PAGE XML
+It is a step independent of the processing of the images, it can be skipped if only the pairs of text/image are needed
+
+Usage : export_ocr.py [image_dir] [--formats alto pagexml] [--workers N] [--force]
+"""
+
+from kraken import serialization
+from PIL import Image
+from multiprocessing import Pool
+import os
+import argparse
+import ocr_store
+from process_images import list_images
+from checkpoint import write_atomic
+from monitoring import timeit, setup_logger
+import logging
+logger = logging.getLogger("TIA_logger")
+
+serialized_dir = "tmp"+os.sep+"save"+os.sep+"ocr_serialized"
+
+# Template of kraken -> suffix of the files serialized
+export_formats = {"alto": "_ocr.xml", "pagexml": "_ocr_page.xml"}
+
+
+def serialized_path(filename: str, template: str = "alto") -> str:
+    """
+    Parameters :
+        filename :
+            Name of the image file
+        template :
+            Format of the serialization, a key of export_formats
+
+    Returns :
+        Path to the serialization of the prediction of filename
+    """
+    return serialized_dir+os.sep+filename+export_formats[template]
+
+
+def image_size(filepath: str, filename: str) -> tuple:
+    """
+    Size of an image, saved with its prediction or read from the header of the image for older saves
+
+    Parameters :
+        filepath :
+            Path to the image file
+        filename :
+            Name of the image file
+
+    Returns :
+        (width, height) of the image
+    """
+    size = ocr_store.load_metadata(filename)["image_size"]
+    if size is None:
+        with Image.open(filepath) as im:
+            size = im.size
+    return size
+
+
+def export_page(job: tuple) -> list:
+    """
+    Serialize the saved prediction of an image into the formats missing or older than the prediction
+
+    Parameters :
+        job :
+            Tuple (filepath, templates, force), force being True to serialize even if the files are up to date
+
+    Returns :
+        List of the templates serialized
+    """
+    filepath, templates, force = job
+    filename = filepath.split(os.sep)[-1]
+    saved = os.path.getmtime(ocr_store.ocr_path(filename))
+    templates = [template for template in templates
+                 if force or not os.path.exists(serialized_path(filename, template))
+                 or os.path.getmtime(serialized_path(filename, template)) < saved]
+    if not templates:
+        return []
+
+    predictions = ocr_store.to_kraken_records(ocr_store.load_ocr(filename))
+    size = image_size(filepath, filename)
+    for template in templates:
+        write_atomic(serialized_path(filename, template), serialization.serialize(
+            predictions, image_name=filename, image_size=size, template=template))
+    return templates
+
+
+@timeit
+def export_predictions(main_dir: str, templates: tuple = ("alto",), workers: int = 1, force: bool = False) -> int:
+    """
+    Serialize the saved prediction of every image of a directory, images without prediction are skipped
+
+    Parameters :
+        main_dir :
+            Directory in which images are located
+        templates :
+            Formats of the serialization, keys of export_formats (By default : ("alto",))
+        workers :
+            Number of processes serializing in parallel (By default : 1, no process pool is used)
+        force :
+            If True, the serializations up to date are made again
+
+    Returns :
+        Number of files written
+    """
+    os.makedirs(serialized_dir, exist_ok=True)
+    jobs = [(filepath, tuple(templates), force) for filepath in list_images(main_dir)
+            if ocr_store.ocr_exists(filepath.split(os.sep)[-1])]
+
+    if workers <= 1:
+        results = map(export_page, jobs)
+        pool = None
+    else:
+        pool = Pool(workers)
+        results = pool.imap_unordered(
+            export_page, jobs, chunksize=max(1, len(jobs)//(4*workers)))
+
+    count = 0
+    try:
+        for serialized in results:
+            count += len(serialized)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logger.info("Serialized "+str(count)+" files ("+", ".join(templates) +
+                ") of "+str(len(jobs))+" predictions into "+serialized_dir)
+    return count
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Serialize the saved ocr predictions into ALTO or PAGE XML")
+    parser.add_argument("image_dir", nargs="?", default="tmp"+os.sep+"extract_image",
+                        help="Directory where images are located (default : tmp/extract_image)")
+    parser.add_argument("--formats", nargs="+", choices=list(export_formats), default=["alto"],
+                        help="Formats of the serialization (default : alto)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes serializing in parallel (default : 1)")
+    parser.add_argument("--force", action="store_true",
+                        help="Serialize again the predictions already serialized")
+    args = parser.parse_args()
+
+    logger = setup_logger()
+    export_predictions(args.image_dir, args.formats,
+                       args.workers, args.force)
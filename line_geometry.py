@@ -0,0 +1,257 @@
+"""
+line_geometry.py: Contains functions for the geometry of the lines segmented by kraken (boundaries and baselines)
+"""
+
+import cv2 as cv
+import numpy as np
+from itertools import chain
+
+# Lines narrower than this ratio of the page width are most likely noise (ornaments, marks, stains)
+min_width_ratio = 0.2
+
+# Thresholds of filter_lines() used when the line filter is enabled, see process_images.py
+default_line_filter = {"min_width_ratio": min_width_ratio,
+                       "min_height": 8, "min_area": 0, "max_aspect": 1.0}
+
+
+def to_arrays(polygons: list) -> tuple:
+    """
+    Convert the polygons (boundaries or baselines) of a page into a single array of points
+
+    Parameters:
+        polygons :
+            List of polygons, each one a list of [x, y] points
+
+    Returns:
+        The (N, 2) array of every point and the array of the index of the first point of each polygon
+    """
+    lengths = np.array([len(polygon) for polygon in polygons], dtype=np.int64)
+    points = np.array(list(chain.from_iterable(polygons))).reshape(-1, 2)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    return points, offsets
+
+
+def bounding_boxes(polygons: list) -> np.ndarray:
+    """
+    Compute the bounding box of every polygon of a page at once
+
+    Parameters:
+        polygons :
+            List of polygons, each one a list of [x, y] points
+
+    Returns:
+        The (n, 4) array of [x_min, y_min, x_max, y_max] of each polygon, empty polygons have a box of zeros
+    """
+    if len(polygons) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+    points, offsets = to_arrays(polygons)
+    lengths = np.diff(np.append(offsets, len(points)))
+    if len(points) == 0:
+        return np.zeros((len(polygons), 4), dtype=np.int64)
+
+    # reduceat only runs over the non-empty polygons, each segment then ends where the next one starts
+    filled = lengths > 0
+    starts = offsets[filled]
+    boxes = np.zeros((len(polygons), 4), dtype=points.dtype)
+    boxes[filled] = np.concatenate((np.minimum.reduceat(points, starts, axis=0),
+                                    np.maximum.reduceat(points, starts, axis=0)), axis=1)
+    return boxes
+
+
+def widths(polygons: list) -> np.ndarray:
+    """
+    Parameters:
+        polygons :
+            List of polygons, each one a list of [x, y] points
+
+    Returns:
+        The array of the horizontal extent of each polygon
+    """
+    boxes = bounding_boxes(polygons)
+    return boxes[:, 2]-boxes[:, 0]
+
+
+def crop_box(img: np.ndarray, box) -> np.ndarray:
+    """
+    Crop the bounding box of a line (the maximum coordinates are excluded)
+
+    Parameters:
+        img :
+            The image as an array
+        box :
+            [x_min, y_min, x_max, y_max] of the line
+
+    Returns:
+        A view of img on the box
+    """
+    x_min, y_min, x_max, y_max = box
+    return img[y_min:y_max, x_min:x_max]
+
+
+def mask_polygon(cropped: np.ndarray, polygon, origin, fill: int = 255) -> np.ndarray:
+    """
+    Fill the background of a cropped line, everything outside of its boundary
+
+    Parameters:
+        cropped :
+            Image of the bounding box of the line
+        polygon :
+            Boundary of the line, in the coordinates of the full image
+        origin :
+            [x_min, y_min] of the bounding box in the full image
+        fill :
+            Value given to the background (By default : 255, white)
+
+    Returns:
+        A copy of cropped with its background filled
+    """
+    points = np.asarray(polygon, dtype=np.int32).reshape(-1, 2) - \
+        np.asarray(origin, dtype=np.int32)
+    mask = np.zeros(cropped.shape[:2], dtype=np.uint8)
+    cv.fillPoly(mask, [points], 255)
+    masked = np.full_like(cropped, fill)
+    masked[mask > 0] = cropped[mask > 0]
+    return masked
+
+
+def crop_line(img: np.ndarray, polygon, box=None, masked: bool = False, fill: int = 255) -> np.ndarray:
+    """
+    Crop a line of an image, optionally with its background filled
+
+    Parameters:
+        img :
+            The image as an array
+        polygon :
+            Boundary of the line
+        box :
+            [x_min, y_min, x_max, y_max] of the line (By default : None, computed from polygon)
+        masked :
+            If True, everything outside of the boundary is filled, see mask_polygon()
+        fill :
+            Value given to the background when masked
+
+    Returns:
+        The cropped line
+    """
+    if box is None:
+        box = bounding_boxes([polygon])[0]
+    cropped = crop_box(img, box)
+    if masked:
+        cropped = mask_polygon(cropped, polygon, box[:2], fill)
+    return cropped
+
+
+def scale_polygons(polygons: list, factor_x: float, factor_y: float) -> list:
+    """
+    Scale every polygon of a page at once, coordinates are rounded to integers
+
+    Parameters:
+        polygons :
+            List of polygons, each one a list of [x, y] points (or None)
+        factor_x :
+            Factor applied to the x coordinates
+        factor_y :
+            Factor applied to the y coordinates
+
+    Returns:
+        The list of scaled polygons, each one a list of [x, y]
+    """
+    present = [polygon for polygon in polygons if polygon is not None]
+    if len(present) == 0:
+        return list(polygons)
+    points, offsets = to_arrays(present)
+    scaled = np.rint(points.astype(np.float64) *
+                     (factor_x, factor_y)).astype(np.int64).tolist()
+    bounds = np.append(offsets, len(scaled)).tolist()
+    scaled = iter([scaled[bounds[i]:bounds[i+1]]
+                   for i in range(len(present))])
+    return [None if polygon is None else next(scaled) for polygon in polygons]
+
+
+def scale_segmentation(segmentation: dict, factor_x: float, factor_y: float) -> dict:
+    """
+    Scale the baselines, boundaries and regions of a segmentation, i.e. back to the size of the original image
+
+    Parameters:
+        segmentation :
+            Dictionnary produced by kraken.blla.segment()
+        factor_x :
+            Factor applied to the x coordinates
+        factor_y :
+            Factor applied to the y coordinates
+
+    Returns:
+        The segmentation, modified in place
+    """
+    lines = segmentation.get("lines", [])
+    for key in ("baseline", "boundary"):
+        for line, polygon in zip(lines, scale_polygons([line.get(key) for line in lines], factor_x, factor_y)):
+            line[key] = polygon
+    for region_type, regions in segmentation.get("regions", {}).items():
+        segmentation["regions"][region_type] = scale_polygons(
+            regions, factor_x, factor_y)
+    return segmentation
+
+
+def estimate_line_height(gray: np.ndarray, min_height: int = 4):
+    """
+    Estimate the spacing between lines of text of a page, from the period of its horizontal ink profile
+
+    Parameters:
+        gray :
+            The page as a grayscale array
+        min_height :
+            Smallest spacing considered, in pixels (By default : 4)
+
+    Returns:
+        The spacing in pixels, or None if the profile has no period (i.e. a blank page)
+    """
+    _, ink = cv.threshold(gray, 0, 1, cv.THRESH_BINARY_INV+cv.THRESH_OTSU)
+    profile = ink.mean(axis=1)
+    profile = profile-profile.mean()
+    if not profile.any():
+        return None
+
+    # Autocorrelation of the profile through the FFT, its first peak is the spacing
+    size = 2*len(profile)
+    spectrum = np.fft.rfft(profile, size)
+    autocorrelation = np.fft.irfft(spectrum*np.conj(spectrum), size)[:len(profile)//2]
+    autocorrelation /= autocorrelation[0]
+    for lag in range(min_height, len(autocorrelation)-1):
+        if autocorrelation[lag] > 0.1 and autocorrelation[lag-1] <= autocorrelation[lag] >= autocorrelation[lag+1]:
+            return float(lag)
+    return None
+
+
+def filter_lines(lines: list, page_width: int, min_width_ratio: float = 0, min_height: int = 0, min_area: int = 0,
+                 max_aspect: float = None) -> np.ndarray:
+    """
+    Find the segmented lines worth recognizing, from the bounding box of their boundary (or baseline)
+
+    Parameters:
+        lines :
+            The "lines" of a segmentation produced by kraken.blla.segment()
+        page_width :
+            Width of the page, in pixels
+        min_width_ratio :
+            Smallest width of a line, as a ratio of page_width (By default : 0, no minimum)
+        min_height :
+            Smallest height of a line, in pixels (By default : 0, no minimum)
+        min_area :
+            Smallest area of the bounding box of a line, in pixels (By default : 0, no minimum)
+        max_aspect :
+            Largest ratio height/width of a line, taller lines are vertical artifacts
+            (By default : None, no maximum)
+
+    Returns:
+        The boolean array of the lines kept
+    """
+    boxes = bounding_boxes([line.get("boundary") or line["baseline"]
+                            for line in lines])
+    width = boxes[:, 2]-boxes[:, 0]
+    height = boxes[:, 3]-boxes[:, 1]
+    keep = (width >= min_width_ratio*page_width) & (height >=
+                                                    min_height) & (width*height >= min_area)
+    if max_aspect is not None:
+        keep &= height <= max_aspect*np.maximum(width, 1)
+    return keep
@@ -0,0 +1,262 @@
+"""
+line_recognition.py: Contains the recognition of the lines of segmented pages, the steps of kraken.rpred.rpred() taken apart
+so that the lines of several pages are extracted before being recognized together
+
+Lines of similar widths are padded into batches, the network runs once per batch instead of once per line
+"""
+
+from kraken.lib.segmentation import extract_polygons
+from kraken.lib.dataset import ImageInputTransforms
+from kraken.lib.exceptions import KrakenInputException
+from kraken.rpred import BaselineOCRRecord
+from PIL import Image
+import torch
+import torch.nn.functional as F
+import os
+import logging
+logger = logging.getLogger("TIA_logger")
+
+# Blank padding added to the left and right of each line, the default of rpred()
+default_pad = 16
+
+# Largest number of lines in a batch, larger batches don't run faster on cpu
+default_batch_size = 32
+
+# Largest padding of a line in a batch, as a ratio of its width, padding is computation wasted
+max_padding = 0.1
+
+# Share of the available memory a batch may use, and peak memory used by the network for each pixel of its input
+# (two float32 maps of 32 channels for the first convolutions of the default model)
+batch_memory_ratio = 0.25
+bytes_per_input_pixel = 256
+
+
+class LineImage:
+    """
+    A line extracted from its page, ready for the recognition
+
+    Attributes:
+        coords :
+            The line of the segmentation (baseline, boundary, tags), given to the BaselineOCRRecord
+        tensor :
+            The line image transformed for the network (C, H, W), None if the line can't be recognized
+        width :
+            Width of the line image before its transformation, to convert positions back into the page
+    """
+
+    def __init__(self, coords: dict, tensor=None, width: int = 0) -> None:
+        self.coords = coords
+        self.tensor = tensor
+        self.width = width
+
+
+def line_transforms(model, pad: int = default_pad) -> ImageInputTransforms:
+    """
+    Parameters:
+        model :
+            The kraken TorchSeqRecognizer
+        pad :
+            Blank padding of each line
+
+    Returns:
+        The transforms turning a line image into the input of the network, as in rpred()
+    """
+    batch, channels, height, width = model.nn.input
+    return ImageInputTransforms(batch, height, width, channels, (pad, 0), False)
+
+
+def extract_lines(im: Image, segmentation: dict, transforms: ImageInputTransforms) -> list:
+    """
+    Extract and transform every line of a page, lines failing are kept empty as in rpred()
+
+    Parameters:
+        im :
+            PIL Image object of the page
+        segmentation :
+            Dictionnary produced by kraken.blla.segment()
+        transforms :
+            Transforms of the network, see line_transforms()
+
+    Returns:
+        List of LineImage, one per line of the segmentation
+    """
+    lines = []
+    for line in segmentation["lines"]:
+        bounds = {"type": "baselines", "text_direction": segmentation.get("text_direction", "horizontal-lr"),
+                  "lines": [line]}
+        try:
+            box, coords = next(extract_polygons(im, bounds))
+        except KrakenInputException as error:
+            logger.warning("Extracting line failed : "+str(error))
+            lines.append(LineImage(line))
+            continue
+        if 0 in box.size:
+            lines.append(LineImage(coords))
+            continue
+        try:
+            tensor = transforms(box)
+        except Exception as error:
+            logger.warning("Tensor conversion failed : "+str(error))
+            lines.append(LineImage(coords))
+            continue
+        # An empty line image has no text to recognize
+        if tensor.max() == tensor.min():
+            lines.append(LineImage(coords))
+            continue
+        lines.append(LineImage(coords, tensor, box.size[0]))
+    return lines
+
+
+def to_record(line: LineImage, prediction: list, output_width: int, pad: int = default_pad, bidi_reordering: bool = True) -> BaselineOCRRecord:
+    """
+    Convert the decoded output of the network into a record, positions being scaled from the network to the page
+
+    Parameters:
+        line :
+            The LineImage recognized
+        prediction :
+            List of (character, start, end, confidence) decoded by the network
+        output_width :
+            Width of the output of the network for this line (without padding of a batch)
+        pad :
+            Blank padding of each line
+        bidi_reordering :
+            If True, the record is reordered by the bidirectional algorithm, as in rpred()
+
+    Returns:
+        The BaselineOCRRecord, identical to the one of rpred()
+    """
+    # Scale between network output and network input, then between network input and the line image
+    net_scale = line.tensor.shape[2]/output_width
+    in_scale = line.width/(line.tensor.shape[2]-2*pad)
+
+    def scale(value):
+        return int(round(min(max(((value*net_scale)-pad)*in_scale, 0), line.width-1)))
+
+    text = ''.join(character for character, _, _, _ in prediction)
+    cuts = [(scale(start), scale(end)) for _, start, end, _ in prediction]
+    confidences = [confidence for _, _, _, confidence in prediction]
+    record = BaselineOCRRecord(text, cuts, confidences, line.coords)
+    return record.logical_order() if bidi_reordering else record.display_order(None)
+
+
+def empty_record(line: LineImage) -> BaselineOCRRecord:
+    """
+    Returns:
+        The empty record rpred() gives to a line which can't be recognized
+    """
+    return BaselineOCRRecord('', [], [], line.coords)
+
+
+def max_batch_pixels() -> int:
+    """
+    Returns:
+        Largest number of input pixels of a batch, from the memory currently available (Linux)
+        None if it is unknown, the batches are then only limited by their number of lines
+    """
+    # MemAvailable counts the page cache which can be freed, unlike the free pages of sysconf()
+    try:
+        with open("/proc/meminfo") as file:
+            available = next(int(line.split()[1])*1024 for line in file
+                             if line.startswith("MemAvailable:"))
+    except (OSError, StopIteration, ValueError):
+        try:
+            available = os.sysconf("SC_AVPHYS_PAGES") * \
+                os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            return None
+    return int(available*batch_memory_ratio/bytes_per_input_pixel)
+
+
+def batch_lines(lines: list, batch_size: int = default_batch_size, max_pixels: int = None, padding: float = max_padding) -> list:
+    """
+    Group the lines to recognize by width, so that a batch is padded as little as possible
+
+    Parameters:
+        lines :
+            List of LineImage, see extract_lines()
+        batch_size :
+            Largest number of lines in a batch (By default : default_batch_size)
+        max_pixels :
+            Largest number of pixels of a padded batch, see max_batch_pixels()
+            (By default : None, no limit)
+        padding :
+            Largest padding of a line, as a ratio of its width (By default : max_padding)
+
+    Returns:
+        List of batches, each one the list of the indexes of lines of a same height, sorted by width
+    """
+    # Heights only differ for networks without a fixed input height, they can't be batched together
+    indexes = sorted((i for i, line in enumerate(lines) if line.tensor is not None),
+                     key=lambda i: tuple(lines[i].tensor.shape[1:]))
+    batches, batch = [], []
+    for i in indexes:
+        # Lines are sorted, the line added is the widest one, i.e. the padded width of the batch
+        height, width = lines[i].tensor.shape[1:]
+        size = height*width*(len(batch)+1)
+        first = lines[batch[0]].tensor if batch else None
+        if batch and (len(batch) >= batch_size or height != first.shape[1] or width > (1+padding)*first.shape[2]
+                      or (max_pixels is not None and size > max_pixels)):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def recognize_batch(model, lines: list, pad: int = default_pad) -> list:
+    """
+    Recognize lines in a single run of the network, they are padded with blank to the widest one
+    The recurrent layers ignore the padding, only the convolutions see it at the end of the narrower lines
+
+    Parameters:
+        model :
+            The kraken TorchSeqRecognizer
+        lines :
+            List of LineImage with a tensor, of the same height (see batch_lines())
+        pad :
+            Blank padding of each line
+
+    Returns:
+        List of BaselineOCRRecord, in the order of lines
+    """
+    widths = [line.tensor.shape[2] for line in lines]
+    # Tensors are inverted, 0 is the blank also added by the transforms
+    batch = torch.stack([F.pad(line.tensor, (0, max(widths)-width))
+                         for line, width in zip(lines, widths)])
+    outputs, output_widths = model.forward(batch, torch.tensor(widths))
+
+    # Decoding of TorchSeqRecognizer.predict(), keeping the output width of each line
+    records = []
+    for line, output, output_width in zip(lines, outputs, output_widths):
+        prediction = model.codec.decode(
+            model.decoder(output[:, :output_width]))
+        records.append(to_record(line, prediction, int(output_width), pad))
+    return records
+
+
+def recognize_lines(model, lines: list, pad: int = default_pad, batch_size: int = default_batch_size) -> list:
+    """
+    Recognize lines, from one or several pages, by batches of lines of similar widths
+    The size of the batches adapts to the memory available, see max_batch_pixels()
+
+    Parameters:
+        model :
+            The kraken TorchSeqRecognizer
+        lines :
+            List of LineImage, see extract_lines()
+        pad :
+            Blank padding of each line
+        batch_size :
+            Largest number of lines in a batch (By default : default_batch_size, 1 recognizes the lines one by one)
+
+    Returns:
+        List of BaselineOCRRecord, in the order of lines
+    """
+    records = [empty_record(line) if line.tensor is None else None
+               for line in lines]
+    for batch in batch_lines(lines, batch_size, max_batch_pixels()):
+        for i, record in zip(batch, recognize_batch(model, [lines[i] for i in batch], pad)):
+            records[i] = record
+    return records
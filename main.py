@@ -1,5 +1,7 @@
 """
-usage : main.py
+usage : main.py [--align-workers N] [--ocr-workers N] [--ocr-threads N] [--model NAME] [--segmentation-model NAME]
+                [--segmentation-size PIXELS] [--segmentation-line-height PIXELS] [--export [alto] [pagexml]] [--recognize-only]
+                [--filter-lines] [--quantized]
 """
 
 import logging
@@ -11,14 +13,19 @@ from time import time
 from monitoring import timeit
 import os
 import re
+import argparse
 import align
 import process_images
+from checkpoint import write_atomic
+import export_ocr
+import recognize_only
 import sys
 import retrieve_match
 import utils_extract
 import preprocess_image
 import pdf_text_extract
 import add_align
+import line_geometry
 
 logger = logging.getLogger("TIA_logger")
 
@@ -92,8 +99,7 @@ def retriever(cotes: dict, image_dir: str, output: str, result_filepath: str) ->
     logger.info("\tSaved matches here "+last_saved)
 
     # Save the dictionnary object with pickle
-    with open(result_filepath, 'ab+') as file:
-        pickle.dump(cotes_associated, file)
+    write_atomic(result_filepath, pickle.dumps(cotes_associated), binary=True)
 
     logger.info("\tSaved backup dictionnary of matches here : "+result_filepath)
 
@@ -193,14 +199,18 @@ def prepare_data(images_extract_dir: str, txt_extract_dir: str) -> dict:
     # -------------------------------------------------------------------
 
     # Find images associated with cotes
-    cotes_associated = {}
+    cotes_associated = None
     if (os.path.exists(result_filepath) and os.path.isfile(result_filepath)):
         # Load saved result to save time
-        with open(result_filepath, 'rb') as file:
-            cotes_associated = pickle.load(file)
-        logger.info(
-            "Loaded matches from previous result from "+result_filepath)
-    else:
+        try:
+            with open(result_filepath, 'rb') as file:
+                cotes_associated = pickle.load(file)
+            logger.info(
+                "Loaded matches from previous result from "+result_filepath)
+        except (EOFError, pickle.UnpicklingError) as error:
+            # Truncated by a crash while it was written in place, before the atomic writes
+            logger.warning("Ignored the corrupt save "+result_filepath+" : "+str(error))
+    if cotes_associated is None:
         # This one process may take time
         cotes_associated = retriever(
             cotes, image_dir, result_filepath, result_filepath)
@@ -230,6 +240,31 @@ def prepare_data(images_extract_dir: str, txt_extract_dir: str) -> dict:
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--align-workers", type=int, default=1,
+                        help="Number of processes aligning images in parallel (default : 1)")
+    parser.add_argument("--ocr-workers", type=int, default=1,
+                        help="Number of processes segmenting and recognizing images in parallel (default : 1)")
+    parser.add_argument("--ocr-threads", type=int, default=None,
+                        help="Number of torch threads of each ocr process (default : cpus divided by --ocr-workers)")
+    parser.add_argument("--model", default=None,
+                        help="Name (in models/) or path of the recognition model (default : HTR-United-Manu_McFrench)")
+    parser.add_argument("--segmentation-model", default=None,
+                        help="Name (in models/) or path of the segmentation model (default : kraken's blla model)")
+    parser.add_argument("--segmentation-size", type=int, default=None,
+                        help="Downscale images to this largest side before their segmentation (default : full resolution)")
+    parser.add_argument("--segmentation-line-height", type=float, default=None,
+                        help="Downscale images to this estimated spacing between lines before their segmentation (default : full resolution)")
+    parser.add_argument("--export", nargs="*", choices=list(export_ocr.export_formats), default=["alto"],
+                        help="Formats the ocr predictions are serialized into, none skips the serialization (default : alto)")
+    parser.add_argument("--recognize-only", action="store_true",
+                        help="Only recognize again the images already segmented, i.e. with a new --model")
+    parser.add_argument("--filter-lines", action="store_true",
+                        help="Don't recognize the lines too narrow, too small or vertical (see line_geometry.default_line_filter)")
+    parser.add_argument("--quantized", action="store_true",
+                        help="Recognize with the int8 quantized model, see quantization.py for its accuracy-vs-speed report")
+    args = parser.parse_args()
+
     # Logger
     logger = monitoring.setup_logger()
 
@@ -261,12 +296,30 @@ if __name__ == "__main__":
     # Process images (segment, predict, crop)
 
     logger.info("Processing images")
-    process_images.process_images(images_extract_dir)
+    line_filter = line_geometry.default_line_filter if args.filter_lines else None
+    if args.recognize_only:
+        recognize_only.recognize_images(images_extract_dir, recognition_model=args.model,
+                                        segmentation_model=args.segmentation_model,
+                                        workers=args.ocr_workers, threads=args.ocr_threads,
+                                        line_filter=line_filter, quantized=args.quantized)
+    else:
+        process_images.process_images(images_extract_dir, recognition_model=args.model,
+                                      segmentation_model=args.segmentation_model,
+                                      workers=args.ocr_workers, threads=args.ocr_threads,
+                                      segmentation_size=args.segmentation_size,
+                                      segmentation_line_height=args.segmentation_line_height,
+                                      line_filter=line_filter, quantized=args.quantized)
+
+    # Serialization of the predictions, not needed for the pairs of text/image
+    if args.export:
+        export_ocr.export_predictions(images_extract_dir, args.export,
+                                      workers=args.ocr_workers)
 
     # -------------------------------------------------------------------
 
     # Alignment text-image of cropped part of an image
-    align.batch_align_crop(images_extract_dir, printing=True)
+    align.batch_align_crop(images_extract_dir, printing=True,
+                           workers=args.align_workers)
 
     # Statistics
     logger.info("Starting statistics calculations")
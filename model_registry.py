@@ -0,0 +1,124 @@
+"""
+model_registry.py: Contains the registry of kraken models, loaded on first use and kept for the lifetime of the process
+"""
+
+import os
+import threading
+import time
+import logging
+logger = logging.getLogger("TIA_logger")
+
+models_dir = "models"
+
+# Default model used from https://zenodo.org/record/6657809
+# Credits to Chagué, Alix, Clérice, Thibault (2022) HTR-United - Manu McFrench V1 (Manuscripts of Modern and Contemporaneous French)
+default_recognition_model = "HTR-United-Manu_McFrench.mlmodel"
+
+# None selects the default segmentation model shipped with kraken (blla.mlmodel)
+default_segmentation_model = None
+
+# Models already loaded, keyed by (kind, path)
+_loaded = {}
+_lock = threading.Lock()
+
+
+def resolve_model_path(name: str) -> str:
+    """
+    Find the file of a model from its name or path
+
+    Parameters:
+        name :
+            Path to a model, or name of a model in models/ (the .mlmodel extension can be omitted)
+
+    Returns:
+        Path to the model file
+    """
+    for candidate in (name, models_dir+os.sep+name, models_dir+os.sep+name+".mlmodel"):
+        if os.path.isfile(candidate):
+            return candidate
+    raise FileNotFoundError("No model found for "+name)
+
+
+def default_segmentation_path() -> str:
+    """
+    Returns:
+        Path to the default segmentation model of kraken, the one blla.segment() loads when no model is given
+    """
+    import pkg_resources
+    return pkg_resources.resource_filename("kraken.blla", "blla.mlmodel")
+
+
+def _get(kind: str, path: str, loader):
+    """
+    Return the model of path, loading it with loader on first use
+    """
+    key = (kind, os.path.abspath(path))
+    with _lock:
+        if key not in _loaded:
+            start = time.time()
+            _loaded[key] = loader(path)
+            logger.info("Loaded %s model %s in %.2f sec" %
+                        (kind, path, time.time()-start))
+        return _loaded[key]
+
+
+def recognition_model_path(name: str = None) -> str:
+    """
+    Parameters:
+        name :
+            Name or path of the model, see resolve_model_path() (By default : None, the default_recognition_model)
+
+    Returns:
+        Path to the recognition model file
+    """
+    return resolve_model_path(default_recognition_model if name is None else name)
+
+
+def segmentation_model_path(name: str = None) -> str:
+    """
+    Parameters:
+        name :
+            Name or path of the model, see resolve_model_path()
+            (By default : None, the default_segmentation_model)
+
+    Returns:
+        Path to the segmentation model file
+    """
+    if name is None:
+        name = default_segmentation_model
+    return default_segmentation_path() if name is None else resolve_model_path(name)
+
+
+def get_recognition_model(name: str = None):
+    """
+    Fetch a recognition model, loaded once per process
+
+    Parameters:
+        name :
+            Name or path of the model, see resolve_model_path() (By default : None, the default_recognition_model)
+            The path of a quantized model (see quantization.py) is also accepted
+
+    Returns:
+        The kraken TorchSeqRecognizer
+    """
+    from kraken.lib import models
+    from quantization import quantized_suffix, load_quantized
+    path = recognition_model_path(name)
+    # Quantized models are saved by quantization.py, not in the format of kraken
+    return _get("recognition", path, load_quantized if path.endswith(quantized_suffix) else models.load_any)
+
+
+def get_segmentation_model(name: str = None):
+    """
+    Fetch a segmentation model, loaded once per process
+
+    Parameters:
+        name :
+            Name or path of the model, see resolve_model_path()
+            (By default : None, the default_segmentation_model)
+
+    Returns:
+        The kraken TorchVGSLModel given to blla.segment()
+    """
+    from kraken.lib import vgsl
+    return _get("segmentation", segmentation_model_path(name), vgsl.TorchVGSLModel.load_model)
@@ -3,12 +3,15 @@ monitoring.py: Contains functions for monitoring and logging performance/time
 """
 
 import matplotlib.pyplot as plt
+import numpy as np
 import time
 import logging
 from datetime import datetime
 import os
 from PIL import Image
 import ujson
+import line_geometry
+from segment_store import SegmentStore
 logger = logging.getLogger("TIA_logger")
 image_extension = (".jpg", ".png")
 
@@ -135,8 +138,8 @@ def generate_compare_html(source_dir: str) -> None:
                 cropping_count = 0
                 for file in files:
 
-                    # Skip non image file, should be jpg, due to previous implementation see align.py
-                    if not file.endswith('.jpg'):
+                    # Skip non image file, jpg or png depending on the crop format chosen in align.py
+                    if not file.lower().endswith(image_extension):
                         continue
                     image_path = directory+os.sep+file
                     cropping_html.write('<img style="min-width:500px;max-width:1000px"  src="' + ".."+os.sep + ".."+os.sep +
@@ -172,7 +175,7 @@ def quantify_segment_used(image_dir: str, cropped_dir: str, segment_dir: str) ->
         cropped_dir :
             Path to the directory with the cropping
         segment_dit :
-            Path to the directory with the segment data
+            Path to the directory with the json segment data, used for images missing from the SegmentStore
     Returns :
         None
     """
@@ -183,9 +186,14 @@ def quantify_segment_used(image_dir: str, cropped_dir: str, segment_dir: str) ->
     percents_used = []
     images_data = []
 
+    # Segmentation of every image, read in batches
+    walk = list(os.walk(image_dir))
+    segmentations = SegmentStore(json_dir=segment_dir).get_many(
+        [image for _, _, images in walk for image in images if image.lower().endswith(image_extension)])
+
     # For every image in the image_dir find their cropping_dir
     # Count the number of pairs in this folder to create data
-    for maindir, _, images in list(os.walk(image_dir)):
+    for maindir, _, images in walk:
 
         for image in images:
             if not image.lower().endswith(image_extension):
@@ -200,11 +208,9 @@ def quantify_segment_used(image_dir: str, cropped_dir: str, segment_dir: str) ->
                     # Divided by 2, because half of the files are the text transcription
                     cropped_in_dir = len(files)//2
 
-            path_to_segment_data = os.path.join(
-                segment_dir, os.path.relpath(directory,
-                                             cropped_dir)+"_segment.json")
-            with open(path_to_segment_data, "r", encoding="UTF-8", errors="ignore") as segment_file:
-                segment_data = ujson.load(segment_file)
+            if image not in segmentations:
+                raise FileNotFoundError("No segmentation saved for "+image)
+            segment_data = segmentations[image]
 
             nb_segments = len(segment_data["lines"])
             if nb_segments == 0:
@@ -218,20 +224,10 @@ def quantify_segment_used(image_dir: str, cropped_dir: str, segment_dir: str) ->
             image_width = PIL_image.width
             PIL_image.close()
 
-            for segment in segment_data["lines"]:
-                baseline = segment["baseline"]
-                x_min = x_max = baseline[0][0]
-                for i in range(1, len(baseline)):
-
-                    x = baseline[i][0]
-
-                    # Take larger coordinates for a rectangle cropping
-                    x_min = (x if x < x_min else x_min)
-                    x_max = (x if x > x_max else x_max)
-
-                cropped_width = x_max - x_min
-                if cropped_width > 0.2*image_width:
-                    segment_used += 1
+            cropped_widths = line_geometry.widths(
+                [segment["baseline"] for segment in segment_data["lines"]])
+            segment_used = int(np.count_nonzero(
+                cropped_widths > line_geometry.min_width_ratio*image_width))
 
             # Saves information : [ Image filedir, percent of segment used , number of cropped aligned, number total segment, number of cropped_width> 20% image_width ]
             images_data.append(
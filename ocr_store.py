@@ -0,0 +1,322 @@
+"""
+ocr_store.py: Contains functions for saving the ocr prediction of a page as arrays (.npz), readable without kraken
+
+Usage : ocr_store.py [--remove]
+        Convert every pickled prediction of tmp/save/ocr_save/ into the .npz format
+        --remove : also remove the pickles converted
+"""
+
+import numpy as np
+import os
+import sys
+import io
+import json
+from itertools import chain
+from checkpoint import write_atomic
+import logging
+logger = logging.getLogger("TIA_logger")
+
+ocr_save_dir = "tmp"+os.sep+"save"+os.sep+"ocr_save"
+
+
+class OCRLine:
+    """
+    Prediction of a line, with the attributes of kraken's BaselineOCRRecord used outside of kraken
+
+    Attributes:
+        prediction :
+            The text predicted
+        line :
+            Boundary polygon of the line, list of [x, y]
+        baseline :
+            Baseline of the line, list of [x, y]
+        confidences :
+            Confidence of each character of prediction
+        raw_cuts :
+            (start, end) position of each character of prediction along the baseline
+        tags :
+            Tags of the line given by the segmentation (or None)
+        display_order :
+            True if prediction is in display order, False if in logical order (see kraken's bidi reordering)
+    """
+
+    def __init__(self, prediction: str, line: list, baseline: list, confidences: list, raw_cuts: list, tags: dict = None, display_order: bool = True) -> None:
+        self.prediction = prediction
+        self.line = line
+        self.baseline = baseline
+        self.confidences = confidences
+        self.raw_cuts = raw_cuts
+        self.tags = tags
+        self.display_order = display_order
+
+    def __len__(self) -> int:
+        return len(self.prediction)
+
+
+def ocr_path(filename: str) -> str:
+    """
+    Parameters:
+        filename :
+            Name of the image file
+
+    Returns:
+        Path to the saved prediction of filename
+    """
+    return ocr_save_dir+os.sep+filename+"_ocr.npz"
+
+
+def pickle_path(filename: str) -> str:
+    """
+    Parameters:
+        filename :
+            Name of the image file
+
+    Returns:
+        Path to the pickled prediction of filename, the format used before the .npz
+    """
+    return ocr_save_dir+os.sep+filename+"_ocr.pickle"
+
+
+def _pack_polygons(polygons: list) -> tuple:
+    """
+    Returns:
+        The (N, 2) array of every point of the polygons and the (n+1) array of the offsets of each polygon
+    """
+    offsets = np.zeros(len(polygons)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(polygon) for polygon in polygons])
+    points = np.array(list(chain.from_iterable(polygons)),
+                      dtype=np.int32).reshape(-1, 2)
+    return points, offsets
+
+
+def _unpack_polygons(points: np.ndarray, offsets: np.ndarray) -> list:
+    """
+    Returns:
+        The list of polygons packed by _pack_polygons(), each one a list of [x, y]
+    """
+    points = points.tolist()
+    return [points[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+
+def save_ocr(predictions: list, filename: str, path: str = None, metadata: dict = None) -> str:
+    """
+    Save the prediction of a page as arrays in a compressed .npz, the file is replaced atomically
+
+    Parameters:
+        predictions :
+            List of records produced by kraken.rpred.rpred() (or of OCRLine)
+        filename :
+            Name of the image file
+        path :
+            Path to the file (By default : None, the file of filename in tmp/save/ocr_save/)
+        metadata :
+            Information saved with the prediction, every key being optional (By default : None, nothing saved) :
+            "image_size" (width, height) of the image, kept for the serialization,
+            "model" identity of the recognition model, i.e. {"name", "sha256"},
+            "filtered_lines" number of lines of the segmentation left out of the recognition
+
+    Returns:
+        Path to the file saved
+    """
+    if path is None:
+        path = ocr_path(filename)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    texts = [record.prediction for record in predictions]
+    text_offsets = np.zeros(len(texts)+1, dtype=np.int64)
+    text_offsets[1:] = np.cumsum([len(text) for text in texts])
+    line_points, line_offsets = _pack_polygons(
+        [record.line for record in predictions])
+    baseline_points, baseline_offsets = _pack_polygons(
+        [record.baseline for record in predictions])
+    raw_cuts = [record.raw_cuts if isinstance(record, OCRLine) else record._cuts
+                for record in predictions]
+    display_order = [record.display_order if isinstance(record, OCRLine) else getattr(record, "_display_order", True)
+                     for record in predictions]
+
+    arrays = {
+        "text": np.array([ord(c) for c in ''.join(texts)], dtype=np.uint32),
+        "text_offsets": text_offsets,
+        "confidences": np.array(list(chain.from_iterable(record.confidences for record in predictions)), dtype=np.float32),
+        "cuts": np.array(list(chain.from_iterable(raw_cuts)), dtype=np.int32).reshape(-1, 2),
+        "line_points": line_points,
+        "line_offsets": line_offsets,
+        "baseline_points": baseline_points,
+        "baseline_offsets": baseline_offsets,
+        "tags": np.array(json.dumps([getattr(record, "tags", None) for record in predictions])),
+        "display_order": np.array(display_order, dtype=bool),
+    }
+    metadata = metadata or {}
+    if metadata.get("image_size") is not None:
+        arrays["image_size"] = np.array(metadata["image_size"], dtype=np.int64)
+    if metadata.get("model") is not None:
+        arrays["model"] = np.array(json.dumps(metadata["model"]))
+    if metadata.get("filtered_lines") is not None:
+        arrays["filtered_lines"] = np.array(metadata["filtered_lines"], dtype=np.int64)
+
+    # Written in memory first, so the file never exists half written
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    write_atomic(path, buffer.getvalue(), binary=True)
+    return path
+
+
+def load_ocr(filename: str, path: str = None) -> list:
+    """
+    Load the prediction of a page saved by save_ocr(), kraken is not needed
+
+    Parameters:
+        filename :
+            Name of the image file
+        path :
+            Path to the file (By default : None, the file of filename in tmp/save/ocr_save/)
+
+    Returns:
+        List of OCRLine, one per line in the order of the prediction
+    """
+    if path is None:
+        path = ocr_path(filename)
+    with np.load(path, allow_pickle=False) as data:
+        codes = data["text"]
+        text_offsets = data["text_offsets"]
+        confidences = data["confidences"].tolist()
+        # Cuts are pixel positions, the first saves stored them as floats
+        cuts = np.rint(data["cuts"]).astype(np.int64).tolist()
+        lines = _unpack_polygons(data["line_points"], data["line_offsets"])
+        baselines = _unpack_polygons(
+            data["baseline_points"], data["baseline_offsets"])
+        tags = json.loads(str(data["tags"]))
+        display_order = data["display_order"].tolist()
+
+    text = ''.join(map(chr, codes.tolist()))
+    records = []
+    for i in range(len(text_offsets)-1):
+        start, end = text_offsets[i], text_offsets[i+1]
+        records.append(OCRLine(text[start:end], lines[i], baselines[i],
+                               confidences[start:end], cuts[start:end], tags[i], display_order[i]))
+    return records
+
+
+def load_metadata(filename: str, path: str = None) -> dict:
+    """
+    Read the information saved with a prediction, without loading the prediction
+
+    Parameters:
+        filename :
+            Name of the image file
+        path :
+            Path to the file (By default : None, the file of filename in tmp/save/ocr_save/)
+
+    Returns:
+        Dictionnary {"image_size", "model", "filtered_lines"} given to save_ocr(), None for what wasn't saved
+    """
+    if path is None:
+        path = ocr_path(filename)
+    metadata = {"image_size": None, "model": None, "filtered_lines": None}
+    with np.load(path, allow_pickle=False) as data:
+        if "image_size" in data.files:
+            metadata["image_size"] = tuple(data["image_size"].tolist())
+        if "model" in data.files:
+            metadata["model"] = json.loads(str(data["model"]))
+        if "filtered_lines" in data.files:
+            metadata["filtered_lines"] = int(data["filtered_lines"])
+    return metadata
+
+
+def ocr_exists(filename: str) -> bool:
+    """
+    Parameters:
+        filename :
+            Name of the image file
+
+    Returns:
+        True if the prediction of the page is saved, migrating its pickle if it is in the previous format
+    """
+    if os.path.isfile(ocr_path(filename)):
+        return True
+    if os.path.isfile(pickle_path(filename)):
+        migrate_pickle(filename)
+        return True
+    return False
+
+
+def to_kraken_records(records: list) -> list:
+    """
+    Convert OCRLine back into kraken's BaselineOCRRecord, i.e. for the serialization by kraken
+
+    Parameters:
+        records :
+            List of OCRLine
+
+    Returns:
+        List of BaselineOCRRecord
+    """
+    from kraken.rpred import BaselineOCRRecord
+    converted = []
+    for record in records:
+        line = {"boundary": record.line, "baseline": record.baseline}
+        if record.tags is not None:
+            line["tags"] = record.tags
+        converted.append(BaselineOCRRecord(record.prediction, [tuple(cut) for cut in record.raw_cuts],
+                                           record.confidences, line, display_order=record.display_order))
+    return converted
+
+
+def migrate_pickle(filename: str, remove: bool = False) -> str:
+    """
+    Convert the pickled prediction of a page into the .npz format, it needs kraken to unpickle
+    The .npz keeps the modification time of the pickle, it tells when the prediction was made (see process_images.py)
+
+    Parameters:
+        filename :
+            Name of the image file
+        remove :
+            If True, the pickle is removed once converted
+
+    Returns:
+        Path to the file saved
+    """
+    import pickle
+    with open(pickle_path(filename), 'rb') as file:
+        predictions = pickle.load(file)
+    path = save_ocr(predictions, filename)
+    saved = os.stat(pickle_path(filename))
+    os.utime(path, ns=(saved.st_atime_ns, saved.st_mtime_ns))
+    if remove:
+        os.remove(pickle_path(filename))
+    logger.debug("Migrated "+pickle_path(filename)+" into "+path)
+    return path
+
+
+def migrate_all(remove: bool = False) -> int:
+    """
+    Convert every pickled prediction of tmp/save/ocr_save/ not converted yet
+
+    Parameters:
+        remove :
+            If True, the pickles are removed once converted
+
+    Returns:
+        Number of pickles converted
+    """
+    count = 0
+    for file in sorted(os.listdir(ocr_save_dir)):
+        if not file.endswith("_ocr.pickle"):
+            continue
+        filename = file[:-len("_ocr.pickle")]
+        if not os.path.isfile(ocr_path(filename)):
+            migrate_pickle(filename)
+            count += 1
+        if remove:
+            os.remove(pickle_path(filename))
+    logger.info("Migrated "+str(count)+" pickled predictions")
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] != "--remove"):
+        print(__doc__)
+        sys.exit()
+    from monitoring import setup_logger
+    setup_logger()
+    migrate_all(remove=len(sys.argv) == 2)
@@ -0,0 +1,137 @@
+"""
+overlay.py: Contains functions for drawing the segmentation of a page on a downscaled copy of the image (tmp/segmented/)
+"""
+
+import cv2 as cv
+import numpy as np
+import os
+import line_geometry
+import ocr_store
+
+segmented_img_dir = "tmp"+os.sep+"segmented"
+
+# Factor applied to the size of the image, the overlay is only looked at in the manual alignment page
+overlay_scale = 0.5
+
+# Colors of the lines (BGR) : used for a pair text-image, not used, too short to be used (most likely noise)
+overlay_colors = {"used": (255, 0, 0), "unused": (0, 0, 255),
+                  "short": (80, 165, 255)}
+
+
+def overlay_path(filename: str) -> str:
+    """
+    Parameters:
+        filename :
+            Name of the image file
+
+    Returns:
+        Path of the segmented image of filename
+    """
+    return segmented_img_dir+os.sep+filename[:-4]+"_segmented.jpg"
+
+
+def load_boundaries(filename: str) -> list:
+    """
+    Read the boundaries of the lines of a page from its ocr prediction saved by process_images.py
+
+    Parameters:
+        filename :
+            Name of the image file
+
+    Returns:
+        List of the boundary of each line, in the order of the ocr prediction
+    """
+    return [record.line for record in ocr_store.load_ocr(filename)]
+
+
+def render_overlay(img: np.ndarray, boundaries: list, used: set, scale: float = overlay_scale, thickness: int = 5) -> np.ndarray:
+    """
+    Draw the boundaries of the lines on a downscaled copy of the image, one cv.polylines call per color
+
+    Parameters:
+        img :
+            The image read by OpenCV
+        boundaries :
+            List of the boundary of each line
+        used :
+            Indexes of the lines used for a pair text-image
+        scale :
+            Factor applied to the size of the image
+        thickness :
+            Thickness of the lines on the full size image
+
+    Returns:
+        The downscaled image with the segmentation drawn on it
+    """
+    if scale != 1:
+        overlay = cv.resize(img, None, fx=scale, fy=scale,
+                            interpolation=cv.INTER_AREA)
+    else:
+        overlay = img.copy()
+
+    groups = {color: [] for color in overlay_colors}
+    line_widths = line_geometry.widths(boundaries)
+    for i, boundary in enumerate(boundaries):
+        points = np.asarray(boundary, dtype=np.float64)
+        if len(points) < 2:
+            continue
+
+        # If the segment width isn't at least min_width_ratio of the total image width, it is drawn in orange (less visible)
+        if line_widths[i] < line_geometry.min_width_ratio*img.shape[1]:
+            color = "short"
+        else:
+            color = "used" if i in used else "unused"
+        groups[color].append(np.rint(points*scale).astype(np.int32))
+
+    for color, polygons in groups.items():
+        if polygons:
+            cv.polylines(overlay, polygons, False, overlay_colors[color],
+                         max(1, round(thickness*scale)))
+    return overlay
+
+
+def save_overlay(img: np.ndarray, filename: str, boundaries: list, used: set, scale: float = overlay_scale, writer=None) -> str:
+    """
+    Render the segmented image of a page (see render_overlay()) and write it in tmp/segmented/
+
+    Parameters:
+        img :
+            The image read by OpenCV
+        filename :
+            Name of the image file
+        boundaries :
+            List of the boundary of each line
+        used :
+            Indexes of the lines used for a pair text-image
+        scale :
+            Factor applied to the size of the image
+        writer :
+            CropWriter writing the image in background
+            (By default : None, the image is written before returning)
+
+    Returns:
+        Path of the segmented image
+    """
+    os.makedirs(segmented_img_dir, exist_ok=True)
+    path = overlay_path(filename)
+    overlay = render_overlay(img, boundaries, used, scale)
+    if writer is None:
+        cv.imwrite(path, overlay)
+    else:
+        writer.write_image(path, overlay)
+    return path
+
+
+def remove_overlay(filename: str) -> None:
+    """
+    Remove the segmented image of a page, i.e. when its alignment changed
+
+    Parameters:
+        filename :
+            Name of the image file
+
+    Returns:
+        None
+    """
+    if os.path.exists(overlay_path(filename)):
+        os.remove(overlay_path(filename))
@@ -0,0 +1,158 @@
+"""
+pipeline.py: Contains the Pipeline, running the steps of a process in threads connected by bounded queues
+"""
+
+import queue
+import threading
+import time
+import logging
+logger = logging.getLogger("TIA_logger")
+
+# Put in a queue once every item was sent
+_end = object()
+
+
+class _Failure:
+    """
+    Exception raised by a stage, forwarded to the next stages until the end of the pipeline
+    """
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+class Pipeline:
+    """
+    Run each stage in its own thread, a stage takes the items of the previous one through a bounded queue
+    While a stage waits for I/O or for code releasing the GIL (OpenCV, torch), the other ones keep running.
+    The size of the queues limits the number of items held in memory (back-pressure)
+
+    Attributes:
+        stats :
+            For each stage, {"items", "busy" (seconds spent processing), "max_depth", "mean_depth"}
+            depths being the number of items waiting in its input queue
+    """
+
+    def __init__(self, stages: list, queue_size: int = 2) -> None:
+        """
+        Parameters:
+            stages :
+                List of (name, function), each function takes the item returned by the previous one
+            queue_size :
+                Number of items waiting between two stages before the previous stage blocks
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = {name: {"items": 0, "busy": 0.0, "max_depth": 0, "mean_depth": 0.0}
+                      for name, _ in stages}
+        self._depths = {name: [0, 0] for name, _ in stages}
+        self._stopped = threading.Event()
+
+    def _put(self, output: queue.Queue, item) -> bool:
+        """
+        Put an item in a queue, giving up if the pipeline is stopped
+
+        Returns:
+            False if the pipeline is stopped
+        """
+        while not self._stopped.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run_stage(self, name: str, function, inputs, output: queue.Queue) -> None:
+        """
+        Apply function on every item of inputs (a queue, or an iterable for the first stage), run in a thread
+        """
+        stats = self.stats[name]
+        first = not isinstance(inputs, queue.Queue)
+        iterator = iter(inputs) if first else None
+        while True:
+            if first:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    item = _end
+                except BaseException as error:
+                    item = _Failure(error)
+            else:
+                try:
+                    item = inputs.get(timeout=0.1)
+                except queue.Empty:
+                    if self._stopped.is_set():
+                        return
+                    continue
+
+                # Items still waiting once this one is taken
+                depth = inputs.qsize()
+                stats["max_depth"] = max(stats["max_depth"], depth)
+                self._depths[name][0] += depth
+                self._depths[name][1] += 1
+                stats["mean_depth"] = self._depths[name][0] / \
+                    self._depths[name][1]
+
+            if item is _end or isinstance(item, _Failure):
+                self._put(output, item)
+                return
+
+            start = time.time()
+            try:
+                result = function(item)
+            except BaseException as error:
+                result = _Failure(error)
+            stats["busy"] += time.time()-start
+            stats["items"] += 1
+            if not self._put(output, result) or isinstance(result, _Failure):
+                return
+
+    def run(self, items):
+        """
+        Generator of the results of the last stage, in the order of items
+
+        Parameters:
+            items :
+                Iterable of the items given to the first stage
+
+        Returns:
+            The result of the last stage for each item
+            The exception of a stage is raised once the items before it are returned
+        """
+        self._stopped.clear()
+        queues = [queue.Queue(maxsize=self.queue_size)
+                  for _ in self.stages]
+        threads = []
+        inputs = items
+        for (name, function), output in zip(self.stages, queues):
+            thread = threading.Thread(target=self._run_stage, args=(name, function, inputs, output),
+                                      name="pipeline-"+name, daemon=True)
+            thread.start()
+            threads.append(thread)
+            inputs = output
+
+        try:
+            while True:
+                result = queues[-1].get()
+                if result is _end:
+                    break
+                if isinstance(result, _Failure):
+                    raise result.error
+                yield result
+        finally:
+            # The stages still running stop once their current item is processed
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def log_stats(self) -> None:
+        """
+        Log the busy time and the queue depth of each stage, to tune the size of the queues
+
+        Returns:
+            None
+        """
+        for name, stats in self.stats.items():
+            logger.info("Stage %s : %d items, busy %.2f sec, queue depth mean %.2f max %d" %
+                        (name, stats["items"], stats["busy"], stats["mean_depth"], stats["max_depth"]))
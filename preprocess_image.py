@@ -7,7 +7,7 @@ import numpy as np
 import cv2 as cv
 from PIL import Image
 from monitoring import timeit
-import ujson
+from checkpoint import load_json, write_json_atomic
 import logging
 logger = logging.getLogger("TIA_logger")
 image_extension = (".jpg", ".png")
@@ -87,11 +87,9 @@ def split_image(image_filepath: str, split_status_path) -> bool:
 
         # Case : single page
         # Add it to the dictionnary with value of 0
-        with open(split_status_path, 'r', encoding='UTF-8', errors="ignore") as f:
-            split_status = ujson.load(f)
+        split_status = load_json(split_status_path, {})
         split_status[image_filepath] = 0
-        with open(split_status_path, 'w', encoding='UTF-8', errors="ignore") as f:
-            ujson.dump(split_status, f, indent=4)
+        write_json_atomic(split_status_path, split_status, indent=4)
         return False
     else:
         # Find the split location
@@ -111,13 +109,11 @@ def split_image(image_filepath: str, split_status_path) -> bool:
         # Case : double page
         # Add splitted part into a dictionnary with value of 2 and 3
         # Also add the original with value of 1 so he can be found in checklist
-        with open(split_status_path, 'r', encoding='UTF-8', errors="ignore") as f:
-            split_status = ujson.load(f)
+        split_status = load_json(split_status_path, {})
         split_status[image_filepath] = 1
         split_status[image_filepath[:-4]+"_left.jpg"] = 2
         split_status[image_filepath[:-4]+"_right.jpg"] = 3
-        with open(split_status_path, 'w', encoding='UTF-8', errors="ignore") as f:
-            ujson.dump(split_status, f, indent=4)
+        write_json_atomic(split_status_path, split_status, indent=4)
 
         return True
 
@@ -138,14 +134,12 @@ def batch_preprocess(maindir: str) -> None:
     # Using a dictionary as a checkpoint to know if an image was already processed
     # Each value means a different case
     # { 0: no need to split, 1 : already splitted,  2 : left split, 3 : right split }
+    # A missing or corrupt checkpoint starts empty, images already split are recognized by their "_right.jpg"
     split_status_path = "tmp"+os.sep+"save"+os.sep+"split_status.json"
-    if not os.path.exists(split_status_path):
+    split_status = load_json(split_status_path, None)
+    if split_status is None:
         split_status = dict()
-        with open(split_status_path, "w", encoding='UTF-8', errors="ignore") as file:
-            ujson.dump(split_status, file, indent=4)
-    else:
-        with open(split_status_path, 'r', encoding='UTF-8', errors="ignore") as f:
-            split_status = ujson.load(f)
+        write_json_atomic(split_status_path, split_status, indent=4)
 
     # For each image in the extract_img directory
     image_split_count = 0
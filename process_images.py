@@ -3,43 +3,106 @@ process_image.py: Contains functions for processing images with kraken OCR
 """
 
 from kraken import blla
-from kraken import rpred
 from kraken.lib import models
-from kraken import serialization
 from PIL import Image
+import numpy as np
 import os
+import json
 import pickle
-import ujson
+import zipfile
+import argparse
+import time
 import logging
-from monitoring import timeit
+from multiprocessing import Pool
+from functools import partial
+from pipeline import Pipeline
+import ocr_store
+from checkpoint import Journal, write_atomic
+from segment_store import SegmentStore
+from content_cache import ContentCache, segmentation_key, recognition_key
+import line_geometry
+import line_recognition
+from quantization import quantize_model
+from monitoring import timeit, setup_logger
+from model_registry import get_recognition_model, get_segmentation_model, recognition_model_path, segmentation_model_path
 logger = logging.getLogger("TIA_logger")
 
+# Segmentation of every image (see segment_store.py)
+segment_store = SegmentStore()
 
-# Default model used from https://zenodo.org/record/6657809
-# Credits to Chagué, Alix, Clérice, Thibault (2022) HTR-United - Manu McFrench V1 (Manuscripts of Modern and Contemporaneous French)
-model_path = 'models'+os.sep+'HTR-United-Manu_McFrench.mlmodel'
-model = models.load_any(model_path)
+# Results keyed by the content of the image and of the models (see content_cache.py)
+content_cache = ContentCache()
+
+# Images whose prediction is saved, with the checksums of the files (see checkpoint.py)
+journal = Journal()
+
+
+def segmentation_scale(im: Image, max_size: int = None, line_height: float = None) -> float:
+    """
+    Factor by which an image is downscaled before its segmentation, images are never upscaled
+
+    Parameters :
+        im :
+            PIL Image object
+        max_size :
+            Largest side of the image given to the segmentation, in pixels (By default : None, no limit)
+        line_height :
+            Spacing between lines of text wanted, in pixels, estimated with line_geometry.estimate_line_height()
+            (By default : None, no target)
+
+    Returns :
+        The factor, 1 if the image is segmented at full resolution
+    """
+    scale = 1.0
+    if max_size is not None:
+        scale = min(scale, max_size/max(im.size))
+    if line_height is not None:
+        # Estimated on a thumbnail, the profile doesn't need the full resolution
+        preview = im.convert("L")
+        preview.thumbnail((1000, 1000))
+        estimated = line_geometry.estimate_line_height(np.asarray(preview))
+        if estimated is not None:
+            scale = min(scale, line_height*preview.size[1]/(estimated*im.size[1]))
+    return scale
 
 
 @timeit
-def kraken_segment(im: Image) -> dict:
+def kraken_segment(im: Image, model_name: str = None, max_size: int = None, line_height: float = None) -> dict:
     """
     Fodder function, to allow @timeit on kraken.blla.segment()
+    The image can be downscaled before the segmentation, the lines are then scaled back to the coordinates of im
 
     Parameters :
         im :
             PIL Image object
+        model_name :
+            Name or path of the segmentation model, see model_registry.py
+            (By default : None, the default model of kraken)
+        max_size :
+            Largest side of the image segmented, see segmentation_scale() (By default : None, full resolution)
+        line_height :
+            Spacing between lines of the image segmented, see segmentation_scale() (By default : None, full resolution)
 
     Returns :
         Dictionnary produced by kraken.blla.segment()
     """
-    return blla.segment(im)
+    # The model is loaded once, instead of on every call of blla.segment() without model
+    model = get_segmentation_model(model_name)
+    scale = segmentation_scale(im, max_size, line_height)
+    if scale >= 1:
+        return blla.segment(im, model=model)
 
+    size = (max(1, round(im.size[0]*scale)), max(1, round(im.size[1]*scale)))
+    logger.debug("Segmenting at %dx%d instead of %dx%d" %
+                 (size+im.size))
+    with im.resize(size, Image.LANCZOS) as small:
+        segmentation = blla.segment(small, model=model)
+    return line_geometry.scale_segmentation(segmentation, im.size[0]/size[0], im.size[1]/size[1])
 
-@timeit
-def ocr_img(model: models.TorchSeqRecognizer, im: Image, baseline_seg: dict,  filename: str) -> list:
+
+def recognize(model: models.TorchSeqRecognizer, im: Image, baseline_seg: dict, batch_size: int = line_recognition.default_batch_size) -> list:
     """
-    Return and save result of applying prediction on an image
+    Apply prediction on an image, its lines are recognized by batches of similar widths (see line_recognition.py)
 
     Parameters :
         model :
@@ -48,138 +111,685 @@ def ocr_img(model: models.TorchSeqRecognizer, im: Image, baseline_seg: dict,  fi
             Image PIL object
         baseline_seg :
             Segmentation data obtained from blla.segment(im)
+        batch_size :
+            Largest number of lines recognized together (By default : line_recognition.default_batch_size)
+            1 recognizes the lines one by one, exactly as kraken.rpred.rpred()
+
+    Returns :
+        List of Predictions, the records produced by kraken.rpred.rpred()
+    """
+    lines = line_recognition.extract_lines(
+        im, baseline_seg, line_recognition.line_transforms(model))
+    return line_recognition.recognize_lines(model, lines, batch_size=batch_size)
+
+
+def filter_segmentation(baseline_seg: dict, page_width: int, line_filter: dict) -> dict:
+    """
+    Leave out the lines not worth recognizing (noise, ornaments, vertical artifacts), see line_geometry.filter_lines()
+
+    Parameters :
+        baseline_seg :
+            Segmentation data obtained from blla.segment(im)
+        page_width :
+            Width of the image, in pixels
+        line_filter :
+            Thresholds given to line_geometry.filter_lines(), see line_geometry.default_line_filter
+
+    Returns :
+        A copy of the segmentation holding only the lines kept, the segmentation given is left untouched
+    """
+    keep = line_geometry.filter_lines(
+        baseline_seg["lines"], page_width, **line_filter)
+    return dict(baseline_seg, lines=[line for line, kept in zip(baseline_seg["lines"], keep) if kept])
+
+
+def ocr_txt_path(filename: str) -> str:
+    """
+    Parameters :
+        filename :
+            Name of the image file
+
+    Returns :
+        Path to the txt file of the prediction of filename
+    """
+    return 'tmp'+os.sep+'ocr_result'+os.sep+filename[:-4]+'_ocr.txt'
+
+
+def ocr_saved(filename: str) -> bool:
+    """
+    Find if the prediction of an image is saved and intact, through the journal (see checkpoint.py)
+    Saves missing from the journal (made before it, or by a process killed before recording them) are recorded if they can be read,
+    else they are removed to be made again
+
+    Parameters :
+        filename :
+            Name of the image file
+
+    Returns :
+        True if the prediction is saved
+    """
+    if journal.is_done("ocr", filename):
+        return True
+    try:
+        if not ocr_store.ocr_exists(filename) or not os.path.exists(ocr_txt_path(filename)):
+            return False
+        ocr_store.load_ocr(filename)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile, pickle.UnpicklingError) as error:
+        logger.warning("Removed the corrupt prediction of " +
+                       filename+" : "+str(error))
+        for path in (ocr_store.ocr_path(filename), ocr_store.pickle_path(filename)):
+            if os.path.exists(path):
+                os.remove(path)
+        return False
+    journal.record("ocr", filename, [
+                   ocr_store.ocr_path(filename), ocr_txt_path(filename)])
+    return True
+
+
+def record_predictions(predictions: list, filename: str, keys: tuple, metadata: dict = None, cached: bool = False) -> None:
+    """
+    Save the prediction of an image (see save_predictions()), add it to the content cache and record it in the journal
+
+    Parameters :
+        predictions :
+            List of Predictions produce by kraken.rpred.rpred() (or of ocr_store.OCRLine)
         filename :
             Name of the image file
+        keys :
+            (segmentation_key, recognition_key) of the prediction, see page_keys()
+        metadata :
+            Information saved with the prediction, see save_predictions()
+        cached :
+            True if the prediction comes from the content cache, it isn't added again
 
     Returns :
-        List of Predictions produce by kraken.rpred.rpred()
+        None
     """
-    ocr_dir = 'tmp'+os.sep+'ocr_result'
-    os.makedirs(ocr_dir, exist_ok=True)
+    if not cached:
+        ocr_store.save_ocr(predictions, filename, path=content_cache.ocr_path(keys[1]),
+                           metadata=metadata)
+    save_predictions(predictions, filename, metadata)
+    content_cache.set_page_keys(filename, *keys)
+    journal.record("ocr", filename, [
+                   ocr_store.ocr_path(filename), ocr_txt_path(filename)])
 
-    # https://kraken.re/main/api.html#recognition
-    predictions = [record for record in rpred.rpred(model, im, baseline_seg)]
 
-    # Backup the ocr_record object to avoid time-consuming steps on relaunch
-    with open("tmp"+os.sep+"save"+os.sep+"ocr_save"+os.sep+filename+'_ocr.pickle', 'wb') as file:
-        pickle.dump(predictions, file)
+def save_predictions(predictions: list, filename: str, metadata: dict = None) -> None:
+    """
+    Save the result of the prediction of an image, as a txt file and arrays (see ocr_store.py)
+
+    Parameters :
+        predictions :
+            List of Predictions produce by kraken.rpred.rpred()
+        filename :
+            Name of the image file
+        metadata :
+            {"image_size", "model", "filtered_lines"} of the prediction, see ocr_store.save_ocr()
+            The size of the image is needed by the serialization (see export_ocr.py)
+
+    Returns :
+        None
+    """
+    ocr_filepath = ocr_txt_path(filename)
+    os.makedirs(os.path.dirname(ocr_filepath), exist_ok=True)
 
     # Also produce a txt file of the result from the prediction
-    ocr_filepath = ocr_dir+os.sep+filename[:-4]+'_ocr.txt'
-    with open(ocr_filepath, 'w', encoding='UTF-8', errors="ignore") as f:
-        for record in predictions:
-            f.write(record.prediction+"\n")
-        logger.info("Created "+ocr_filepath)
+    write_atomic(ocr_filepath, ''.join(
+        record.prediction+"\n" for record in predictions))
+    logger.info("Created "+ocr_filepath)
 
-    logger.debug("Saved ocr prediction into "+"tmp"+os.sep +
-                 "save"+os.sep+"ocr_save"+os.sep+filename+'_ocr.pickle')
+    # Backup the ocr_record objects to avoid time-consuming steps on relaunch
+    # It is written last, its presence indicates the image was processed
+    backup = ocr_store.save_ocr(predictions, filename, metadata=metadata)
+    logger.debug("Saved ocr prediction into "+backup)
 
-    return predictions
 
+def model_signature(recognition_model: str = None, segmentation_model: str = None, segmentation_params: dict = None,
+                    line_filter: dict = None) -> dict:
+    """
+    Identify the models and parameters of a run, results are reused only for the same signature
 
-@timeit
-def serialize_alto(image_filepath: str, predictions: list) -> str:
+    Parameters :
+        recognition_model :
+            Name or path of the recognition model, see model_registry.py
+        segmentation_model :
+            Name or path of the segmentation model, see model_registry.py
+        segmentation_params :
+            Parameters given to kraken_segment(), they change the result of the segmentation
+            (By default : None, no parameter)
+        line_filter :
+            Thresholds of line_geometry.filter_lines(), lines left out change the result of the recognition
+            (By default : None, every line is recognized)
+
+    Returns :
+        {"recognition_path", "segmentation_path", "recognition_hash", "segmentation_hash", "segmentation_params",
+        "recognition_params"}
+    """
+    recognition_path = recognition_model_path(recognition_model)
+    segmentation_path = segmentation_model_path(segmentation_model)
+    return {"recognition_path": recognition_path, "segmentation_path": segmentation_path,
+            "recognition_hash": content_cache.file_hash(recognition_path),
+            "segmentation_hash": content_cache.file_hash(segmentation_path),
+            "segmentation_params": segmentation_params or {},
+            "recognition_params": {"line_filter": line_filter} if line_filter else {}}
+
+
+def model_identity(signature: dict) -> dict:
     """
-    Serialize the result of the ocr prediction by Kraken
+    Parameters :
+        signature :
+            Signature of the run, see model_signature()
 
+    Returns :
+        {"name", "sha256"} of the recognition model, saved with each prediction
+    """
+    return {"name": os.path.basename(signature["recognition_path"]), "sha256": signature["recognition_hash"]}
+
+
+def page_keys(filepath: str, signature: dict) -> tuple:
+    """
     Parameters :
-        image_filepath :
+        filepath :
             Path to the image file
-        predictions :
-            List of ocr_record produced by Kraken's OCR
+        signature :
+            Signature of the run, see model_signature()
 
     Returns :
-        Text content of the ALTO produced
+        (segmentation_key, recognition_key) of the image, see content_cache.py
     """
-    im = Image.open(image_filepath)
-    alto = serialization.serialize(
-        predictions, image_name=image_filepath.split(os.sep)[-1], image_size=im.size, template="alto")
-    im.close()
-    return alto
+    segment_key = segmentation_key(content_cache.file_hash(filepath),
+                                   signature["segmentation_hash"], signature["segmentation_params"])
+    return segment_key, recognition_key(segment_key, signature["recognition_hash"], signature["recognition_params"])
+
+
+def saved_before_cache(filepath: str, filename: str, signature: dict, step: str = "recognition") -> bool:
+    """
+    Parameters :
+        filepath :
+            Path to the image file
+        filename :
+            Name of the image file
+        signature :
+            Signature of the run, see model_signature()
+        step :
+            "recognition" for the saved prediction, "segmentation" for the saved segmentation (see segment_store.py)
+            (By default : "recognition")
+
+    Returns :
+        True if the save of an image processed before the content cache is more recent than the image and the models
+        it depends on, it is then considered made from them
+    """
+    if step == "segmentation":
+        # The store doesn't date its segmentations, they are dated by their json of the previous format
+        # or else by the prediction made from them
+        json_path = None if segment_store.json_dir is None else \
+            segment_store.json_dir+os.sep+filename+"_segment.json"
+        path = json_path if json_path is not None and os.path.isfile(json_path) else ocr_store.ocr_path(filename)
+        if not os.path.isfile(path):
+            return False
+        dependencies = (filepath, signature["segmentation_path"])
+    else:
+        path = ocr_store.ocr_path(filename)
+        dependencies = (filepath, signature["recognition_path"], signature["segmentation_path"])
+    saved = os.path.getmtime(path)
+    return all(saved >= os.path.getmtime(dependency) for dependency in dependencies)
+
+
+def load_page(filepath: str, keys: tuple, signature: dict) -> dict:
+    """
+    First step of the processing of an image : find the steps already saved, read the saves and decode the image
+    Serializations (ALTO, PAGE XML) are made afterwards from the saves, see export_ocr.py
+    Saves are reused only if they were made from the same image content and models (see content_cache.py)
+
+    Parameters :
+        filepath :
+            Path to the image file
+        keys :
+            (segmentation_key, recognition_key) of the image, see page_keys()
+        signature :
+            Signature of the run, see model_signature()
+
+    Returns :
+        The page, a dictionnary given to the next steps (see process_page())
+    """
+    start = time.time()
+    filename = filepath.split(os.sep)[-1]
+    page = {"filepath": filepath, "filename": filename, "keys": keys, "im": None, "size": None,
+            "segmentation_params": signature["segmentation_params"], "model": model_identity(signature),
+            "line_filter": signature["recognition_params"].get("line_filter"), "filtered": None,
+            "segmentation": None, "predictions": None, "segmented": False, "ocr": False, "cached": False,
+            "stats": {"filename": filename, "segmented": False, "ocr": False, "cached": False, "filtered": 0,
+                      "times": {}}}
+
+    saved_keys = content_cache.page_keys(filename)
+    saved = ocr_saved(filename)
+    if saved and saved_keys is None and saved_before_cache(filepath, filename, signature):
+        # Adopt the prediction made before the content cache, shared with duplicates of the image
+        content_cache.set_page_keys(filename, *keys)
+        if not content_cache.has_ocr(keys[1]):
+            ocr_store.save_ocr(ocr_store.load_ocr(filename), filename, path=content_cache.ocr_path(keys[1]),
+                               metadata=ocr_store.load_metadata(filename))
+        if content_cache.get_segmentation(keys[0]) is None and saved_before_cache(filepath, filename, signature, "segmentation"):
+            segmentation = segment_store.get(filename)
+            if segmentation is not None:
+                content_cache.put_segmentation(keys[0], segmentation)
+        saved_keys = keys
+
+    if saved and saved_keys == keys:
+        # If the ocr result/predict_backup already exists, then there is no need to process the associated image
+        pass
+    elif content_cache.has_ocr(keys[1]):
+        # Same image content and models as another image already processed
+        logger.info("Reusing cached ocr of "+filepath)
+        page["cached"] = True
+        page["predictions"] = ocr_store.load_ocr(
+            filename, path=content_cache.ocr_path(keys[1]))
+        metadata = ocr_store.load_metadata(
+            filename, path=content_cache.ocr_path(keys[1]))
+        page["size"] = metadata["image_size"]
+        page["filtered"] = metadata["filtered_lines"]
+        page["segmentation"] = content_cache.get_segmentation(keys[0])
+    else:
+        if saved:
+            logger.info("Image or models changed since the last ocr of "+filename)
+        logger.info("Processing : "+filepath)
+        page["ocr"] = True
+        page["im"] = Image.open(filepath)
+        page["im"].load()
+        page["size"] = page["im"].size
+
+        # If the segmentation was already done for this image content, load it to save time
+        page["segmentation"] = content_cache.get_segmentation(keys[0])
+        if page["segmentation"] is None and saved_keys is None and saved_before_cache(filepath, filename, signature, "segmentation"):
+            # Adopt the segmentation made before the content cache
+            page["segmentation"] = segment_store.get(filename)
+            if page["segmentation"] is not None:
+                content_cache.put_segmentation(keys[0], page["segmentation"])
+        if page["segmentation"] is not None:
+            logger.debug("Loaded previous segmentation result of "+filename)
+
+    page["stats"]["times"]["decode"] = time.time()-start
+    return page
+
+
+def segment_page(page: dict, segmentation_model: str = None) -> dict:
+    """
+    Segment an image loaded by load_page(), if it has to be recognized and has no saved segmentation
+    The parameters of the segmentation are the ones of the signature given to load_page()
+    A new segmentation is saved at once (see segment_store.py and content_cache.py), it is kept if the recognition fails
+
+    Parameters :
+        page :
+            The page returned by load_page()
+        segmentation_model :
+            Name or path of the segmentation model, see model_registry.py
+
+    Returns :
+        The page
+    """
+    start = time.time()
+    if page["ocr"] and page["segmentation"] is None:
+        logger.debug("Starting segmentation")
+        page["segmentation"] = kraken_segment(
+            page["im"], segmentation_model, **page["segmentation_params"])
+        page["segmented"] = True
+        content_cache.put_segmentation(page["keys"][0], page["segmentation"])
+        segment_store.put(page["filename"], page["segmentation"])
+    page["stats"]["times"]["segmentation"] = time.time()-start
+    return page
+
+
+def recognize_page(page: dict, recognition_model: str = None) -> dict:
+    """
+    Apply prediction on an image segmented by segment_page()
+    If the line filter of the signature is set, the lines it leaves out are not recognized, they stay in the segmentation
+
+    Parameters :
+        page :
+            The page returned by segment_page()
+        recognition_model :
+            Name or path of the recognition model, see model_registry.py
+
+    Returns :
+        The page
+    """
+    start = time.time()
+    if page["ocr"]:
+        logger.debug("Starting prediction")
+        segmentation = page["segmentation"]
+        if page["line_filter"] is not None:
+            segmentation = filter_segmentation(
+                segmentation, page["size"][0], page["line_filter"])
+            page["filtered"] = len(
+                page["segmentation"]["lines"])-len(segmentation["lines"])
+            logger.debug("Filtered out "+str(page["filtered"])+" lines of "+page["filename"])
+        page["predictions"] = recognize(get_recognition_model(recognition_model),
+                                        page["im"], segmentation)
+    page["stats"]["times"]["ocr"] = time.time()-start
+    return page
+
+
+def write_page(page: dict) -> dict:
+    """
+    Last step of the processing of an image : save the prediction, and the segmentation if it wasn't made by segment_page()
+    New results are also added to the content cache (see content_cache.py)
+
+    Parameters :
+        page :
+            The page returned by recognize_page()
+
+    Returns :
+        Statistics of the page : {"filename", "segmented", "ocr", "cached", "filtered", "times": {step: seconds}}
+    """
+    start = time.time()
+    stats = page["stats"]
+    stats["segmented"] = page["segmented"]
+    if page["ocr"] or page["cached"]:
+        # A new segmentation is already saved, a reused one is saved under the name of this image
+        if page["segmentation"] is not None and not page["segmented"]:
+            segment_store.put(page["filename"], page["segmentation"])
+        record_predictions(page["predictions"], page["filename"], page["keys"],
+                           {"image_size": page["size"], "model": page["model"],
+                            "filtered_lines": page["filtered"]}, cached=page["cached"])
+        stats["ocr"] = page["ocr"]
+        stats["cached"] = page["cached"]
+        stats["filtered"] = page["filtered"] or 0
+
+    if page["im"] is not None:
+        page["im"].close()
+    stats["times"]["write"] = time.time()-start
+    stats["times"]["total"] = sum(stats["times"].values())
+    return stats
+
+
+def process_page(filepath: str, keys: tuple, signature: dict, recognition_model: str = None, segmentation_model: str = None) -> dict:
+    """
+    Apply segmentation and prediction to an image, skipping the steps already saved
+
+    Parameters :
+        filepath :
+            Path to the image file
+        keys :
+            (segmentation_key, recognition_key) of the image, see page_keys()
+        signature :
+            Signature of the run, see model_signature()
+        recognition_model :
+            Name or path of the recognition model, see model_registry.py
+        segmentation_model :
+            Name or path of the segmentation model, see model_registry.py
+
+    Returns :
+        Statistics of the page, see write_page()
+    """
+    page = load_page(filepath, keys, signature)
+    page = segment_page(page, segmentation_model)
+    page = recognize_page(page, recognition_model)
+    return write_page(page)
+
+
+def init_ocr_worker(recognition_model: str, segmentation_model: str, threads: int) -> None:
+    """
+    Initializer of the processes of process_images(), the models are loaded once per process
+
+    Parameters :
+        recognition_model :
+            Name or path of the recognition model, see model_registry.py
+        segmentation_model :
+            Name or path of the segmentation model, see model_registry.py
+        threads :
+            Number of torch intra-op threads of the process
+
+    Returns :
+        None
+    """
+    import torch
+    torch.set_num_threads(threads)
+    get_segmentation_model(segmentation_model)
+    get_recognition_model(recognition_model)
+
+
+def process_page_job(job: tuple) -> dict:
+    """
+    Wrapper of process_page() used by the process pool of process_images()
+
+    Parameters :
+        job :
+            Tuple (filepath, keys, signature, recognition_model, segmentation_model)
+
+    Returns :
+        Statistics of the page, see process_page()
+    """
+    return process_page(*job)
+
+
+def list_images(main_dir: str) -> list:
+    """
+    Parameters :
+        main_dir :
+            Directory in which images are located, subdirectories included
+
+    Returns :
+        List of the paths to the images
+    """
+    # All available extension, it may differ from what kraken can support
+    image_extension = (".jpg", ".png", ".svg", "jpeg")
+
+    filepaths = []
+    for (dirpath, subdirnames, filenames) in os.walk(main_dir):
+        for filename in filenames:
+            if not filename.lower().endswith(image_extension):
+             # skip non-image file
+                logger.debug("skipped this non-image file : "+filename)
+                continue
+            filepaths.append(dirpath+os.sep+filename)
+    return filepaths
 
 
 @timeit
-def process_images(main_dir: str) -> None:
+def process_images(main_dir: str, recognition_model: str = None, segmentation_model: str = None, workers: int = 1, threads: int = None, queue_size: int = 2, segmentation_size: int = None, segmentation_line_height: float = None, line_filter: dict = None, quantized: bool = False) -> None:
     """
     For all images in a directory, apply segmentation and prediction
+    Models are only loaded when a page needs them (see model_registry.py)
 
     Parameters :
         main_dir :
             Directory in which images are located
+        recognition_model :
+            Name or path of the recognition model (By default : None, the default model of model_registry.py)
+        segmentation_model :
+            Name or path of the segmentation model (By default : None, the default model of kraken)
+        workers :
+            Number of processes, each one loading the models once (By default : 1, no process pool is used)
+        threads :
+            Number of torch intra-op threads of each process
+            (By default : None, the cpus are divided between the processes, the default of torch in a single process)
+        queue_size :
+            Number of pages waiting between two steps of the pipeline, when there is a single process
+            It limits the number of decoded images held in memory (see pipeline.py)
+        segmentation_size :
+            Largest side of the images given to the segmentation, see segmentation_scale()
+            (By default : None, images are segmented at full resolution)
+        segmentation_line_height :
+            Spacing between lines of the images given to the segmentation, see segmentation_scale()
+            (By default : None, images are segmented at full resolution)
+        line_filter :
+            Thresholds of the lines left out of the recognition, see line_geometry.filter_lines()
+            (By default : None, every line is recognized)
+        quantized :
+            If True, the recognition model is replaced by its int8 quantized model, see quantization.py
 
     Returns :
         None
     """
     # Create output directories
-    os.makedirs("tmp"+os.sep+"save"+os.sep+"segment", exist_ok=True)
     os.makedirs("tmp"+os.sep+"save"+os.sep+"ocr_save", exist_ok=True)
-    os.makedirs("tmp"+os.sep+"save"+os.sep+"ocr_serialized", exist_ok=True)
-
-    # All available extension, it may differ from what kraken can support
-    image_extension = (".jpg", ".png", ".svg", "jpeg")
 
     # Statistics count
     ocr_count = 0
     segment_count = 0
     nb_img_processed = 0
 
-    for (dirpath, subdirnames, filenames) in os.walk(main_dir):
-        for filename in filenames:
-            if not filename.lower().endswith(image_extension):
-             # skip non-image file
-                logger.debug("skipped this non-image file : "+filename)
-                continue
+    filepaths = list_images(main_dir)
+
+    # The quantized model is made once, then the processes load it as any other model
+    if quantized:
+        recognition_model = quantize_model(recognition_model)
+
+    # Results are keyed by the content of the images and models, hashes are only computed for new or modified files
+    segmentation_params = {key: value for key, value in (("max_size", segmentation_size), ("line_height", segmentation_line_height))
+                           if value is not None}
+    signature = model_signature(
+        recognition_model, segmentation_model, segmentation_params, line_filter)
+    keys = {filepath: page_keys(filepath, signature)
+            for filepath in filepaths}
+
+    # Duplicates of an image are processed after it, they then reuse its cached result
+    first_pass, second_pass, seen = [], [], set()
+    for filepath in filepaths:
+        if keys[filepath][1] in seen:
+            second_pass.append(filepath)
+        else:
+            seen.add(keys[filepath][1])
+            first_pass.append(filepath)
+    if second_pass:
+        logger.info(str(len(second_pass)) +
+                    " images are duplicates of other ones, they are processed once")
+
+    pipeline = pool = None
+    if workers <= 1:
+        import torch
+        if threads is not None:
+            torch.set_num_threads(threads)
+        # Decoding, segmentation, recognition and writing of different pages overlap
+        pipeline = Pipeline([("decode", lambda filepath: load_page(filepath, keys[filepath], signature)),
+                             ("segmentation", partial(
+                                 segment_page, segmentation_model=segmentation_model)),
+                             ("recognition", partial(
+                                 recognize_page, recognition_model=recognition_model)),
+                             ("write", write_page)], queue_size=queue_size)
+
+        def run_pass(paths):
+            return pipeline.run(paths)
+    else:
+        # N processes x threads must not exceed the cpus, torch would otherwise oversubscribe them
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1)//workers)
+        logger.info("Processing images with "+str(workers) +
+                    " processes of "+str(threads)+" threads")
+
+        # Pages are pulled one by one from the queue of the pool, their duration varies a lot
+        pool = Pool(workers, initializer=init_ocr_worker,
+                    initargs=(recognition_model, segmentation_model, threads))
+
+        def run_pass(paths):
+            return pool.imap_unordered(process_page_job,
+                                       [(filepath, keys[filepath], signature, recognition_model, segmentation_model) for filepath in paths])
+
+    total_times = {}
+    cached_count = 0
+    filtered_count = 0
+    try:
+        for paths in (first_pass, second_pass):
+            for stats in run_pass(paths):
+                segment_count += stats["segmented"]
+                ocr_count += stats["ocr"]
+                cached_count += stats["cached"]
+                filtered_count += stats["filtered"]
+                for step, duration in stats["times"].items():
+                    total_times[step] = total_times.get(step, 0)+duration
+
+                nb_img_processed += 1
+                logger.debug("Done with "+stats["filename"]+" in %.2f sec, " % stats["times"]["total"]+str(nb_img_processed)+" images, a total of " + str(segment_count) +
+                             " segmentation and " + str(ocr_count) + " ocr were done")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if pipeline is not None:
+        pipeline.log_stats()
+    logger.info(str(cached_count)+" images reused the cached ocr of an identical image")
+    if line_filter is not None:
+        logger.info(str(filtered_count) +
+                    " lines were filtered out of the recognition")
+
+    logger.info("Processed "+str(nb_img_processed)+" images, time spent by step : " +
+                ", ".join("%s %.2f sec" % (step, duration) for step, duration in total_times.items()))
+
+
+def compare_segmentation(main_dir: str, modes: dict, segmentation_model: str = None, limit: int = 10, output: str = "tmp"+os.sep+"save"+os.sep+"segment_stats"+os.sep+"segmentation_modes.json") -> dict:
+    """
+    Segment the same images with several modes of kraken_segment() and compare the lines found and the time spent
+    Nothing is saved apart from the report
+
+    Parameters :
+        main_dir :
+            Directory in which images are located
+        modes :
+            Dictionnary associating the name of a mode -> parameters of kraken_segment() (i.e. {"max_size": 2000})
+        segmentation_model :
+            Name or path of the segmentation model, see model_registry.py
+        limit :
+            Number of images segmented (By default : 10)
+        output :
+            Path to the json report
 
-            filepath = dirpath+os.sep+filename
-            im = Image.open(filepath)
-
-            # Segmentation & Prediction
-
-            # Path to the saved data
-            predict_backup = "tmp"+os.sep+"save"+os.sep + \
-                "ocr_save"+os.sep+filename+'_ocr.pickle'
-            segment_save = "tmp"+os.sep+"save"+os.sep + \
-                "segment"+os.sep+filename+'_segment.json'
-            alto_xml_save = "tmp"+os.sep+"save"+os.sep + \
-                "ocr_serialized"+os.sep+filename+'_ocr.xml'
-
-            if os.path.exists(predict_backup) and os.path.isfile(predict_backup):
-                # If the ocr result/predict_backup already exists, then there is no need to process the associated image
-                if not os.path.exists(alto_xml_save):
-                    with open(predict_backup, 'rb') as file:
-                        predictions = pickle.load(file)
-
-            else:
-                logger.info("Processing : "+filepath)
-
-                # Segmentation
-                if os.path.exists(segment_save) and os.path.isfile(segment_save):
-                    # If the segment_save already exists
-                    # Load saved result to save time
-                    logger.debug(
-                        "Loading previous segmentation result "+segment_save)
-                    with open(segment_save, 'r', encoding='UTF-8', errors="ignore") as file:
-                        baseline_seg = ujson.load(file)
-                else:
-                    logger.debug("Starting segmentation")
-                    baseline_seg = kraken_segment(im)
-                    with open(segment_save, 'w', encoding='UTF-8', errors="ignore") as file:
-                        ujson.dump(baseline_seg, file, indent=4)
-                    segment_count += 1
-
-                # Prediction/OCR
-                logger.debug("Starting prediction")
-                predictions = ocr_img(model, im, baseline_seg, filename)
-                ocr_count += 1
-
-            # ALTO XML, predictions serialized format
-            if not os.path.exists(alto_xml_save):
-                logger.debug("Starting Serialization")
-                alto = serialize_alto(filepath, predictions)
-                with open(alto_xml_save, 'w', encoding="UTF-8", errors="ignore") as fp:
-                    fp.write(alto)
-
-            nb_img_processed += 1
-            im.close()
-            logger.debug("Done with "+filename+", "+str(nb_img_processed)+" images, a total of " + str(segment_count) +
-                         " segmentation and " + str(ocr_count) + " ocr were done")
+    Returns :
+        The report : {mode: {"params", "seconds", "lines", "lines_difference", "pages": {filename: {"seconds", "lines"}}}}
+        lines_difference being the total of the differences of line count with the first mode, page by page
+    """
+    filepaths = sorted(list_images(main_dir))[:limit]
+    report = {name: {"params": params, "seconds": 0.0, "lines": 0, "lines_difference": 0, "pages": {}}
+              for name, params in modes.items()}
+
+    # Loaded before, so it isn't timed with the first mode
+    get_segmentation_model(segmentation_model)
+    reference = next(iter(modes))
+    for filepath in filepaths:
+        filename = filepath.split(os.sep)[-1]
+        with Image.open(filepath) as im:
+            im.load()
+            for name, params in modes.items():
+                start = time.time()
+                segmentation = kraken_segment(im, segmentation_model, **params)
+                page = {"seconds": time.time()-start,
+                        "lines": len(segmentation["lines"])}
+                report[name]["pages"][filename] = page
+                report[name]["seconds"] += page["seconds"]
+                report[name]["lines"] += page["lines"]
+                report[name]["lines_difference"] += abs(
+                    page["lines"]-report[reference]["pages"][filename]["lines"])
+
+    for name, result in report.items():
+        logger.info("Segmentation %s : %d images in %.2f sec, %d lines, %d lines of difference with %s" %
+                    (name, len(filepaths), result["seconds"], result["lines"], result["lines_difference"], reference))
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    write_atomic(output, json.dumps(report, indent=4))
+    logger.info("Saved the comparison of segmentations into "+output)
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Compare the line count and the time of the segmentation at full resolution and downscaled")
+    parser.add_argument("image_dir", nargs="?", default="tmp"+os.sep+"extract_image",
+                        help="Directory where images are located (default : tmp/extract_image)")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[2500, 1800],
+                        help="Largest sides of the images compared (default : 2500 1800)")
+    parser.add_argument("--line-heights", type=float, nargs="*", default=[],
+                        help="Spacings between lines of the images compared, in pixels")
+    parser.add_argument("--limit", type=int, default=10,
+                        help="Number of images segmented (default : 10)")
+    parser.add_argument("--segmentation-model", default=None,
+                        help="Name (in models/) or path of the segmentation model (default : kraken's blla model)")
+    args = parser.parse_args()
+
+    logger = setup_logger()
+    modes = {"full": {}}
+    modes.update({"size_"+str(size): {"max_size": size}
+                 for size in args.sizes})
+    modes.update({"line_height_"+str(height): {"line_height": height}
+                 for height in args.line_heights})
+    compare_segmentation(args.image_dir, modes,
+                         args.segmentation_model, args.limit)
@@ -0,0 +1,245 @@
+"""
+quantization.py: Contains the dynamic int8 quantization of the recognition models, for the inference on cpu,
+and the report comparing the quantized model to the original one on the pairs text/image of the alignments
+
+The recurrent and linear layers are quantized, their weights are stored in int8 and their activations are quantized
+on the fly, the convolutions stay in float32. The quantized model is saved next to the original one (.int8.pt)
+and given to process_images.py like any other model, its results are cached apart from the ones of the original
+
+Usage : quantization.py [pairs_dir] [--model NAME] [--sample N] [--threads N] [--output PATH]
+"""
+
+import os
+import io
+import json
+import time
+import argparse
+import distance
+import line_recognition
+from PIL import Image
+from checkpoint import file_checksum, write_atomic, unfinished_suffix
+from crop_writer import crop_formats
+from model_registry import recognition_model_path, get_recognition_model
+from monitoring import setup_logger
+import logging
+logger = logging.getLogger("TIA_logger")
+
+# Extension of the quantized models, replacing the one of the original model
+quantized_suffix = ".int8.pt"
+
+quantization_report_path = "tmp"+os.sep+"save"+os.sep+"quantization_report.json"
+
+# The quantized model is recommended if its character error rate doesn't increase more than max_cer_delta
+# and it recognizes at least min_speedup times more lines per second
+max_cer_delta = 0.005
+min_speedup = 1.1
+
+
+def quantized_model_path(name: str = None) -> str:
+    """
+    Parameters:
+        name :
+            Name or path of the original recognition model, see model_registry.py
+
+    Returns:
+        Path to its quantized model, next to it
+    """
+    path = recognition_model_path(name)
+    if path.endswith(quantized_suffix):
+        return path
+    return os.path.splitext(path)[0]+quantized_suffix
+
+
+def quantize_model(name: str = None) -> str:
+    """
+    Quantize a recognition model, the quantized model is saved once and made again only if the original changes
+
+    Parameters:
+        name :
+            Name or path of the original recognition model, see model_registry.py
+            (By default : None, the default model of model_registry.py)
+
+    Returns:
+        Path to the quantized model, it can be given as recognition model to process_images.py
+    """
+    import torch
+    from kraken.lib import models
+
+    source = recognition_model_path(name)
+    path = quantized_model_path(name)
+    if path == source:
+        return path
+    source_hash = file_checksum(source)
+    if os.path.exists(path):
+        try:
+            if torch.load(path, map_location="cpu")["source_sha256"] == source_hash:
+                return path
+        except Exception as error:
+            logger.warning("Corrupt quantized model "+path+" : "+str(error))
+        logger.info("Quantizing again "+source+", it changed since "+path)
+
+    start = time.time()
+    model = models.load_any(source)
+    model.nn.nn = torch.quantization.quantize_dynamic(
+        model.nn.nn, {torch.nn.LSTM, torch.nn.GRU, torch.nn.Linear}, dtype=torch.qint8)
+    buffer = io.BytesIO()
+    torch.save({"source_sha256": source_hash, "model": model.nn}, buffer)
+    write_atomic(path, buffer.getvalue(), binary=True)
+    logger.info("Quantized %s into %s in %.2f sec (%.1f MB -> %.1f MB)" %
+                (source, path, time.time()-start, os.path.getsize(source)/2**20, os.path.getsize(path)/2**20))
+    return path
+
+
+def load_quantized(path: str):
+    """
+    Load a model saved by quantize_model(), used by model_registry.get_recognition_model()
+
+    Parameters:
+        path :
+            Path to the quantized model
+
+    Returns:
+        The kraken TorchSeqRecognizer
+    """
+    import torch
+    from kraken.lib import models
+    saved = torch.load(path, map_location="cpu")
+    return models.TorchSeqRecognizer(saved["model"], train=False)
+
+
+def list_pairs(pairs_dir: str, sample: int = None) -> list:
+    """
+    Parameters:
+        pairs_dir :
+            Folder of the pairs text/image, one sub-folder per page (see align.py)
+        sample :
+            Number of pairs kept, the first ones in alphabetical order (By default : None, every pair)
+
+    Returns:
+        List of (image path, text) of the pairs
+    """
+    pairs = []
+    for root, _, files in os.walk(pairs_dir):
+        # Pages whose pairs are still being written
+        if root.endswith(unfinished_suffix):
+            continue
+        for file in files:
+            if not file.endswith(tuple("."+image_format for image_format in crop_formats)):
+                continue
+            text_path = root+os.sep+file.split(".")[0]+".gt.txt"
+            if os.path.exists(text_path):
+                pairs.append((root+os.sep+file, text_path))
+    pairs.sort()
+    if sample is not None:
+        pairs = pairs[:sample]
+
+    texts = []
+    for _, text_path in pairs:
+        with open(text_path, encoding="UTF-8") as file:
+            texts.append(file.read().strip())
+    return [(image_path, text) for (image_path, _), text in zip(pairs, texts)]
+
+
+def evaluate(model, pairs: list) -> dict:
+    """
+    Recognize the line images of the pairs and compare the predictions to their texts
+
+    Parameters:
+        model :
+            The kraken TorchSeqRecognizer
+        pairs :
+            List of (image path, text), see list_pairs()
+
+    Returns:
+        {"cer", "lines_per_second", "seconds"}, the time only counting the recognition
+    """
+    transforms = line_recognition.line_transforms(model)
+    lines = []
+    for image_path, _ in pairs:
+        with Image.open(image_path) as im:
+            width, height = im.size
+            # Each image is a whole line, its coordinates only matter to the record
+            coords = {"baseline": [[0, height//2], [width, height//2]],
+                      "boundary": [[0, 0], [width, 0], [width, height], [0, height]]}
+            lines.append(line_recognition.LineImage(
+                coords, transforms(im), width))
+
+    # The first batch pays for the allocations of torch
+    line_recognition.recognize_lines(model, lines[:line_recognition.default_batch_size])
+    start = time.time()
+    records = line_recognition.recognize_lines(model, lines)
+    seconds = time.time()-start
+
+    errors = sum(distance.levenshtein(record.prediction, text)
+                 for record, (_, text) in zip(records, pairs))
+    characters = sum(len(text) for _, text in pairs)
+    return {"cer": errors/max(1, characters), "lines_per_second": len(lines)/max(seconds, 1e-6), "seconds": seconds}
+
+
+def quantization_report(pairs_dir: str, recognition_model: str = None, sample: int = 500, threads: int = None,
+                        output: str = quantization_report_path) -> dict:
+    """
+    Compare the quantized model to the original one, on the same pairs text/image
+
+    Parameters:
+        pairs_dir :
+            Folder of the pairs text/image, see list_pairs()
+        recognition_model :
+            Name or path of the original recognition model (By default : None, the default model of model_registry.py)
+        sample :
+            Number of pairs recognized (By default : 500)
+        threads :
+            Number of torch threads (By default : None, the default of torch)
+        output :
+            Path to the json report
+
+    Returns:
+        The report : {"model", "quantized", "pairs", "float32", "int8", "cer_delta", "speedup", "recommended"},
+        float32 and int8 being the results of evaluate()
+    """
+    import torch
+    if threads is not None:
+        torch.set_num_threads(threads)
+    pairs = list_pairs(pairs_dir, sample)
+    if not pairs:
+        raise FileNotFoundError("No pair text/image found in "+pairs_dir)
+
+    quantized = quantize_model(recognition_model)
+    report = {"model": recognition_model_path(recognition_model), "quantized": quantized, "pairs": len(pairs),
+              "threads": torch.get_num_threads(),
+              "float32": evaluate(get_recognition_model(recognition_model), pairs),
+              "int8": evaluate(get_recognition_model(quantized), pairs)}
+    report["cer_delta"] = report["int8"]["cer"]-report["float32"]["cer"]
+    report["speedup"] = report["int8"]["lines_per_second"] / \
+        report["float32"]["lines_per_second"]
+    report["recommended"] = report["cer_delta"] <= max_cer_delta and report["speedup"] >= min_speedup
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    write_atomic(output, json.dumps(report, indent=4))
+    logger.info("%d pairs : float32 CER %.4f %.1f lines/sec, int8 CER %.4f %.1f lines/sec (CER %+.4f, x%.2f), quantization %s" %
+                (len(pairs), report["float32"]["cer"], report["float32"]["lines_per_second"],
+                 report["int8"]["cer"], report["int8"]["lines_per_second"], report["cer_delta"], report["speedup"],
+                 "recommended" if report["recommended"] else "not recommended"))
+    logger.info("Saved the report into "+output)
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Quantize the recognition model and compare it to the original on the pairs text/image")
+    parser.add_argument("pairs_dir", nargs="?", default="tmp"+os.sep+"cropped_match",
+                        help="Directory of the pairs text/image (default : tmp/cropped_match)")
+    parser.add_argument("--model", default=None,
+                        help="Name (in models/) or path of the recognition model (default : HTR-United-Manu_McFrench)")
+    parser.add_argument("--sample", type=int, default=500,
+                        help="Number of pairs recognized by each model (default : 500)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Number of torch threads (default : torch's default)")
+    parser.add_argument("--output", default=quantization_report_path,
+                        help="Path to the json report (default : tmp/save/quantization_report.json)")
+    args = parser.parse_args()
+
+    logger = setup_logger()
+    quantization_report(args.pairs_dir, args.model,
+                        args.sample, args.threads, args.output)
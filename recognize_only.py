@@ -0,0 +1,287 @@
+"""
+recognize_only.py: Contains the recognition of images already segmented with another recognition model,
+i.e. after a training round, the stored segmentation is reused and left untouched
+
+The lines of several pages are extracted together, while the previous pages are recognized (see pipeline.py)
+The predictions replace the ones of tmp/save/ocr_save/ and tmp/ocr_result/, tagged with the identity of the model
+
+Usage : recognize_only.py [image_dir] [--model NAME] [--workers N] [--threads N] [--pages-per-batch N] [--filter-lines] [--quantized]
+"""
+
+from PIL import Image
+from multiprocessing import Pool
+from functools import partial
+import os
+import time
+import argparse
+import ocr_store
+import line_recognition
+import line_geometry
+from pipeline import Pipeline
+from content_cache import recognition_key
+from quantization import quantize_model
+from model_registry import get_recognition_model
+from process_images import (content_cache, segment_store, list_images, model_signature, model_identity, page_keys,
+                            ocr_saved, record_predictions, filter_segmentation, init_ocr_worker)
+from monitoring import timeit, setup_logger
+import logging
+logger = logging.getLogger("TIA_logger")
+
+
+def plan_page(filepath: str, signature: dict):
+    """
+    Find what has to be done for an image, the prediction is restored at once if the content cache has it
+
+    Parameters :
+        filepath :
+            Path to the image file
+        signature :
+            Signature of the run, see process_images.model_signature()
+
+    Returns :
+        (filepath, keys) if the image has to be recognized, else "done", "cached" or "unsegmented"
+    """
+    filename = filepath.split(os.sep)[-1]
+    saved_keys = content_cache.page_keys(filename)
+
+    # The segmentation stays the one the image was processed with
+    segment_key = saved_keys[0] if saved_keys is not None else page_keys(
+        filepath, signature)[0]
+    keys = (segment_key, recognition_key(
+        segment_key, signature["recognition_hash"], signature["recognition_params"]))
+
+    if saved_keys == keys and ocr_saved(filename):
+        return "done"
+    if content_cache.has_ocr(keys[1]):
+        path = content_cache.ocr_path(keys[1])
+        metadata = dict(ocr_store.load_metadata(filename, path=path),
+                        model=model_identity(signature))
+        record_predictions(ocr_store.load_ocr(filename, path=path),
+                           filename, keys, metadata, cached=True)
+        return "cached"
+    if filename not in segment_store:
+        logger.warning("No segmentation of "+filename +
+                       ", it has to be processed by process_images.py")
+        return "unsegmented"
+    return filepath, keys
+
+
+def load_batch(jobs: list, recognition_model: str = None, line_filter: dict = None) -> list:
+    """
+    First step of a batch of images : decode them, read their segmentation and extract their lines
+    The lines left out by the line filter are not extracted, the stored segmentation is left untouched
+
+    Parameters :
+        jobs :
+            List of (filepath, keys) returned by plan_page()
+        recognition_model :
+            Name or path of the recognition model, its input shape defines the transforms of the lines
+        line_filter :
+            Thresholds given to line_geometry.filter_lines() (By default : None, every line is recognized)
+
+    Returns :
+        List of pages {"filepath", "filename", "keys", "size", "filtered", "lines"}
+    """
+    transforms = line_recognition.line_transforms(
+        get_recognition_model(recognition_model))
+    filenames = [filepath.split(os.sep)[-1] for filepath, _ in jobs]
+    segmentations = segment_store.get_many(filenames)
+
+    pages = []
+    for (filepath, keys), filename in zip(jobs, filenames):
+        with Image.open(filepath) as im:
+            im.load()
+            segmentation, filtered = segmentations[filename], None
+            if line_filter is not None:
+                segmentation = filter_segmentation(
+                    segmentation, im.size[0], line_filter)
+                filtered = len(
+                    segmentations[filename]["lines"])-len(segmentation["lines"])
+                logger.debug("Filtered out "+str(filtered) +
+                             " lines of "+filename)
+            pages.append({"filepath": filepath, "filename": filename, "keys": keys, "size": im.size, "filtered": filtered,
+                          "lines": line_recognition.extract_lines(im, segmentation, transforms)})
+    return pages
+
+
+def recognize_batch(pages: list, recognition_model: str = None) -> list:
+    """
+    Recognize the lines of a batch of pages together
+
+    Parameters :
+        pages :
+            Pages returned by load_batch()
+        recognition_model :
+            Name or path of the recognition model
+
+    Returns :
+        The pages, with their "predictions"
+    """
+    lines = [line for page in pages for line in page["lines"]]
+    records = line_recognition.recognize_lines(
+        get_recognition_model(recognition_model), lines)
+
+    position = 0
+    for page in pages:
+        page["predictions"] = records[position:position+len(page["lines"])]
+        position += len(page["lines"])
+        del page["lines"]
+    return pages
+
+
+def write_batch(pages: list, model: dict) -> int:
+    """
+    Save the predictions of a batch of pages, see process_images.record_predictions()
+
+    Parameters :
+        pages :
+            Pages returned by recognize_batch()
+        model :
+            Identity of the recognition model, see process_images.model_identity()
+
+    Returns :
+        Number of lines recognized
+    """
+    for page in pages:
+        record_predictions(page["predictions"], page["filename"], page["keys"],
+                           {"image_size": page["size"], "model": model, "filtered_lines": page["filtered"]})
+    return sum(len(page["predictions"]) for page in pages)
+
+
+def recognize_batch_job(job: tuple) -> int:
+    """
+    Process a batch of pages in a process of the pool of recognize_images()
+
+    Parameters :
+        job :
+            Tuple (jobs, recognition_model, model, line_filter), see load_batch() and write_batch()
+
+    Returns :
+        Number of lines recognized
+    """
+    jobs, recognition_model, model, line_filter = job
+    return write_batch(recognize_batch(load_batch(jobs, recognition_model, line_filter), recognition_model), model)
+
+
+@timeit
+def recognize_images(main_dir: str, recognition_model: str = None, segmentation_model: str = None, workers: int = 1,
+                     threads: int = None, pages_per_batch: int = 8, queue_size: int = 2, line_filter: dict = None, quantized: bool = False) -> dict:
+    """
+    Recognize again every image of a directory with a recognition model, reusing their stored segmentation
+    Images already recognized by this model are skipped
+
+    Parameters :
+        main_dir :
+            Directory in which images are located
+        recognition_model :
+            Name or path of the recognition model (By default : None, the default model of model_registry.py)
+        segmentation_model :
+            Name or path of the segmentation model, only used for images processed before the content cache
+        workers :
+            Number of processes (By default : 1, the batches go through a pipeline of threads)
+        threads :
+            Number of torch intra-op threads of each process
+            (By default : None, the cpus are divided between the processes)
+        pages_per_batch :
+            Number of pages whose lines are extracted and recognized together (By default : 8)
+        queue_size :
+            Number of batches waiting between two steps of the pipeline, when there is a single process
+        line_filter :
+            Thresholds of the lines left out of the recognition, see line_geometry.filter_lines()
+            (By default : None, every line is recognized)
+        quantized :
+            If True, the recognition model is replaced by its int8 quantized model, see quantization.py
+
+    Returns :
+        Number of images by outcome : {"recognized", "cached", "done", "unsegmented", "lines"}
+    """
+    if quantized:
+        recognition_model = quantize_model(recognition_model)
+    signature = model_signature(
+        recognition_model, segmentation_model, line_filter=line_filter)
+    model = model_identity(signature)
+    logger.info("Recognizing with "+model["name"] +
+                " ("+model["sha256"][:12]+")")
+
+    counts = {"recognized": 0, "cached": 0,
+              "done": 0, "unsegmented": 0, "lines": 0}
+    jobs, duplicates, seen = [], [], set()
+    for filepath in list_images(main_dir):
+        plan = plan_page(filepath, signature)
+        if isinstance(plan, str):
+            counts[plan] += 1
+        elif plan[1][1] in seen:
+            # Restored from the content cache once its first occurrence is recognized
+            duplicates.append(filepath)
+        else:
+            seen.add(plan[1][1])
+            jobs.append(plan)
+    batches = [jobs[start:start+pages_per_batch]
+               for start in range(0, len(jobs), pages_per_batch)]
+
+    start = time.time()
+    pool = pipeline = None
+    if workers <= 1:
+        import torch
+        if threads is not None:
+            torch.set_num_threads(threads)
+        # Next batches are decoded and extracted while the current one is recognized
+        pipeline = Pipeline([("extract", partial(load_batch, recognition_model=recognition_model, line_filter=line_filter)),
+                             ("recognition", partial(
+                                 recognize_batch, recognition_model=recognition_model)),
+                             ("write", partial(write_batch, model=model))], queue_size=queue_size)
+        results = pipeline.run(batches)
+    else:
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1)//workers)
+        pool = Pool(workers, initializer=init_ocr_worker,
+                    initargs=(recognition_model, segmentation_model, threads))
+        results = pool.imap_unordered(recognize_batch_job,
+                                      [(batch, recognition_model, model, line_filter) for batch in batches])
+
+    try:
+        for lines in results:
+            counts["lines"] += lines
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if pipeline is not None:
+        pipeline.log_stats()
+    counts["recognized"] = len(jobs)
+    for filepath in duplicates:
+        counts[plan_page(filepath, signature)] += 1
+
+    logger.info("Recognized %d images (%d lines, %.2f lines/sec), %d reused from the content cache, %d already done, %d without segmentation" %
+                (counts["recognized"], counts["lines"], counts["lines"]/max(time.time()-start, 1e-6),
+                 counts["cached"], counts["done"], counts["unsegmented"]))
+    return counts
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Recognize again the images already segmented, with another recognition model")
+    parser.add_argument("image_dir", nargs="?", default="tmp"+os.sep+"extract_image",
+                        help="Directory where images are located (default : tmp/extract_image)")
+    parser.add_argument("--model", default=None,
+                        help="Name (in models/) or path of the recognition model (default : HTR-United-Manu_McFrench)")
+    parser.add_argument("--segmentation-model", default=None,
+                        help="Segmentation model of the images processed before the content cache (default : kraken's blla model)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes recognizing in parallel (default : 1)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Number of torch threads of each process (default : cpus divided by --workers)")
+    parser.add_argument("--pages-per-batch", type=int, default=8,
+                        help="Number of pages whose lines are recognized together (default : 8)")
+    parser.add_argument("--filter-lines", action="store_true",
+                        help="Don't recognize the lines too narrow, too small or vertical (see line_geometry.default_line_filter)")
+    parser.add_argument("--quantized", action="store_true",
+                        help="Recognize with the int8 quantized model (see quantization.py)")
+    args = parser.parse_args()
+
+    logger = setup_logger()
+    recognize_images(args.image_dir, args.model, args.segmentation_model,
+                     args.workers, args.threads, args.pages_per_batch,
+                     line_filter=line_geometry.default_line_filter if args.filter_lines else None,
+                     quantized=args.quantized)
@@ -0,0 +1,300 @@
+"""
+segment_store.py: Contains the SegmentStore, saving the segmentation of every image in a single SQLite file
+
+Usage : segment_store.py export [output_dir]
+        Write every segmentation of the store as a json file (the format of tmp/save/segment/)
+        segment_store.py import [json_dir]
+        Add every json file of json_dir (By default : tmp/save/segment/) into the store
+"""
+
+import numpy as np
+import os
+import sys
+import sqlite3
+import zlib
+import ujson
+from checkpoint import ThreadConnections
+import logging
+logger = logging.getLogger("TIA_logger")
+
+segment_store_path = "tmp"+os.sep+"save"+os.sep+"segment.sqlite"
+
+# Folder of the json files of the segmentation, the format used before the store
+segment_json_dir = "tmp"+os.sep+"save"+os.sep+"segment"
+
+
+def encode_segmentation(segmentation: dict) -> tuple:
+    """
+    Encode the result of blla.segment() : polygons are packed into a binary array, everything else stays json
+
+    Parameters:
+        segmentation :
+            Dictionnary produced by kraken.blla.segment()
+
+    Returns:
+        (header, points, lengths), the json header and the compressed bytes of the points and of the polygon lengths
+    """
+    polygons = []
+    header = {key: value for key, value in segmentation.items()
+              if key not in ("lines", "regions")}
+
+    # Lines keep their other keys (i.e. tags), their baseline and boundary are packed
+    header["lines"] = []
+    for line in segmentation.get("lines", []):
+        header["lines"].append({key: value for key, value in line.items()
+                                if key not in ("baseline", "boundary")})
+        polygons.append(line.get("baseline"))
+        polygons.append(line.get("boundary"))
+
+    header["regions"] = []
+    for region_type, regions in segmentation.get("regions", {}).items():
+        header["regions"].append([region_type, len(regions)])
+        polygons.extend(regions)
+
+    # -1 marks a missing polygon
+    lengths = np.array([-1 if polygon is None else len(polygon)
+                        for polygon in polygons], dtype=np.int32)
+    points = np.array([point for polygon in polygons if polygon is not None for point in polygon],
+                      dtype=np.float64).reshape(-1, 2)
+
+    # Coordinates are integers for kraken, floats are kept if there is any
+    if np.array_equal(points, np.rint(points)) and (len(points) == 0 or np.abs(points).max() < 2**31):
+        header["dtype"] = "int32"
+        points = points.astype(np.int32)
+    else:
+        header["dtype"] = "float64"
+
+    return ujson.dumps(header), zlib.compress(points.tobytes()), zlib.compress(lengths.tobytes())
+
+
+def decode_segmentation(header: str, points: bytes, lengths: bytes) -> dict:
+    """
+    Decode a segmentation encoded by encode_segmentation()
+
+    Parameters:
+        header :
+            The json header
+        points :
+            Compressed bytes of the points
+        lengths :
+            Compressed bytes of the polygon lengths
+
+    Returns:
+        Dictionnary in the format of kraken.blla.segment()
+    """
+    header = ujson.loads(header)
+    dtype = header.pop("dtype")
+    points = np.frombuffer(zlib.decompress(points),
+                           dtype=dtype).reshape(-1, 2).tolist()
+    lengths = np.frombuffer(zlib.decompress(lengths), dtype=np.int32).tolist()
+
+    polygons = []
+    position = 0
+    for length in lengths:
+        if length < 0:
+            polygons.append(None)
+        else:
+            polygons.append(points[position:position+length])
+            position += length
+
+    segmentation = {key: value for key, value in header.items()
+                    if key not in ("lines", "regions")}
+    segmentation["lines"] = []
+    for i, line in enumerate(header["lines"]):
+        line["baseline"] = polygons[2*i]
+        line["boundary"] = polygons[2*i+1]
+        segmentation["lines"].append(line)
+
+    position = 2*len(header["lines"])
+    segmentation["regions"] = {}
+    for region_type, count in header["regions"]:
+        segmentation["regions"][region_type] = polygons[position:position+count]
+        position += count
+    return segmentation
+
+
+class SegmentStore:
+    """
+    Segmentation of every image in a single SQLite file, keyed by image filename
+    The file can be read and written by several processes and threads, each one opens its own connection
+
+    Attributes:
+        path :
+            Path to the SQLite file
+        json_dir :
+            Folder of the json files of the previous format, an image missing from the store is imported from it
+    """
+
+    def __init__(self, path: str = segment_store_path, json_dir: str = segment_json_dir) -> None:
+        self.path = path
+        self.json_dir = json_dir
+        self._connections = ThreadConnections(path, ["""CREATE TABLE IF NOT EXISTS segments (
+            image TEXT PRIMARY KEY, header TEXT, points BLOB, lengths BLOB)"""])
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Returns:
+            The connection of the current thread, see checkpoint.ThreadConnections
+        """
+        return self._connections.get()
+
+    def _json_path(self, image: str) -> str:
+        return self.json_dir+os.sep+image+"_segment.json"
+
+    def put_many(self, segmentations: dict) -> None:
+        """
+        Save several segmentations in a single transaction
+
+        Parameters:
+            segmentations :
+                Dictionnary associating image filename -> segmentation
+
+        Returns:
+            None
+        """
+        rows = [(image,)+encode_segmentation(segmentation)
+                for image, segmentation in segmentations.items()]
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)", rows)
+
+    def put(self, image: str, segmentation: dict) -> None:
+        """
+        Save the segmentation of an image
+
+        Parameters:
+            image :
+                Image filename
+            segmentation :
+                Dictionnary produced by kraken.blla.segment()
+
+        Returns:
+            None
+        """
+        self.put_many({image: segmentation})
+
+    def get_many(self, images: list) -> dict:
+        """
+        Read the segmentations of several images, in batches of queries
+
+        Parameters:
+            images :
+                List of image filenames
+
+        Returns:
+            Dictionnary associating image filename -> segmentation, images without segmentation are missing
+        """
+        connection = self._connect()
+        result = {}
+        images = list(images)
+
+        # SQLite limits the number of parameters of a query
+        for start in range(0, len(images), 500):
+            batch = images[start:start+500]
+            rows = connection.execute("SELECT image, header, points, lengths FROM segments WHERE image IN (" +
+                                      ",".join("?"*len(batch))+")", batch).fetchall()
+            for image, header, points, lengths in rows:
+                result[image] = decode_segmentation(header, points, lengths)
+
+        # Images segmented before the store are imported from their json
+        imported = {}
+        for image in images:
+            if image not in result and self.json_dir is not None and os.path.isfile(self._json_path(image)):
+                with open(self._json_path(image), "r", encoding="UTF-8", errors="ignore") as file:
+                    imported[image] = ujson.load(file)
+        if imported:
+            self.put_many(imported)
+            result.update(imported)
+        return result
+
+    def get(self, image: str):
+        """
+        Read the segmentation of an image
+
+        Parameters:
+            image :
+                Image filename
+
+        Returns:
+            The segmentation, or None if the image has none
+        """
+        return self.get_many([image]).get(image)
+
+    def __contains__(self, image: str) -> bool:
+        row = self._connect().execute(
+            "SELECT 1 FROM segments WHERE image = ?", (image,)).fetchone()
+        return row is not None or (self.json_dir is not None and os.path.isfile(self._json_path(image)))
+
+    def images(self) -> list:
+        """
+        Returns:
+            List of the image filenames in the store
+        """
+        return [row[0] for row in self._connect().execute("SELECT image FROM segments ORDER BY image")]
+
+    def export_json(self, output_dir: str, images: list = None) -> int:
+        """
+        Write segmentations as json files, in the format used before the store
+
+        Parameters:
+            output_dir :
+                Folder where the files are written
+            images :
+                List of image filenames to export (By default : None, every image of the store)
+
+        Returns:
+            Number of files written
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        images = self.images() if images is None else images
+        count = 0
+        for start in range(0, len(images), 500):
+            for image, segmentation in self.get_many(images[start:start+500]).items():
+                with open(output_dir+os.sep+image+"_segment.json", 'w', encoding='UTF-8', errors="ignore") as file:
+                    ujson.dump(segmentation, file, indent=4)
+                count += 1
+        return count
+
+    def import_json(self, json_dir: str) -> int:
+        """
+        Add every json file of a folder into the store
+
+        Parameters:
+            json_dir :
+                Folder of the json files (named <image>_segment.json)
+
+        Returns:
+            Number of segmentations added
+        """
+        segmentations = {}
+        for file in sorted(os.listdir(json_dir)):
+            if file.endswith("_segment.json"):
+                with open(json_dir+os.sep+file, "r", encoding="UTF-8", errors="ignore") as f:
+                    segmentations[file[:-len("_segment.json")]] = ujson.load(f)
+        self.put_many(segmentations)
+        return len(segmentations)
+
+    def close(self) -> None:
+        """
+        Close the connection of the current thread
+
+        Returns:
+            None
+        """
+        self._connections.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ("export", "import"):
+        print(__doc__)
+        sys.exit()
+    store = SegmentStore()
+    if sys.argv[1] == "export":
+        output_dir = sys.argv[2] if len(sys.argv) == 3 else segment_json_dir
+        print("Exported "+str(store.export_json(output_dir)) +
+              " segmentations into "+output_dir)
+    else:
+        json_dir = sys.argv[2] if len(sys.argv) == 3 else segment_json_dir
+        print("Imported "+str(store.import_json(json_dir)) +
+              " segmentations from "+json_dir)
@@ -0,0 +1,90 @@
+"""
+Tests of the search of the patterns in the transcription (align.py)
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import align
+from align import seeded_hamming_match, hamming_scores, complete_word, align_patterns
+from transcription import Transcription
+
+
+def test_seeded_hamming_match_seeds_past_the_end():
+    # The only q-gram shared is at the end of the text, too late for the whole pattern to fit after it
+    text = Transcription("le petit chat dort sur le tapis du salon pendant la nuit wxyz")
+    pattern = "wxyzqqqqkkkkjjjjvvvv"
+    assert len(pattern) < len(text.text)-20
+
+    index, score, evaluated = seeded_hamming_match(pattern, text, band=5)
+
+    scores = hamming_scores(pattern, text.codes)
+    assert index == int(scores.argmin())
+    assert score == int(scores.min())
+    assert evaluated >= len(scores)
+
+
+def test_seeded_hamming_match_pattern_near_the_end():
+    text = Transcription("debut du texte sans rapport avec la ligne " * 5 + "la derniere ligne de la page")
+    pattern = "la derniere ligne de la pa"
+
+    index, score, _ = seeded_hamming_match(pattern, text)
+
+    assert score == 0
+    assert text.lower[index:index+len(pattern)] == pattern
+
+
+def test_complete_word_at_the_start_of_the_text():
+    # The text doesn't end with a separator, the previous walk wrapped to its end and dropped the first word
+    text = Transcription("bonjour le petit monde qui dort encore sous la lune pale")
+
+    assert complete_word(text, 0, 5) == "bonjour"
+    assert complete_word(text, 0, 5, threshold=3) == "bonjour"
+    associations, indexes = align_patterns(["bonjour le petit monde", "qui dort encore sous la lune"], text)
+    assert associations[0][2] == "bonjour le petit monde"
+    assert indexes[0] == 0
+
+
+def test_alignment_cache_key_with_default_options():
+    text = Transcription("le petit chat dort sur le tapis du salon")
+    ocr = ["le petit chat dort"]
+    key = align.alignment_cache_key(ocr, text, {})
+
+    assert align.alignment_cache_key(ocr, text, {"mode": "hamming", "search": "full"}) == key
+    assert align.alignment_cache_key(
+        ocr, text, {"mode": "hamming", "search": "full", "band": 20, "window": 200, "q": 4}) == key
+    assert align.alignment_cache_key(ocr, text, {"search": "qgram"}) != key
+
+
+def write_page(tmp_path, filename):
+    for folder in ("extract_txt", "ocr_result", "cropped_match"+os.sep+filename):
+        os.makedirs(tmp_path/"tmp"/folder, exist_ok=True)
+    (tmp_path/"tmp"/"extract_txt"/(filename[:-4]+".gt.txt")).write_text(
+        "le petit chat dort sur le tapis du salon\nreference\n", encoding="UTF-8")
+    (tmp_path/"tmp"/"ocr_result"/(filename[:-4]+"_ocr.txt")).write_text(
+        "le petit chat dort sur le tapis\n", encoding="UTF-8")
+    (tmp_path/"tmp"/"cropped_match"/filename/"0.gt.txt").write_text("pair", encoding="UTF-8")
+
+
+def test_apply_align_adopts_pages_aligned_before_the_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_page(tmp_path, "page.jpg")
+
+    assert align.apply_align(0, "page.jpg", "tmp/extract_image/page.jpg", 1) == 0
+    assert (tmp_path/"tmp"/"cropped_match"/"page.jpg"/"0.gt.txt").exists()
+    entry = align.load_alignment_cache("page.jpg")
+    txt_manual, txt_ocr = align.txt_compare_open("page.jpg")
+    assert entry["key"] == align.alignment_cache_key(txt_ocr, txt_manual, {})
+
+
+def test_apply_align_replaces_pairs_of_outdated_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_page(tmp_path, "page.jpg")
+    align.save_alignment_cache("page.jpg", "outdated", [], [])
+    cropped = []
+    monkeypatch.setattr(align, "align_cropped", lambda *args, **kwargs: cropped.append(args))
+
+    assert align.apply_align(0, "page.jpg", "tmp/extract_image/page.jpg", 1) == 1
+    assert not (tmp_path/"tmp"/"cropped_match"/"page.jpg").exists()
+    assert len(cropped) == 1
@@ -0,0 +1,24 @@
+"""
+Tests of the geometry of the segmented lines (line_geometry.py)
+"""
+
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from line_geometry import bounding_boxes
+
+
+def test_bounding_boxes_with_empty_polygons():
+    polygons = [[], [[1, 1], [9, 9]], [], [[5, 2], [3, 8], [4, 4]], []]
+
+    boxes = bounding_boxes(polygons)
+
+    assert boxes.tolist() == [[0, 0, 0, 0], [1, 1, 9, 9], [0, 0, 0, 0], [3, 2, 5, 8], [0, 0, 0, 0]]
+
+
+def test_bounding_boxes_last_polygon_before_an_empty_one():
+    assert bounding_boxes([[[1, 1], [9, 9]], []]).tolist() == [[1, 1, 9, 9], [0, 0, 0, 0]]
+    assert bounding_boxes([[], []]).tolist() == [[0, 0, 0, 0], [0, 0, 0, 0]]
+    assert bounding_boxes([]).shape == (0, 4)
@@ -0,0 +1,71 @@
+"""
+Tests of the saves of the ocr predictions (ocr_store.py)
+"""
+
+import os
+import sys
+import pickle
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ocr_store
+
+
+def write_pickle(filename):
+    record = ocr_store.OCRLine("le petit chat", [[0, 0], [100, 0], [100, 20], [0, 20]], [[0, 15], [100, 15]],
+                               [0.9]*13, [(i*7, i*7+7) for i in range(13)])
+    os.makedirs(ocr_store.ocr_save_dir, exist_ok=True)
+    with open(ocr_store.pickle_path(filename), "wb") as file:
+        pickle.dump([record], file)
+
+
+def test_migrated_pickle_keeps_its_modification_time(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_pickle("page.jpg")
+    os.utime(ocr_store.pickle_path("page.jpg"), (1_000_000, 1_000_000))
+    # The image was scanned again after the prediction
+    image = tmp_path/"page.jpg"
+    image.write_bytes(b"rescanned")
+
+    assert ocr_store.ocr_exists("page.jpg")
+
+    saved = os.path.getmtime(ocr_store.ocr_path("page.jpg"))
+    assert saved == 1_000_000
+    assert saved < os.path.getmtime(image)
+    assert [record.prediction for record in ocr_store.load_ocr("page.jpg")] == ["le petit chat"]
+
+
+def test_save_and_load_a_page(tmp_path):
+    records = [ocr_store.OCRLine("Été à Noël ſ œ", [[10, 5], [300, 5], [300, 40], [10, 40]], [[10, 30], [300, 30]],
+                                 [0.5+i/100 for i in range(14)], [(20*i, 20*i+15) for i in range(14)],
+                                 {"type": "default", "split": None}),
+               ocr_store.OCRLine("", [[0, 50], [5, 50], [5, 60]], [[0, 55], [5, 55]], [], [], None, False),
+               ocr_store.OCRLine("fin", [[0, 70], [90, 70], [90, 95]], [[0, 90], [90, 90]],
+                                 [1.0, 0.25, 0.75], [(0, 30), (30, 60), (60, 89)], {"type": "marginalia"})]
+    metadata = {"image_size": (1200, 1800), "model": {"name": "m.mlmodel", "sha256": "ab"*32},
+                "filtered_lines": 2}
+    path = str(tmp_path/"page.jpg_ocr.npz")
+
+    ocr_store.save_ocr(records, "page.jpg", path=path, metadata=metadata)
+    loaded = ocr_store.load_ocr("page.jpg", path=path)
+
+    assert len(loaded) == len(records)
+    for record, saved in zip(loaded, records):
+        assert record.prediction == saved.prediction
+        assert record.line == saved.line
+        assert record.baseline == saved.baseline
+        assert record.confidences == pytest.approx(saved.confidences)
+        assert record.raw_cuts == [list(cut) for cut in saved.raw_cuts]
+        assert all(isinstance(position, int) for cut in record.raw_cuts for position in cut)
+        assert record.tags == saved.tags
+        assert record.display_order == saved.display_order
+    assert ocr_store.load_metadata("page.jpg", path=path) == metadata
+
+
+def test_load_metadata_of_a_page_saved_without_it(tmp_path):
+    path = str(tmp_path/"page.jpg_ocr.npz")
+    ocr_store.save_ocr([], "page.jpg", path=path)
+
+    assert ocr_store.load_ocr("page.jpg", path=path) == []
+    assert ocr_store.load_metadata("page.jpg", path=path) == {
+        "image_size": None, "model": None, "filtered_lines": None}
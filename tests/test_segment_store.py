@@ -0,0 +1,50 @@
+"""
+Tests of the store of the segmentations (segment_store.py)
+"""
+
+import os
+import sys
+import ujson
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from segment_store import SegmentStore, encode_segmentation, decode_segmentation
+
+
+def page_segmentation(shift=0):
+    return {"text_direction": "horizontal-lr", "type": "baselines", "script_detection": False,
+            "lines": [{"baseline": [[10+shift, 30], [300, 31]], "boundary": [[10, 5], [300, 5], [300, 40], [10, 40]],
+                       "tags": {"type": "default"}},
+                      {"baseline": [[0, 55], [5, 55]], "boundary": [], "tags": {"type": "marginalia", "note": "écrit"}}],
+            "regions": {"text": [[[0, 0], [400, 0], [400, 100], [0, 100]]], "title": []}}
+
+
+def test_encode_and_decode_a_segmentation():
+    segmentation = page_segmentation()
+
+    assert decode_segmentation(*encode_segmentation(segmentation)) == segmentation
+
+
+def test_encode_and_decode_float_coordinates():
+    segmentation = page_segmentation()
+    segmentation["lines"][0]["baseline"] = [[10.5, 30.25], [300, 31]]
+
+    decoded = decode_segmentation(*encode_segmentation(segmentation))
+
+    assert decoded["lines"][0]["baseline"] == [[10.5, 30.25], [300, 31]]
+    assert decoded["lines"][1] == segmentation["lines"][1]
+
+
+def test_get_many_with_the_json_fallback(tmp_path):
+    json_dir = tmp_path/"segment"
+    json_dir.mkdir()
+    (json_dir/"old.jpg_segment.json").write_text(ujson.dumps(page_segmentation(1)), encoding="UTF-8")
+    store = SegmentStore(str(tmp_path/"segment.sqlite"), json_dir=str(json_dir))
+    store.put("new.jpg", page_segmentation(2))
+
+    segmentations = store.get_many(["new.jpg", "old.jpg", "missing.jpg"])
+
+    assert segmentations == {"new.jpg": page_segmentation(2), "old.jpg": page_segmentation(1)}
+    assert store.images() == ["new.jpg", "old.jpg"]
+    assert "old.jpg" in store and "missing.jpg" not in store
+    assert store.get("missing.jpg") is None
+    store.close()
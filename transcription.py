@@ -0,0 +1,153 @@
+"""
+transcription.py: Contains the Transcription object, holding every form of a transcription used for alignment
+"""
+
+import numpy as np
+import os
+from functools import lru_cache
+
+# Characters ending a word, when completing words of an alignment
+word_separator = [" ", ",", "", "\n"]
+
+
+def lower_text(text: str) -> str:
+    """
+    Lowercase a text while keeping one character per character of the original text,
+    so that indexes found in the lowercased text are valid in the original one
+
+    Parameters:
+        text :
+            The text to lowercase
+
+    Returns:
+        The lowercased text, of the same length as text
+    """
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # Some characters expand when lowercased, lower them one by one
+        lowered = ''.join(c.lower()[0] for c in text)
+    return lowered
+
+
+def encode_text(text: str, lower: bool = True) -> np.ndarray:
+    """
+    Encode a text into an array of code points, so it can be compared with vectorized operations
+
+    Parameters:
+        text :
+            The text to encode
+        lower :
+            If True, the text is lowercased before being encoded
+
+    Returns:
+        A numpy array of the code points, with one value per character of text
+    """
+    if lower:
+        text = lower_text(text)
+    return np.array([ord(c) for c in text], dtype=np.int32)
+
+
+def word_separators(text: str) -> np.ndarray:
+    """
+    Find the positions of every word separator of a text
+
+    Parameters:
+        text :
+            The text
+
+    Returns:
+        A sorted numpy array of the indexes of the word separators
+    """
+    return np.array([i for i, c in enumerate(text) if c in word_separator], dtype=np.int64)
+
+
+def qgram_index(text_lower: str, q: int = 4) -> dict:
+    """
+    Build an inverted index of every q-gram of the text
+
+    Parameters:
+        text_lower :
+            Text lowercased with lower_text()
+        q :
+            Number of characters of each q-gram
+
+    Returns:
+        Dictionnary associating each q-gram to a numpy array of its positions in the text
+    """
+    positions = {}
+    for i in range(len(text_lower)-q+1):
+        positions.setdefault(text_lower[i:i+q], []).append(i)
+    return {qgram: np.array(lst, dtype=np.int32) for qgram, lst in positions.items()}
+
+
+class Transcription:
+    """
+    A transcription, with the forms of its text used for alignment computed once
+
+    Attributes:
+        raw :
+            The transcription as read
+        text :
+            The transcription with newlines replaced by spaces, indexes of alignments refer to this text
+        lower :
+            The text lowercased with lower_text()
+        codes :
+            The text encoded with encode_text()
+        separators :
+            Sorted array of the positions of word separators in text
+    """
+
+    def __init__(self, raw: str) -> None:
+        self.raw = raw
+        self.text = raw.replace("\n", " ")
+        self.lower = lower_text(self.text)
+        self.codes = encode_text(self.text)
+        self.separators = word_separators(self.text)
+        self._qgram_indexes = {}
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    def qgram_index(self, q: int = 4) -> dict:
+        """
+        Inverted index of the q-grams of the lowercased text, built on first use (see qgram_index())
+
+        Parameters:
+            q :
+                Number of characters of each q-gram
+
+        Returns:
+            Dictionnary associating each q-gram to a numpy array of its positions in the text
+        """
+        if q not in self._qgram_indexes:
+            self._qgram_indexes[q] = qgram_index(self.lower, q)
+        return self._qgram_indexes[q]
+
+
+@lru_cache(maxsize=32)
+def _load_transcription(filepath: str, mtime: float, remove_last_line: bool) -> Transcription:
+    """
+    Read a transcription file, cached on its path and modification time (see load_transcription())
+    """
+    with open(filepath, newline='', encoding='UTF-8', errors="ignore") as inputfile:
+        txt_manual = inputfile.readlines()
+        if remove_last_line:
+            txt_manual.pop()
+        txt_manual = ''.join(txt_manual).replace('\t', '')
+    return Transcription(txt_manual)
+
+
+def load_transcription(filepath: str, remove_last_line: bool = True) -> Transcription:
+    """
+    Read a transcription file without tab, the result is cached until the file is modified
+
+    Parameters:
+        filepath :
+            Path to the transcription
+        remove_last_line :
+            If True, the last line is removed (it is the autographe reference in the MDV dataset)
+
+    Returns:
+        The Transcription object
+    """
+    return _load_transcription(filepath, os.path.getmtime(filepath), remove_last_line)